@@ -0,0 +1,218 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class LocalRateLimiter:
+    """Per-model requests-per-minute limits for a single process; see shared_state.SharedRateLimiter
+    for the version that holds across workers."""
+
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.buckets = {}
+
+    async def acquire(self, model):
+        rpm = self.requests_per_minute.get(model)
+        if not rpm:
+            return
+        bucket = self.buckets.get(model)
+        if bucket is None:
+            # Same burst as SharedRateLimiter: a few seconds' worth.
+            bucket = self.buckets[model] = TokenBucket(rpm / 60, max(1, rpm / 20), time.monotonic())
+        while bucket.refill(time.monotonic()) < 1:
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+        bucket.tokens -= 1
+
+
+class AdmissionControl:
+    """Per-user and per-guild token buckets for incoming requests.
+
+    A request is admitted only if both its user's and its guild's bucket hold a token, and then
+    takes one from each, so a rejected request costs nothing. Buckets that have refilled are
+    dropped once there are more than `max_keys` of them.
+    """
+
+    def __init__(self, user_per_minute, user_burst, guild_per_minute, guild_burst, exempt=(), max_keys=10000,
+                 metrics=None):
+        self.limits = {
+            "user": (user_per_minute / 60, user_burst),
+            "guild": (guild_per_minute / 60, guild_burst),
+        }
+        self.exempt = set(exempt)
+        self.max_keys = max_keys
+        self.metrics = metrics
+        self.buckets = {}
+        self.warned = set()
+
+    def _bucket(self, kind, key, now):
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            rate, burst = self.limits[kind]
+            bucket = self.buckets[(kind, key)] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, now):
+        for key in [k for k, b in self.buckets.items() if b.refill(now) >= b.burst]:
+            del self.buckets[key]
+
+    def admit(self, user_id, guild_id):
+        """Return None if the request may go ahead, otherwise "user" or "guild" for the limit it hit."""
+        if user_id in self.exempt:
+            return None
+        now = time.monotonic()
+        buckets = [("user", self._bucket("user", user_id, now))]
+        if guild_id is not None:
+            buckets.append(("guild", self._bucket("guild", guild_id, now)))
+        for kind, bucket in buckets:
+            if bucket.refill(now) < 1:
+                if self.metrics is not None:
+                    self.metrics.inc("admission_rejected_total", reason=kind)
+                return kind
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        self.warned.discard(user_id)
+        return None
+
+    def should_warn(self, user_id):
+        """True the first time a user is turned away since they were last admitted."""
+        if user_id in self.warned:
+            return False
+        self.warned.add(user_id)
+        return True
+
+    def throttled(self):
+        """(kind, key, tokens) for every bucket that is currently empty."""
+        now = time.monotonic()
+        return [(kind, key, b.refill(now)) for (kind, key), b in self.buckets.items() if b.refill(now) < 1]
+
+
+class FairScheduler:
+    """Start-time fair queueing of pipelines across channels, under a global in-flight cap.
+
+    Each request to `slot(channel_id, cost)` gets a start tag of max(virtual time, the channel's
+    previous finish tag) and a finish tag `cost / weight` later; waiting requests are let in
+    lowest start tag first. A channel that sends a burst therefore queues behind its own earlier
+    work while quieter channels keep getting turns.
+
+    The scheduler also watches its own queue depth and the recent p95 of the pipeline times
+    `record`ed for each mode: `shed_level()` is 1 once the depth or any mode's p95 passes its
+    threshold (`shed_p95[mode]` seconds) and 2 at twice the threshold, for callers to answer with
+    cheaper models. Recorded times should leave out queueing, which the depth already counts.
+    """
+
+    def __init__(self, max_in_flight, weights=None, shed_depth=8, shed_p95=None, window=300, metrics=None):
+        self.max_in_flight = max_in_flight
+        self.weights = weights or {}
+        self.shed_depth = shed_depth
+        self.shed_p95 = shed_p95 or {}
+        self.window = window
+        self.metrics = metrics
+        self.virtual = 0.0
+        self.finish = {}
+        self.queue = []
+        self.in_flight = 0
+        self.running = {}
+        self.latencies = deque(maxlen=1000)
+        self.seq = itertools.count()
+
+    def depth(self):
+        return sum(1 for *_, fut in self.queue if not fut.done())
+
+    def waiting_by_channel(self):
+        counts = {}
+        for _, _, channel_id, fut in self.queue:
+            if not fut.done():
+                counts[channel_id] = counts.get(channel_id, 0) + 1
+        return counts
+
+    @contextlib.asynccontextmanager
+    async def slot(self, channel_id, cost=1):
+        start = max(self.virtual, self.finish.get(channel_id, 0.0))
+        self.finish[channel_id] = start + cost / self.weights.get(channel_id, 1)
+        queued = time.monotonic()
+        if self.in_flight < self.max_in_flight and not self.depth():
+            self._start(start)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.queue, (start, next(self.seq), channel_id, fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Let in just as we were cancelled: pass the slot on.
+                    self._release(None)
+                raise
+        if self.metrics is not None:
+            self.metrics.observe("admission_wait_seconds", time.monotonic() - queued)
+        self.running[channel_id] = self.running.get(channel_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._release(channel_id)
+
+    def _start(self, start):
+        self.in_flight += 1
+        self.virtual = max(self.virtual, start)
+
+    def _release(self, channel_id):
+        self.in_flight -= 1
+        if self.running.get(channel_id, 0) > 1:
+            self.running[channel_id] -= 1
+        else:
+            self.running.pop(channel_id, None)
+        while self.queue and self.in_flight < self.max_in_flight:
+            start, _, _, fut = heapq.heappop(self.queue)
+            if fut.done():
+                continue
+            self._start(start)
+            fut.set_result(None)
+        # Channels whose last finish tag is behind virtual time are idle and start fresh anyway.
+        if len(self.finish) > 1000:
+            self.finish = {c: f for c, f in self.finish.items() if f > self.virtual}
+
+    def record(self, mode, seconds):
+        self.latencies.append((time.monotonic(), mode, seconds))
+
+    def p95_by_mode(self):
+        cutoff = time.monotonic() - self.window
+        by_mode = {}
+        for t, mode, seconds in self.latencies:
+            if t >= cutoff:
+                by_mode.setdefault(mode, []).append(seconds)
+        for mode, recent in by_mode.items():
+            recent.sort()
+            by_mode[mode] = recent[min(len(recent) - 1, int(0.95 * len(recent)))]
+        return by_mode
+
+    def shed_level(self):
+        depth = self.depth()
+        # Modes have very different normal latencies, so each is held to its own threshold.
+        load = max(
+            (p95 / self.shed_p95[mode] for mode, p95 in self.p95_by_mode().items() if self.shed_p95.get(mode)),
+            default=0,
+        )
+        if depth >= 2 * self.shed_depth or load >= 2:
+            return 2
+        if depth >= self.shed_depth or load >= 1:
+            return 1
+        return 0
@@ -0,0 +1,109 @@
+import asyncio
+from collections import OrderedDict
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def shrink_image(data, mime_type, max_side, min_bytes):
+    """Downscale and re-encode an image if it is large. Returns (data, mime_type)."""
+    if Image is None or len(data) < min_bytes:
+        return data, mime_type
+    try:
+        with Image.open(BytesIO(data)) as img:
+            if getattr(img, "is_animated", False):
+                return data, mime_type
+            img.thumbnail((max_side, max_side))
+            out = BytesIO()
+            if img.mode in ("RGBA", "LA", "P"):
+                img.save(out, format="WEBP", quality=85)
+                new_mime = "image/webp"
+            else:
+                img.convert("RGB").save(out, format="JPEG", quality=85, optimize=True)
+                new_mime = "image/jpeg"
+    except Exception as e:
+        print(f"Could not shrink image: {e}")
+        return data, mime_type
+    if out.tell() >= len(data):
+        return data, mime_type
+    return out.getvalue(), new_mime
+
+
+class AttachmentCache:
+    """LRU cache of downloaded image attachments, bounded by total bytes.
+
+    With a `shared` store, misses are looked up there before downloading and downloads are
+    written back, so other workers (and this one after a restart) can reuse them.
+    """
+
+    def __init__(self, max_bytes, concurrency=4, max_side=1536, shrink_min_bytes=512 * 1024, shared=None, shared_ttl=None):
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.max_side = max_side
+        self.shrink_min_bytes = shrink_min_bytes
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+
+    def get(self, attachment_id):
+        entry = self.entries.get(attachment_id)
+        if entry is not None:
+            self.entries.move_to_end(attachment_id)
+        return entry
+
+    def put(self, attachment_id, entry):
+        if attachment_id in self.entries:
+            self.size -= len(self.entries.pop(attachment_id)[0])
+        if len(entry[0]) > self.max_bytes:
+            return
+        self.entries[attachment_id] = entry
+        self.size += len(entry[0])
+        while self.size > self.max_bytes:
+            _, (data, _) = self.entries.popitem(last=False)
+            self.size -= len(data)
+
+    async def _download(self, attachment):
+        if self.shared is not None:
+            entry = await self.shared.load_blob("attachments", str(attachment.id))
+            if entry is not None:
+                self.put(attachment.id, entry)
+                return entry
+        data = await attachment.read()
+        entry = await asyncio.to_thread(
+            shrink_image, data, attachment.content_type, self.max_side, self.shrink_min_bytes
+        )
+        self.put(attachment.id, entry)
+        if self.shared is not None:
+            await self.shared.save_blob("attachments", str(attachment.id), entry[0], entry[1], self.shared_ttl)
+        return entry
+
+    async def fetch(self, attachment):
+        """Return (data, mime_type) for an image attachment, downloading it at most once."""
+        entry = self.get(attachment.id)
+        if entry is not None:
+            return entry
+        task = self.pending.get(attachment.id)
+        if task is None:
+            task = asyncio.ensure_future(self._download(attachment))
+            self.pending[attachment.id] = task
+            task.add_done_callback(lambda _: self.pending.pop(attachment.id, None))
+        return await asyncio.shield(task)
+
+    async def fetch_many(self, attachments):
+        """Fetch several attachments concurrently. Failed downloads come back as None."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_one(attachment):
+            async with semaphore:
+                try:
+                    return await self.fetch(attachment)
+                except Exception as e:
+                    print(f"Could not download attachment {attachment.id}: {e}")
+                    return None
+
+        return await asyncio.gather(*(fetch_one(a) for a in attachments))
@@ -0,0 +1,53 @@
+"""A stand-in for the Discord gateway, run as a sharding.py worker.
+
+    STATE_DB_PATH=/tmp/bench.sqlite3 python sharding.py --workers 2 --shard-count 4 -- \\
+        python bench/fake_gateway.py --synthetic 200 --speed 4 --out-dir /tmp/shards --crash-after 20
+
+Every worker builds the same trace, keeps the events for guilds on its own shards (Discord's
+`(guild_id >> 22) % shard_count` rule, read from SHARD_IDS / SHARD_COUNT) and replays them
+through the bot like replay.py does, sharing STATE_DB_PATH with the other workers. Results go to
+`--out-dir/worker-<WORKER_ID>.json`. With `--crash-after N` the first run of each worker exits
+abruptly after N events, to exercise the supervisor's restart path.
+"""
+import json
+import os
+
+import replay
+
+
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+
+def main():
+    parser = replay.build_parser()
+    parser.add_argument("--out-dir", help="directory for per-worker results")
+    parser.add_argument("--crash-after", type=int, help="exit abruptly after this many events on the first run")
+    args = parser.parse_args()
+
+    shard_count = int(os.getenv("SHARD_COUNT") or 1)
+    shards = {int(s) for s in os.getenv("SHARD_IDS", "0").split(",") if s.strip()}
+    worker_id = os.getenv("WORKER_ID", "0")
+    first_run = os.getenv("WORKER_RESTARTS", "0") == "0"
+    # Keep the original line numbers so reply_to still points at the right message.
+    events = [
+        dict(e, index=idx) for idx, e in enumerate(replay.events_for(args))
+        if shard_for(e.get("guild") or 0, shard_count) in shards
+    ]
+
+    def on_event(idx):
+        if args.crash_after is not None and first_run and idx >= args.crash_after:
+            os._exit(3)
+
+    result = replay.run(args, events, on_event)
+    result["worker"] = {"id": worker_id, "shards": sorted(shards), "restarts": int(os.getenv("WORKER_RESTARTS", "0"))}
+    print(f"worker {worker_id}, shards {sorted(shards)}:")
+    replay.print_report(result)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+        with open(os.path.join(args.out_dir, f"worker-{worker_id}.json"), "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""Offline stand-ins for Discord and the google-genai client, used by the replay benchmark."""
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import re
+from types import SimpleNamespace
+
+# Discord snowflakes carry a millisecond timestamp in the top bits, which keeps ids time-ordered.
+DISCORD_EPOCH_MS = 1420070400000
+_sequence = itertools.count()
+
+
+def make_snowflake(when):
+    ms = int(when.timestamp() * 1000) - DISCORD_EPOCH_MS
+    return (ms << 22) | (next(_sequence) & 0x3FFFFF)
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id, data, content_type="image/png", read_latency=0.05):
+        self.id = attachment_id
+        self.data = data
+        self.content_type = content_type
+        self.read_latency = read_latency
+        self.reads = 0
+
+    async def read(self):
+        self.reads += 1
+        await asyncio.sleep(self.read_latency)
+        return self.data
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content, created_at=None, attachments=(), mentions=(), reference=None):
+        self.created_at = created_at or datetime.datetime.now(datetime.timezone.utc)
+        self.id = make_snowflake(self.created_at)
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.author = author
+        self.content = content
+        self.attachments = list(attachments)
+        self.mentions = list(mentions)
+        self.reference = reference
+        self.deleted = False
+
+    @property
+    def clean_content(self):
+        text = self.content
+        for user in self.mentions:
+            text = text.replace(f"<@{user.id}>", f"@{user.display_name}").replace(f"<@!{user.id}>", f"@{user.display_name}")
+        return text
+
+    def to_reference(self, fail_if_not_exists=True):
+        return SimpleNamespace(message_id=self.id, channel_id=self.channel.id)
+
+    async def edit(self, content=None):
+        await self.channel.api_call("edit")
+        self.content = content
+        await self.channel.dispatch("on_raw_message_edit", SimpleNamespace(message=self))
+        return self
+
+    async def delete(self):
+        await self.channel.api_call("delete")
+        self.channel.messages.pop(self.id, None)
+        self.deleted = True
+        await self.channel.dispatch(
+            "on_raw_message_delete", SimpleNamespace(channel_id=self.channel.id, message_id=self.id)
+        )
+
+
+class FakeChannel:
+    """A text channel with history, send, fetch_message and bulk delete.
+
+    Every REST-style call sleeps `api_latency` seconds and is counted in `api_calls`.
+    Messages the bot sends are fed back through `dispatch`, like the gateway would.
+    """
+
+    def __init__(self, channel_id, bot_user, dispatch=None, api_latency=0.03, guild_id=None):
+        self.id = channel_id
+        self.guild = SimpleNamespace(id=guild_id) if guild_id else None
+        self.bot_user = bot_user
+        self.messages = {}
+        self.sent = []
+        self.files = []
+        self.api_latency = api_latency
+        self.api_calls = {}
+        self._dispatch = dispatch
+
+    async def dispatch(self, event, payload):
+        if self._dispatch is not None:
+            await self._dispatch(event, payload)
+
+    async def api_call(self, kind):
+        self.api_calls[kind] = self.api_calls.get(kind, 0) + 1
+        await asyncio.sleep(self.api_latency)
+
+    def add(self, message):
+        self.messages[message.id] = message
+        return message
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        await self.api_call("history")
+        msgs = sorted(self.messages.values(), key=lambda m: m.id)
+        if isinstance(after, datetime.datetime):
+            msgs = [m for m in msgs if m.created_at > after]
+        elif after is not None:
+            msgs = [m for m in msgs if m.id > after.id]
+        if before is not None:
+            when = before if isinstance(before, datetime.datetime) else before.created_at
+            msgs = [m for m in msgs if m.created_at < when]
+        if oldest_first is None:
+            oldest_first = after is not None
+        if not oldest_first:
+            msgs.reverse()
+        for msg in msgs[:limit] if limit is not None else msgs:
+            yield msg
+
+    def get_partial_message(self, message_id):
+        return SimpleNamespace(id=message_id, channel=self)
+
+    async def fetch_message(self, message_id):
+        await self.api_call("fetch")
+        try:
+            return self.messages[message_id]
+        except KeyError:
+            raise LookupError(f"Unknown message {message_id}")
+
+    async def send(self, content=None, reference=None, file=None, **kwargs):
+        await self.api_call("send")
+        resolved = None
+        if reference is not None:
+            resolved = self.messages.get(getattr(reference, "message_id", getattr(reference, "id", None)))
+        msg = FakeMessage(
+            self, self.bot_user, content or "",
+            reference=SimpleNamespace(message_id=resolved.id, resolved=resolved) if resolved else None,
+        )
+        if file is not None:
+            self.files.append(file)
+        self.add(msg)
+        self.sent.append(msg)
+        await self.dispatch("on_message", msg)
+        return msg
+
+    async def delete_messages(self, messages):
+        await self.api_call("bulk_delete")
+        for msg in messages:
+            self.messages.pop(msg.id, None)
+        await self.dispatch(
+            "on_raw_bulk_message_delete",
+            SimpleNamespace(channel_id=self.id, message_ids={m.id for m in messages}),
+        )
+
+
+class ModelProfile:
+    """Latency, failure rate and token behaviour of one fake model.
+
+    Latency is `base` seconds plus `per_1k_prompt` seconds per thousand prompt tokens, scaled by
+    log-normal jitter.
+    """
+
+    def __init__(self, base=0.5, per_1k_prompt=0.02, jitter=0.25, failure_rate=0.0, thinking_ratio=0.3):
+        self.base = base
+        self.per_1k_prompt = per_1k_prompt
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.thinking_ratio = thinking_ratio
+
+
+DEFAULT_PROFILES = {
+    "gemini-2.5-pro": ModelProfile(base=2.0, per_1k_prompt=0.05, thinking_ratio=0.3),
+    "gemini-2.5-flash": ModelProfile(base=0.6, per_1k_prompt=0.02, thinking_ratio=0.2),
+    "gemini-2.5-flash-lite-preview-06-17": ModelProfile(base=0.25, per_1k_prompt=0.01, thinking_ratio=0),
+    "gemini-2.0-flash-preview-image-generation": ModelProfile(base=3.0, per_1k_prompt=0.0),
+    "gemini-2.5-flash-preview-tts": ModelProfile(base=1.2, per_1k_prompt=0.0),
+}
+
+
+def _parts(contents):
+    if isinstance(contents, str):
+        return [contents]
+    parts = []
+    for item in contents:
+        if isinstance(item, dict):
+            parts.extend(item.get("parts", []))
+        else:
+            parts.extend(getattr(item, "parts", None) or [item])
+    return parts
+
+
+def _texts(contents):
+    texts = []
+    for part in _parts(contents):
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict):
+            texts.append(part.get("text") or "")
+        elif getattr(part, "text", None):
+            texts.append(part.text)
+    return texts
+
+
+def _images(contents):
+    return sum(1 for part in _parts(contents) if getattr(part, "inline_data", None) is not None)
+
+
+class FakeModels:
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def generate_content(self, model, contents, config=None):
+        return await self.owner.respond(model, contents, config)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        response = await self.owner.respond(model, contents, config, stream=True)
+        return self.owner.chunks(response)
+
+
+class FakeCaches:
+    def __init__(self, owner):
+        self.owner = owner
+        self.counter = itertools.count(1)
+
+    async def create(self, model, config=None):
+        self.owner.calls.append((model, "cache.create"))
+        await asyncio.sleep(0.2 * self.owner.time_scale)
+        name = f"cachedContents/fake-{next(self.counter)}"
+        contents = config.contents or []
+        self.owner.caches[name] = sum(len(t) for t in _texts(contents)) // 4 + 258 * _images(contents)
+        return SimpleNamespace(name=name)
+
+    async def delete(self, name):
+        self.owner.caches.pop(name, None)
+
+
+class FakeGenaiClient:
+    """Answers every call the bot makes with plausible, well-formed output.
+
+    Per-model latency, failure rate and token counts come from `profiles`, and every latency is
+    multiplied by `time_scale`. All randomness is drawn from a seeded RNG so runs are repeatable.
+    """
+
+    def __init__(self, profiles=None, seed=0, stream_chunks=8, time_scale=1.0):
+        self.profiles = dict(DEFAULT_PROFILES)
+        self.profiles.update(profiles or {})
+        self.rng = random.Random(seed)
+        self.stream_chunks = stream_chunks
+        self.time_scale = time_scale
+        self.calls = []
+        self.caches = {}
+        self.aio = SimpleNamespace(models=FakeModels(self), caches=FakeCaches(self))
+
+    def _output(self, model, contents, config):
+        texts = _texts(contents)
+        system = str(getattr(config, "system_instruction", "") or "")
+        modalities = getattr(config, "response_modalities", None) or []
+        schema = getattr(config, "response_schema", None)
+        if "AUDIO" in modalities:
+            # 24 kHz 16-bit mono, ~60ms of audio per word.
+            words = len(texts[-1].split()) if texts else 1
+            return None, b"\x00\x00" * int(24000 * 0.06 * words)
+        if "IMAGE" in modalities:
+            return "here you go!", bytes(self.rng.getrandbits(8) for _ in range(4096))
+        if schema is not None and str(getattr(schema, "type", "")).upper().endswith("ARRAY"):
+            ids = re.findall(r"^\[(\d+)\]", texts[-1], re.M) if texts else []
+            return json.dumps([int(i) for i in ids[-2:]]), None
+        if system.startswith("Respond only with the single line direction"):
+            return "Say it dramatically:", None
+        if "running summary" in system:
+            return "- people chatted about things", None
+        last = texts[-1] if texts else ""
+        if "messages you must reply to" in last:
+            ids = re.findall(r"^\[(\d+)\]", last, re.M)
+            replies = [{"id": int(i), "reply": f"OMG reply to {i} " + "lol " * self.rng.randint(3, 40)} for i in ids]
+            return json.dumps({"responses": replies}), None
+        return "AAAAA ok ok " + "lmao " * self.rng.randint(3, 30), None
+
+    async def respond(self, model, contents, config, stream=False):
+        profile = self.profiles[model]
+        texts = _texts(contents)
+        prompt_tokens = sum(len(t) for t in texts) // 4 + 258 * _images(contents)
+        thinking = getattr(config, "thinking_config", None)
+        budget = getattr(thinking, "thinking_budget", None) or 0
+        thinking_tokens = int(budget * profile.thinking_ratio)
+        latency = (profile.base + profile.per_1k_prompt * prompt_tokens / 1000 + thinking_tokens / 4000)
+        latency *= self.rng.lognormvariate(0, profile.jitter) * self.time_scale
+        cached_tokens = self.caches.get(getattr(config, "cached_content", None), 0)
+        self.calls.append((model, "stream" if stream else "generate"))
+        fail = self.rng.random() < profile.failure_rate
+        await asyncio.sleep(latency if not stream else latency / 2)
+        if fail:
+            raise RuntimeError(f"fake {model} 503 UNAVAILABLE")
+        text, data = self._output(model, contents, config)
+        parts = []
+        if text is not None:
+            parts.append(SimpleNamespace(text=text, inline_data=None))
+        if data is not None:
+            mime = "audio/L16;rate=24000" if "AUDIO" in (getattr(config, "response_modalities", None) or []) else "image/png"
+            parts.append(SimpleNamespace(text=None, inline_data=SimpleNamespace(data=data, mime_type=mime)))
+        usage = SimpleNamespace(
+            prompt_token_count=prompt_tokens + cached_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=len(text or "") // 4 + (len(data) // 1000 if data else 0),
+            thoughts_token_count=thinking_tokens,
+        )
+        usage.total_token_count = usage.prompt_token_count + usage.candidates_token_count + thinking_tokens
+        return SimpleNamespace(
+            text=text,
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))],
+            usage_metadata=usage,
+            stream_latency=latency / 2,
+        )
+
+    async def chunks(self, response):
+        text = response.text or ""
+        step = max(1, len(text) // self.stream_chunks)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+        for idx, piece in enumerate(pieces):
+            await asyncio.sleep(response.stream_latency / len(pieces))
+            last = idx == len(pieces) - 1
+            yield SimpleNamespace(text=piece, usage_metadata=response.usage_metadata if last else None)
@@ -0,0 +1,424 @@
+"""Microbenchmarks for the pure helpers that run on every message, with equivalence checks.
+
+Times split_long_message, strip_bot_name, extract_json, estimate_tokens and the context and
+decision-log construction (collect_context / collect_context_pairs) on realistic and adversarial
+inputs: 100-message windows, 30k-character replies, malformed and truncated JSON, emoji-heavy
+text. Each helper is timed next to the reference versions below, the implementations they replaced;
+before timing, both are run on randomized inputs and any difference in output fails the run.
+
+    python bench/micro.py --compare bench/micro_baseline.json
+    python bench/micro.py --out micro.json
+
+bench/micro_baseline.json holds the results the current helpers were accepted with.
+
+The run exits non-zero if a helper is slower than its reference, or (with `--compare`) slower
+relative to its reference than in an earlier run, by more than `--tolerance`. Record a baseline
+with `--out` before changing a helper, then check the change against it.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import re
+import sys
+import timeit
+from types import SimpleNamespace
+
+from replay import BOT_USER_ID, VOCAB, git_commit, import_bot
+
+from fakes import FakeChannel, FakeGenaiClient, FakeMessage, FakeUser
+
+EMOJI = ["😂", "🔥", "👀", "🎉", "💀", "🙏", "✨", "🥺", "👍🏽", "🏳️‍🌈", "👨‍👩‍👧‍👦", "❤️"]
+ODD_TEXT = ["İ", "Σ", "ß", "ﬁ", "é", "日本", "‍", "\t", "\r\n"]
+PUNCTUATION = [". ", "! ", "? ", "\n", ".\n", "...", ", ", " ", "!!"]
+
+
+# Reference versions: the implementations the helpers in bot.py and context_budget.py replaced.
+
+def reference_split_long_message(text, max_len=2000):
+    sentences = re.split(r'([.!?]\s|\n)', text)
+    result = []
+    current = ''
+    for i in range(0, len(sentences), 2):
+        sentence = sentences[i]
+        sep = sentences[i+1] if i+1 < len(sentences) else ''
+        piece = sentence + sep
+        if len(current) + len(piece) > max_len:
+            if current:
+                result.append(current)
+                current = ''
+            while len(piece) > max_len:
+                result.append(piece[:max_len])
+                piece = piece[max_len:]
+        current += piece
+    if current:
+        result.append(current)
+    return result
+
+
+def reference_strip_bot_name(text, bot_name):
+    bot_name = bot_name.lower()
+    text = text.lstrip()
+    if text.lower().startswith(bot_name + ":"):
+        return text[len(bot_name)+1:].lstrip()
+    return text
+
+
+def reference_partial_string(s, i):
+    from jsonstream import _CUT_ESCAPE, _HIGH_SURROGATE
+
+    body = _HIGH_SURROGATE.sub(r"\1", _CUT_ESCAPE.sub(r"\1", s[i:]))
+    try:
+        return json.loads('"' + body + '"', strict=False)
+    except json.JSONDecodeError:
+        return body
+
+
+def reference_estimate_tokens(text):
+    chars = len(text)
+    extra = len(text.encode("utf-8")) - chars
+    return chars // 4 + extra // 2 + 1
+
+
+def reference_truncate_to_tokens(text, max_tokens):
+    from context_budget import estimate_tokens
+
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = max_tokens * 4
+    while cut > 0 and estimate_tokens(text[:cut]) > max_tokens:
+        cut = cut * 3 // 4
+    return text[:cut].rstrip() + " …[truncated]"
+
+
+@contextlib.contextmanager
+def reference_helpers(bot):
+    """Swap the reference versions in for the module-level helpers that other code calls.
+
+    Inside it, bot.extract_json, collect_context and collect_context_pairs run as they did before.
+    """
+    import context_budget
+    import jsonstream
+
+    swaps = [
+        (jsonstream, "_partial_string", reference_partial_string),
+        (context_budget, "estimate_tokens", reference_estimate_tokens),
+        (bot, "estimate_tokens", reference_estimate_tokens),
+        (context_budget, "truncate_to_tokens", reference_truncate_to_tokens),
+        (bot, "truncate_to_tokens", reference_truncate_to_tokens),
+    ]
+    saved = [(module, name, getattr(module, name)) for module, name, _ in swaps]
+    for module, name, value in swaps:
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+# Inputs.
+
+def words(rng, n, emoji=0.0):
+    out = []
+    for _ in range(n):
+        out.append(rng.choice(EMOJI) if rng.random() < emoji else rng.choice(VOCAB))
+    return " ".join(out)
+
+
+def prose(rng, chars, emoji=0.0):
+    """Sentences and paragraphs of chat-like text, about `chars` characters long."""
+    parts = []
+    size = 0
+    while size < chars:
+        sentence = words(rng, rng.randint(3, 30), emoji).capitalize() + rng.choice(PUNCTUATION)
+        if rng.random() < 0.1:
+            sentence += "\n"
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:chars]
+
+
+def replies_document(rng, n, chars, emoji=0.0):
+    return json.dumps(
+        {"responses": [{"id": 1000 + i, "reply": prose(rng, chars, emoji)} for i in range(n)]},
+        ensure_ascii=rng.random() < 0.5,
+    )
+
+
+def json_inputs(rng):
+    doc = replies_document(rng, 3, 10000, emoji=0.1)
+    braces = prose(rng, 2000).replace(" so ", " {so} ").replace(" it ", " [it] ")
+    return {
+        "plain": doc,
+        "fenced": "```json\n" + doc + "\n```",
+        "prose": "Sure! Here you go:\n" + doc + "\nHope that helps.",
+        "truncated": doc[: len(doc) * 2 // 3],
+        "stray_braces": braces + " " + doc[: len(doc) // 2],
+        "ids": json.dumps([rng.randrange(10**17, 10**18) for _ in range(20)]),
+    }
+
+
+def random_fragment(rng):
+    """Random JSON-ish text for the equivalence checks: documents, truncations, fences and junk."""
+    kind = rng.random()
+    if kind < 0.3:
+        doc = replies_document(rng, rng.randint(0, 3), rng.randint(0, 80), emoji=0.2)
+    elif kind < 0.45:
+        doc = json.dumps([rng.randrange(-5, 10**18) for _ in range(rng.randint(0, 5))])
+    elif kind < 0.55:
+        doc = rng.choice(["1", '"x"', "NaN", "[NaN]", "-Infinity", "{}", "[]", "null", "[1e400]", '{"a": -0}'])
+    elif kind < 0.8:
+        # Replies cut inside escapes: backslash runs, \u sequences and surrogate halves.
+        reply = "x" * rng.randint(0, 30) + "".join(
+            rng.choice(["\\\\", "\\", "\\u", "\\ud83d", "\\ude00", "\\u00e9", "\\n", "x", "\n", "😂"])
+            for _ in range(rng.randint(0, 12))
+        )
+        doc = '{"responses": [{"id": 1, "reply": "' + reply
+    else:
+        doc = "".join(rng.choice('{}[]":,\\ ntrufalse0123.e-' + "".join(EMOJI[:3])) for _ in range(rng.randint(0, 40)))
+    if rng.random() < 0.3:
+        doc = doc[: rng.randint(0, len(doc))]
+    if rng.random() < 0.3:
+        label = rng.choice(["json", "JSON", "", "js {", "json [x]"])
+        closing = rng.choice(["\n```", "```", "", "\n``` trailing"])
+        doc = f"```{label}{rng.choice(['', chr(10), ' ', chr(10) + ' '])}{doc}{closing}"
+    if rng.random() < 0.3:
+        doc = rng.choice(["", "  ", "Here: ", "a {b} ", "[x] ", "\n"]) + doc + rng.choice(["", " ok", "\n", " }"])
+    return doc
+
+
+def random_text(rng):
+    """Random text for the split and strip checks, dense in sentence ends, newlines and odd characters."""
+    pool = PUNCTUATION + EMOJI + ODD_TEXT + list(VOCAB[:8])
+    return "".join(rng.choice(pool) + rng.choice(["", " ", "x"]) for _ in range(rng.randint(0, 60)))
+
+
+def make_window(rng, channel, users, bot_user, long_replies=0, emoji=0.0):
+    """100 messages as they would sit in the history buffer: chatter, pings, replies and bot answers."""
+    window = []
+    for i in range(100):
+        if rng.random() < 0.25:
+            author = bot_user
+            text = prose(rng, 30000, emoji) if i < long_replies else prose(rng, rng.randint(50, 600), emoji)
+        else:
+            author = rng.choice(users)
+            text = words(rng, rng.randint(2, 40), emoji)
+        mentions = [bot_user] if author != bot_user and rng.random() < 0.2 else []
+        if mentions:
+            text = f"<@{bot_user.id}> " + text
+        reference = None
+        if window and rng.random() < 0.2:
+            target = rng.choice(window)
+            reference = SimpleNamespace(message_id=target.id, resolved=target)
+        window.append(channel.add(FakeMessage(channel, author, text, mentions=mentions, reference=reference)))
+    return window
+
+
+# Checks and timing.
+
+def check_equivalence(bot, rng, cases, windows, bot_user, loop):
+    """Compare each helper with its reference on `cases` random inputs. Returns a list of failures."""
+    failures = []
+
+    def same(name, args, expected, actual):
+        # repr() too, so that NaN matches NaN.
+        if type(expected) is not type(actual) or (expected != actual and repr(expected) != repr(actual)):
+            failures.append(f"{name}{args!r}: expected {expected!r}, got {actual!r}")
+
+    def outcome(fn, *args):
+        try:
+            return fn(*args)
+        except RecursionError as e:
+            return e.__class__
+
+    for _ in range(cases):
+        text = random_text(rng)
+        max_len = rng.choice([1, 2, 3, 5, 8, 20, 2000])
+        same("split_long_message", (text, max_len),
+             reference_split_long_message(text, max_len), bot.split_long_message(text, max_len))
+        name = rng.choice(["MuffinBot", "muffinbot", "Σίσυφος", "İbo", "straße", "x", ""])
+        prefix = rng.choice([name, name.upper(), name.lower(), name[:-1], ""]) + rng.choice([":", ": ", "", " :"])
+        text = rng.choice(["", " ", "\n"]) + prefix + text
+        same("strip_bot_name", (text, name), reference_strip_bot_name(text, name), bot.strip_bot_name(text, name))
+        text = random_fragment(rng)
+        max_tokens = rng.choice([1, 5, 20, 100])
+        with reference_helpers(bot):
+            expected = (outcome(bot.extract_json, text), bot.estimate_tokens(text), bot.truncate_to_tokens(text, max_tokens))
+        same("extract_json", (text,), expected[0], outcome(bot.extract_json, text))
+        same("estimate_tokens", (text,), expected[1], bot.estimate_tokens(text))
+        same("truncate_to_tokens", (text, max_tokens), expected[2], bot.truncate_to_tokens(text, max_tokens))
+
+    for name, window in windows.items():
+        exclude = {window[-1].id}
+        with reference_helpers(bot):
+            expected = (
+                loop.run_until_complete(bot.collect_context(window, exclude, bot_user)),
+                loop.run_until_complete(bot.collect_context_pairs(window, exclude, bot_user)),
+            )
+        actual = (
+            loop.run_until_complete(bot.collect_context(window, exclude, bot_user)),
+            loop.run_until_complete(bot.collect_context_pairs(window, exclude, bot_user)),
+        )
+        same("collect_context", (name,), expected[0], actual[0])
+        same("collect_context_pairs", (name,), expected[1], actual[1])
+    return failures
+
+
+def time_pair(bot, current, reference, repeat):
+    """Fastest per-call seconds of `current` and of `reference` (run inside reference_helpers).
+
+    Timed batches of the two alternate, so drift in machine load hits both alike.
+    """
+    timers = {"current": timeit.Timer(current), "reference": timeit.Timer(reference)}
+    with reference_helpers(bot):
+        number, _ = timers["reference"].autorange()
+    best = {}
+    for _ in range(repeat):
+        for name, timer in timers.items():
+            with reference_helpers(bot) if name == "reference" else contextlib.nullcontext():
+                elapsed = timer.timeit(number) / number
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return best["current"], best["reference"]
+
+
+def benchmarks(bot, rng, windows, bot_user, loop):
+    """(name, current, reference) callables, one per helper and input. Time `reference` inside reference_helpers."""
+    reply = prose(rng, 30000)
+    emoji_reply = prose(rng, 30000, emoji=0.4)
+    unbroken = "a" * 30000
+    short = prose(rng, 300)
+    cases = [
+        ("split/30k", lambda: bot.split_long_message(reply), lambda: reference_split_long_message(reply)),
+        ("split/30k-emoji", lambda: bot.split_long_message(emoji_reply),
+         lambda: reference_split_long_message(emoji_reply)),
+        ("split/30k-unbroken", lambda: bot.split_long_message(unbroken),
+         lambda: reference_split_long_message(unbroken)),
+        ("split/short", lambda: bot.split_long_message(short), lambda: reference_split_long_message(short)),
+        ("strip/30k", lambda: bot.strip_bot_name("MuffinBot: " + reply, "MuffinBot"),
+         lambda: reference_strip_bot_name("MuffinBot: " + reply, "MuffinBot")),
+        ("strip/30k-none", lambda: bot.strip_bot_name(emoji_reply, "MuffinBot"),
+         lambda: reference_strip_bot_name(emoji_reply, "MuffinBot")),
+        ("strip/30k-emoji", lambda: bot.strip_bot_name("MuffinBot: " + emoji_reply, "MuffinBot"),
+         lambda: reference_strip_bot_name("MuffinBot: " + emoji_reply, "MuffinBot")),
+        ("strip/short-emoji", lambda: bot.strip_bot_name("muffinbot: 🔥🔥 ok", "MuffinBot"),
+         lambda: reference_strip_bot_name("muffinbot: 🔥🔥 ok", "MuffinBot")),
+        ("tokens/30k", lambda: bot.estimate_tokens(reply), lambda: reference_estimate_tokens(reply)),
+        ("tokens/30k-emoji", lambda: bot.estimate_tokens(emoji_reply), lambda: reference_estimate_tokens(emoji_reply)),
+    ]
+    for name, text in json_inputs(rng).items():
+        parse = lambda text=text: bot.extract_json(text)  # noqa: E731
+        cases.append((f"json/{name}", parse, parse))
+    for name, window in windows.items():
+        exclude = {window[-1].id}
+
+        def context(window=window, exclude=exclude):
+            loop.run_until_complete(bot.collect_context(window, exclude, bot_user))
+
+        def pairs(window=window, exclude=exclude):
+            loop.run_until_complete(bot.collect_context_pairs(window, exclude, bot_user))
+
+        cases.append((f"context/{name}", context, context))
+        cases.append((f"pairs/{name}", pairs, pairs))
+    return cases
+
+
+def setup(seed):
+    bot = import_bot()
+    fake = FakeGenaiClient(seed=seed)
+    bot.gemini.client = fake
+    bot.context_cache.backend.client = fake
+    bot_user = FakeUser(BOT_USER_ID, "MuffinBot", bot=True)
+    bot.bot._connection.user = bot_user
+
+    async def keep_summary(previous, lines):
+        return previous
+
+    # Windows over the token budget fold their oldest messages into the summary; skip the model call.
+    bot.summaries.summarize = keep_summary
+    rng = random.Random(seed)
+    users = [FakeUser(2000 + i, f"user{i}") for i in range(12)]
+    windows = {}
+    for i, (name, long_replies, emoji) in enumerate([("chat", 0, 0.0), ("emoji", 0, 0.4), ("30k", 5, 0.1)]):
+        channel = FakeChannel(i + 1, bot_user, guild_id=81985242628096)
+        windows[name] = make_window(rng, channel, users, bot_user, long_replies, emoji)
+    return bot, rng, windows, bot_user
+
+
+def compare(result, baseline, tolerance):
+    """Print per-benchmark deltas against `baseline` and return True if none regressed past `tolerance`.
+
+    Times are compared relative to the reference run next to them, which takes out differences
+    in machine speed and load between the two runs.
+    """
+    ok = True
+    print(f"\nvs {baseline.get('commit')} (time relative to reference)")
+    for name, stats in result["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if not old:
+            continue
+        before = old["current"] / old["reference"]
+        after = stats["current"] / stats["reference"]
+        change = (after - before) / before
+        flag = "  REGRESSED" if change > tolerance else ""
+        print(f"{name:<22}{before:>10.3f} ->{after:>8.3f} {change:+.0%}{flag}")
+        if change > tolerance:
+            ok = False
+    return ok
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", type=int, default=3000, help="random inputs per equivalence check")
+    parser.add_argument("--repeat", type=int, default=7, help="timed batches per benchmark; the fastest counts")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--compare", help="results JSON from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs reference or baseline")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot, rng, windows, bot_user = setup(args.seed)
+        failures = check_equivalence(bot, random.Random(args.seed), args.cases, windows, bot_user, loop)
+    if failures:
+        print(f"{len(failures)} equivalence failures, first ones:")
+        for failure in failures[:10]:
+            print("  " + failure[:500])
+        sys.exit(1)
+    print(f"equivalence: {args.cases} random inputs per helper, {len(windows)} windows: ok")
+
+    result = {"commit": git_commit(), "seed": args.seed, "benchmarks": {}}
+    ok = True
+    print(f"{'benchmark':<22}{'reference':>12}{'current':>12}{'speedup':>10}")
+    for name, current, reference in benchmarks(bot, rng, windows, bot_user, loop):
+        if args.filter not in name:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            cur_time, ref_time = time_pair(bot, current, reference, args.repeat)
+        result["benchmarks"][name] = {"reference": ref_time, "current": cur_time}
+        slower = cur_time > ref_time * (1 + args.tolerance)
+        ok = ok and not slower
+        print(f"{name:<22}{ref_time * 1e6:>10.1f}us{cur_time * 1e6:>10.1f}us{ref_time / cur_time:>9.2f}x"
+              + ("  SLOWER" if slower else ""))
+    loop.close()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        ok = compare(result, baseline, args.tolerance) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""Replay channel traces through the real on_message pipeline, offline, and report latency per mode.
+
+Discord and Gemini are replaced by the fakes in bench/fakes.py; everything in between (history,
+coalescing, context building, decision, fallback, streaming, TTS, caches) is the bot's own code.
+
+    python bench/replay.py --synthetic 300 --seed 1 --out baseline.json
+    python bench/replay.py --synthetic 300 --seed 1 --compare baseline.json
+    python bench/replay.py --trace trace.jsonl --speed 5
+
+Trace files are JSONL, one message per line, in time order:
+
+    {"t": 0.0, "channel": 1, "guild": 81985242628096, "author": "alice",
+     "content": "!think why is the sky blue", "mention": true, "images": 0, "reply_to": null}
+
+`t` is seconds since the start of the trace, `guild` is the channel's guild ID, `mention` says
+whether the message pings the bot,
+`images` is the number of image attachments and `reply_to` is the 0-based line index of the
+message it replies to (`index` overrides a line's own index when a trace is filtered). Only `t`,
+`channel`, `author` and `content` are required.
+
+Results for the same trace, seed and options are comparable between commits: `--out` writes them
+as JSON and `--compare` prints the difference against an earlier run and exits non-zero if a
+mode's p95 regressed by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeAttachment, FakeChannel, FakeGenaiClient, FakeMessage, FakeUser  # noqa: E402
+
+BOT_USER_ID = 1000
+ADMIN_ID = 1
+MODES = ("normal", "think", "search", "image", "speak")
+SYNTHETIC_MIX = {"normal": 0.55, "think": 0.15, "search": 0.1, "image": 0.1, "speak": 0.1}
+VOCAB = (
+    "lol omg muffin wait what why how cat meme game tonight pizza send help bro fr ngl "
+    "the a is it was that this and but so who knows maybe never again cursed based real"
+).split()
+
+
+def mode_of(content):
+    if "!image" in content:
+        return "image"
+    if "!speak" in content:
+        return "speak"
+    if "!search" in content:
+        return "search"
+    if "!think" in content:
+        return "think"
+    return "normal"
+
+
+def synthetic_trace(count, seed, channels=4, users=12, rate=2.0, mention_share=0.3, guilds=4):
+    """Poisson arrivals across `channels`, with a share of messages pinging the bot in mixed modes."""
+    rng = random.Random(seed)
+    guild_ids = [rng.getrandbits(60) for _ in range(guilds)]
+    flags = {"normal": "", "think": "!think ", "search": "!search ", "image": "!image ", "speak": "!speak "}
+    events = []
+    t = 0.0
+    for i in range(count):
+        t += rng.expovariate(rate)
+        mention = rng.random() < mention_share
+        mode = rng.choices(list(SYNTHETIC_MIX), weights=list(SYNTHETIC_MIX.values()))[0] if mention else "normal"
+        words = " ".join(rng.choice(VOCAB) for _ in range(rng.randint(3, 40)))
+        channel = rng.randrange(channels) + 1
+        events.append({
+            "t": round(t, 3),
+            "channel": channel,
+            "guild": guild_ids[channel % guilds],
+            "author": f"user{rng.randrange(users)}",
+            "content": (flags[mode] if mention else "") + words,
+            "mention": mention,
+            "images": 1 if rng.random() < 0.05 else 0,
+            "reply_to": rng.randrange(i) if i and rng.random() < 0.2 else None,
+        })
+    return events
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def import_bot():
+    os.environ.setdefault("DISCORD_TOKEN", "bench")
+    os.environ["GEMINI_API_KEY"] = "bench"
+    os.environ.setdefault("ADMIN_USER_ID", str(ADMIN_ID))
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.setdefault("STATE_DB_PATH", ":memory:")
+    os.environ.setdefault("MESSAGE_STORE_PATH", ":memory:")
+    import bot
+    return bot
+
+
+async def replay(events, args, on_event=None):
+    """Replay `events` through the bot. `on_event(index)`, if given, is called before each one."""
+    bot = import_bot()
+    fake = FakeGenaiClient(seed=args.seed, time_scale=args.time_scale)
+    bot.gemini.client = fake
+    bot.context_cache.backend.client = fake
+    bot_user = FakeUser(BOT_USER_ID, "MuffinBot", bot=True)
+    bot.bot._connection.user = bot_user
+
+    async def dispatch(event, payload):
+        await getattr(bot, event)(payload)
+
+    rng = random.Random(args.seed)
+    users = {}
+    channels = {}
+    latencies = {mode: [] for mode in MODES}
+    failures = []
+
+    def channel_for(channel_id, guild_id):
+        channel = channels.get(channel_id)
+        if channel is None:
+            channel = channels[channel_id] = FakeChannel(
+                channel_id, bot_user, dispatch, args.api_latency * args.time_scale, guild_id
+            )
+            # Older chatter that the bot has to backfill through channel.history().
+            for _ in range(args.preload):
+                author = user_for(f"user{rng.randrange(12)}")
+                words = " ".join(rng.choice(VOCAB) for _ in range(rng.randint(3, 40)))
+                channel.add(FakeMessage(channel, author, words))
+        return channel
+
+    def user_for(name):
+        if name not in users:
+            users[name] = FakeUser(ADMIN_ID if name == "admin" else 2000 + len(users), name)
+        return users[name]
+
+    handler = bot.coalescer.handler
+
+    async def timed_handler(channel, items):
+        try:
+            await handler(channel, items)
+        finally:
+            now = time.perf_counter()
+            for item in items:
+                mode = "search" if item["search"] else "think" if item["thinking"] else "normal"
+                latencies[mode].append(now - item["received"])
+
+    bot.coalescer.handler = timed_handler
+
+    # Requests turned away by admission control get a quick refusal, not an answer: count them
+    # apart so they do not pull the image and speak latencies down.
+    rejected = {mode: 0 for mode in MODES}
+    rejected_here = contextvars.ContextVar("rejected_here", default=None)
+    admit = bot.admission.admit
+
+    def counting_admit(user_id, guild_id):
+        limited = admit(user_id, guild_id)
+        flag = rejected_here.get()
+        if limited is not None and flag is not None:
+            flag.append(limited)
+        return limited
+
+    bot.admission.admit = counting_admit
+
+    async def deliver(message, mode, mention, timed):
+        flag = []
+        rejected_here.set(flag)
+        start = time.perf_counter()
+        try:
+            await bot.on_message(message)
+        except Exception as e:
+            failures.append(f"{mode}: {e!r}")
+            return
+        if flag:
+            if mention:
+                rejected[mode] += 1
+            return
+        if timed:
+            latencies[mode].append(time.perf_counter() - start)
+
+    sent = {}
+    tasks = []
+    wall_start = time.perf_counter()
+    for idx, event in enumerate(events):
+        delay = wall_start + event["t"] / args.speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if on_event is not None:
+            on_event(idx)
+        channel = channel_for(event["channel"], event.get("guild"))
+        mention = event.get("mention", False)
+        content = event["content"]
+        attachments = [
+            FakeAttachment(rng.getrandbits(48), rng.randbytes(args.image_bytes), read_latency=0.05 * args.time_scale)
+            for _ in range(event.get("images", 0))
+        ]
+        reference = None
+        target = sent.get(event.get("reply_to"))
+        if target is not None:
+            reference = SimpleNamespace(message_id=target.id, resolved=target)
+        message = FakeMessage(
+            channel,
+            user_for(event["author"]),
+            f"<@{BOT_USER_ID}> {content}" if mention else content,
+            attachments=attachments,
+            mentions=[bot_user] if mention else [],
+            reference=reference,
+        )
+        channel.add(message)
+        sent[event.get("index", idx)] = message
+        mode = mode_of(content)
+        tasks.append(asyncio.create_task(deliver(message, mode, mention, mention and mode in ("image", "speak"))))
+
+    await asyncio.gather(*tasks)
+    while bot.coalescer.tasks or bot.coalescer.pending:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - wall_start
+
+    background = list(bot.summaries.tasks.values())
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    api_calls = {}
+    for channel in channels.values():
+        for kind, n in channel.api_calls.items():
+            api_calls[kind] = api_calls.get(kind, 0) + n
+    model_calls = {}
+    for model, kind in fake.calls:
+        key = f"{model} {kind}"
+        model_calls[key] = model_calls.get(key, 0) + 1
+    answered = sum(len(v) for v in latencies.values())
+    return {
+        "modes": {
+            mode: {
+                "n": len(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "mean": sum(values) / len(values) if values else None,
+            }
+            for mode, values in latencies.items()
+        },
+        "answered": answered,
+        "rejected": rejected,
+        "messages": len(events),
+        "wall_seconds": wall,
+        "throughput_per_second": answered / wall if wall else None,
+        "gemini_calls": model_calls,
+        "discord_calls": api_calls,
+        "failures": failures,
+    }
+
+
+def print_report(result):
+    print(f"commit {result['commit']}  messages={result['messages']}  answered={result['answered']}  "
+          f"rejected={sum(result.get('rejected', {}).values())}  "
+          f"wall={result['wall_seconds']:.1f}s  throughput={result['throughput_per_second'] or 0:.2f}/s")
+    print(f"peak rss={result['peak_rss_mb']:.1f} MiB" + (
+        f"  peak traced={result['peak_traced_mb']:.1f} MiB" if result.get("peak_traced_mb") is not None else ""
+    ))
+    print(f"{'mode':<8}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'rejected':>10}")
+    rejected = result.get("rejected", {})
+    for mode, stats in result["modes"].items():
+        if stats["n"]:
+            print(f"{mode:<8}{stats['n']:>6}{stats['p50']:>9.2f}{stats['p95']:>9.2f}{stats['p99']:>9.2f}"
+                  f"{rejected.get(mode, 0):>10}")
+        elif rejected.get(mode):
+            print(f"{mode:<8}{0:>6}{'-':>9}{'-':>9}{'-':>9}{rejected[mode]:>10}")
+    print("gemini calls: " + ", ".join(f"{k}={v}" for k, v in sorted(result["gemini_calls"].items())))
+    print("discord calls: " + ", ".join(f"{k}={v}" for k, v in sorted(result["discord_calls"].items())))
+    if result["failures"]:
+        print(f"{len(result['failures'])} failure(s), first: {result['failures'][0]}")
+
+
+def compare(result, baseline, tolerance):
+    """Print per-mode deltas against `baseline` and return True if no p95 regressed past `tolerance`."""
+    if baseline.get("config") != result["config"]:
+        print("warning: baseline was recorded with different options; numbers may not be comparable")
+    ok = True
+    print(f"\nvs {baseline.get('commit')}")
+    print(f"{'mode':<8}{'p50':>16}{'p95':>16}{'p99':>16}")
+    for mode, stats in result["modes"].items():
+        old = baseline.get("modes", {}).get(mode)
+        if not stats["n"] or not old or not old.get("n"):
+            continue
+        cells = []
+        for q in ("p50", "p95", "p99"):
+            change = (stats[q] - old[q]) / old[q] if old[q] else 0.0
+            cells.append(f"{old[q]:.2f}->{stats[q]:.2f} {change:+.0%}")
+            if q == "p95" and change > tolerance:
+                ok = False
+        print(f"{mode:<8}" + "".join(f"{c:>16}" for c in cells))
+    old_rss = baseline.get("peak_rss_mb")
+    if old_rss:
+        print(f"peak rss {old_rss:.1f} -> {result['peak_rss_mb']:.1f} MiB")
+    return ok
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--trace", help="JSONL trace to replay")
+    source.add_argument("--synthetic", type=int, default=200, help="number of synthetic messages (default 200)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay the trace this many times faster")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiply fake model and API latencies")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="fake Discord REST latency in seconds")
+    parser.add_argument("--preload", type=int, default=50, help="older messages per channel to backfill")
+    parser.add_argument("--image-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log output")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report peak traced Python memory (slower)")
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p95 regression vs the baseline")
+    return parser
+
+
+def events_for(args):
+    return load_trace(args.trace) if args.trace else synthetic_trace(args.synthetic, args.seed)
+
+
+def run(args, events, on_event=None):
+    """Replay `events` and return the result dict, tagged with the commit, options and peak memory."""
+    if args.tracemalloc:
+        tracemalloc.start()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        result = asyncio.run(replay(events, args, on_event))
+    result["commit"] = git_commit()
+    result["config"] = {
+        "trace": os.path.basename(args.trace) if args.trace else f"synthetic:{args.synthetic}",
+        "seed": args.seed,
+        "speed": args.speed,
+        "time_scale": args.time_scale,
+        "api_latency": args.api_latency,
+        "preload": args.preload,
+        "image_bytes": args.image_bytes,
+    }
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20 if args.tracemalloc else None
+    return result
+
+
+def main():
+    args = build_parser().parse_args()
+    result = run(args, events_for(args))
+    print_report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import contextlib
 import datetime
 import discord
 from google import genai
@@ -7,8 +8,33 @@ from google.genai import types
 from dotenv import load_dotenv
 import re
 import json
+import hashlib
+import sqlite3
 from io import BytesIO
-import wave
+import time
+from history import HistoryCache
+from attachments import AttachmentCache
+from gemini import ModelPool
+from fallback import CircuitBreaker, FallbackEngine
+from coalesce import MentionCoalescer
+from dispatch import ReplyDispatcher
+from context_cache import ContextCache, GeminiCacheBackend
+from jsonstream import find_json, parse_partial, partial_replies, recover_replies
+from streaming import StreamedReply
+from tts import SpeechPipeline
+from metrics import Metrics
+from sent_index import SentMessageIndex, delete_messages
+from message_store import MessageStore
+from admission import AdmissionControl, FairScheduler, LocalRateLimiter
+from images import EXTENSIONS, ImageGenerator, image_size
+from result_cache import ResultCache
+from thinking import ThinkingPolicy
+from cancellation import RequestContext, RequestRegistry, dropped, mark_posted
+from threads import STOPWORDS, ThreadTracker
+from shared_state import SharedRateLimiter, SharedStore
+from context_budget import (
+    RollingSummary, estimate_content_tokens, estimate_tokens, split_to_budget, truncate_to_tokens,
+)
 
 load_dotenv()
 
@@ -22,7 +48,88 @@ GEMINI_IMAGE_MODEL = 'gemini-2.0-flash-preview-image-generation'
 GEMINI_TTS_MODEL = 'gemini-2.5-flash-preview-tts'
 VOICE_NAME = 'Leda'
 
+# Max concurrent in-flight requests and per-call timeout (seconds) for each model.
+MODEL_CONCURRENCY = {
+    GEMINI_PRO_MODEL: 4,
+    GEMINI_FLASH_MODEL: 8,
+    GEMINI_LITE_MODEL: 16,
+    GEMINI_IMAGE_MODEL: 2,
+    GEMINI_TTS_MODEL: 4,
+}
+MODEL_TIMEOUTS = {
+    GEMINI_PRO_MODEL: 120,
+    GEMINI_FLASH_MODEL: 60,
+    GEMINI_LITE_MODEL: 30,
+    GEMINI_IMAGE_MODEL: 120,
+    GEMINI_TTS_MODEL: 90,
+}
+# Per-attempt deadlines inside a fallback chain, and how long to wait on a model before
+# hedging with the next one in the chain. Leave a model out of HEDGE_AFTER_SECONDS to disable hedging.
+FALLBACK_DEADLINES = {
+    GEMINI_PRO_MODEL: 90,
+    GEMINI_FLASH_MODEL: 45,
+    GEMINI_LITE_MODEL: 20,
+}
+HEDGE_AFTER_SECONDS = {
+    GEMINI_PRO_MODEL: 45,
+}
+# Calls slower than this count as failures in the model's circuit breaker, so a model that has
+# become sluggish is skipped like one that errors. Leave a model out to ignore its latency.
+BREAKER_SLOW_SECONDS = {
+    GEMINI_PRO_MODEL: 75,
+    GEMINI_FLASH_MODEL: 30,
+    GEMINI_LITE_MODEL: 15,
+}
+# Local Prometheus endpoint; set METRICS_PORT=0 to disable.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# Cached Pro prompt prefixes per channel. Gemini rejects caches below a minimum token count.
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_MIN_TOKENS = 4096
+# Local SQLite file for state that must survive restarts (e.g. the IDs of messages the bot sent).
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'muffinbot.sqlite3')
+PURGE_PROGRESS_INTERVAL = 2
+# Sharding: SHARD_COUNT=auto runs every shard Discord recommends in this process; a number plus
+# SHARD_IDS (e.g. "0,2") runs just those shards, as sharding.py does for each worker process.
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()]
+WORKER_ID = os.getenv('WORKER_ID', 'main')
+HEARTBEAT_INTERVAL = 15
+# Project-wide Gemini requests per minute (shared by all workers through STATE_DB_PATH when sharded).
+# Match these to the API tier; models left out are not rate limited.
+MODEL_REQUESTS_PER_MINUTE = {
+    GEMINI_PRO_MODEL: 150,
+    GEMINI_FLASH_MODEL: 1000,
+    GEMINI_LITE_MODEL: 4000,
+}
+# Attachments and synthesized audio are also kept in STATE_DB_PATH, for other workers and restarts.
+SHARED_CACHE_BYTES = 512 * 1024 * 1024
+# Local copy of every message the bot sees. History windows are filled from it after a restart,
+# and it is searched for older messages that match a mention.
+MESSAGE_STORE_PATH = os.getenv('MESSAGE_STORE_PATH', 'muffinbot-messages.sqlite3')
+MESSAGE_RETENTION_DAYS = 30
+RECALL_RESULTS = 5
+# Recalled messages must share this many distinct words (besides stopwords and names) with the mentions.
+RECALL_MIN_OVERLAP = 2
+
 client = genai.Client(api_key=GEMINI_API_KEY)
+metrics = Metrics()
+metrics_server = None
+heartbeat_task = None
+shared = SharedStore(STATE_DB_PATH, SHARED_CACHE_BYTES)
+# Workers started by sharding.py (which sets SHARD_IDS) draw from one request budget in
+# STATE_DB_PATH; a single process keeps its budget in memory and skips the SQLite round trip.
+if SHARD_IDS:
+    rate_limiter = SharedRateLimiter(shared, MODEL_REQUESTS_PER_MINUTE)
+else:
+    rate_limiter = LocalRateLimiter(MODEL_REQUESTS_PER_MINUTE)
+gemini = ModelPool(client, MODEL_CONCURRENCY, MODEL_TIMEOUTS, metrics=metrics, rate_limiter=rate_limiter)
+fallback = FallbackEngine(
+    gemini, FALLBACK_DEADLINES, HEDGE_AFTER_SECONDS,
+    breaker_factory=lambda model: CircuitBreaker(slow_seconds=BREAKER_SLOW_SECONDS.get(model)), metrics=metrics,
+)
+context_cache = ContextCache(GeminiCacheBackend(client), CONTEXT_CACHE_TTL, CONTEXT_CACHE_MIN_TOKENS)
+sent_index = SentMessageIndex(STATE_DB_PATH)
 
 def log_token_usage(response):
     usage = getattr(response, "usage_metadata", None)
@@ -33,45 +140,139 @@ def log_token_usage(response):
         )
 
 def extract_json(text):
-    """Extract JSON object from a string."""
-    text = text.strip()
+    """Extract a JSON object or array from a string, skipping code fences and surrounding prose."""
+    text = (text or "").strip()
     try:
         return json.loads(text)
     except json.JSONDecodeError:
-        match = re.search(r"\{.*\}", text, re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(0))
-            except json.JSONDecodeError:
-                pass
-    return None
+        return find_json(text)
+
+def count_parse(label, outcome):
+    metrics.inc("json_parse_total", label=label, outcome=outcome)
+    if outcome != "ok":
+        print(f"{label} JSON {outcome}")
 
-DEFAULT_BUDGET = 16384
+# Thinking budgets per kind of call, before ThinkingPolicy scales them down for small inputs and
+# for modes running over their latency SLO (p95 seconds). None leaves it to the model's default.
+# Limits are (min, max) per model: Pro cannot turn thinking off, Lite does not think here.
+THINKING_BUDGETS = {
+    "decision": 1024,
+    "normal": None,
+    "think": 16384,
+    "search": 8192,
+    "speak": 4096,
+}
+THINKING_LIMITS = {
+    GEMINI_PRO_MODEL: (128, 32768),
+    GEMINI_FLASH_MODEL: (0, 24576),
+    GEMINI_LITE_MODEL: (0, 0),
+}
+LATENCY_SLO_SECONDS = {
+    "decision": 3,
+    "normal": 10,
+    "think": 30,
+    "search": 30,
+    "speak": 20,
+}
+# Optional JSON-lines log of every budget choice and observed latency, for tuning the above.
+THINKING_LOG_PATH = os.getenv('THINKING_LOG_PATH') or None
 CONTEXT_HOURS = 24
 MAX_CONTEXT_IMAGES = 3
+HISTORY_LIMIT = 100
+ATTACHMENT_CACHE_BYTES = 64 * 1024 * 1024
+ATTACHMENT_CONCURRENCY = 4
+# Prompt size limits (estimated tokens). Older history that does not fit is folded into a
+# rolling per-channel summary instead of being dropped.
+CONTEXT_TOKEN_BUDGET = 24000
+PAIRS_TOKEN_BUDGET = 12000
+MAX_MESSAGE_TOKENS = 2000
+SUMMARY_MAX_TOKENS = 1500
+MENTION_DEBOUNCE_SECONDS = 1.5
+# Post replies while the Pro call is still streaming, editing each message at most this often.
+STREAM_REPLIES = True
+STREAM_EDIT_INTERVAL = 1.5
+# Synthesized speech is cached in memory; long text is synthesized in sentence-aligned pieces in parallel.
+TTS_CACHE_BYTES = 128 * 1024 * 1024
+TTS_CHUNK_CHARS = 600
+MENTION_MAX_WAIT_SECONDS = 4
+# Replies to different messages are posted concurrently, up to this many at a time.
+REPLY_SEND_CONCURRENCY = 4
+# Each reply request gets only its conversation thread plus the channel's last few messages, and
+# replies in different threads are generated in parallel. Set THREAD_CONTEXT = False to always
+# send the whole window.
+THREAD_CONTEXT = True
+THREAD_SHARED_TAIL = 6
+THREAD_ADJACENCY_SECONDS = 120
+THREAD_ACTIVE_SECONDS = 3600
+THREAD_MIN_SIMILARITY = 1.0
+THREAD_GROUP_BUCKETS = (1, 2, 3, 4, 6, 8)
+# Admission control: requests per minute (and burst) allowed per user and per guild, with the
+# admin exempt; pipelines running at once, shared fairly between channels (CHANNEL_WEIGHTS
+# gives a channel ID a bigger share); and when to shed load by skipping Pro and thinking
+# (level 1) or answering with Lite only (level 2, at twice either threshold).
+USER_REQUESTS_PER_MINUTE = 6
+USER_REQUEST_BURST = 4
+GUILD_REQUESTS_PER_MINUTE = 60
+GUILD_REQUEST_BURST = 20
+MAX_PIPELINES = 8
+CHANNEL_WEIGHTS = {}
+SHED_QUEUE_DEPTH = 8
+# Shed once a mode's p95 pipeline time (from its scheduler slot to its last reply) passes this.
+SHED_P95_SECONDS = {"normal": 20, "think": 60, "search": 60, "image": 60, "speak": 40}
+# End-to-end deadline per request, from the mention to the last reply, by mode. Requests are
+# also cancelled when their trigger message is deleted or edited, or when its author mentions
+# the bot again in the channel before anything was posted.
+REQUEST_DEADLINE_SECONDS = {"normal": 120, "think": 240, "search": 240, "image": 180, "speak": 180}
+# Mentions of a cancelled reply pipeline that were not themselves withdrawn go to the next batch.
+REQUEUE_REASONS = ("deleted", "edited", "superseded")
+# Relative cost of one request in each mode, for fair queueing.
+PIPELINE_COSTS = {"normal": 1, "think": 2, "search": 2, "image": 3, "speak": 2}
+# !image results are cached by (prompt, input image), re-encoded to fit IMAGE_TARGET_BYTES, and
+# each user gets IMAGE_PER_USER generations at a time.
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+IMAGE_CACHE_TTL = 3600
+IMAGE_TARGET_BYTES = 1024 * 1024
+IMAGE_OUTPUT_FORMAT = 'WEBP'
+IMAGE_PER_USER = 1
+# !search answers are cached by (normalized question, guild, message replied to). The admin can
+# add !nocache to a request to skip the caches.
+SEARCH_CACHE_BYTES = 4 * 1024 * 1024
+SEARCH_CACHE_TTL = 3600
+SEARCH_WORD_RE = re.compile(r'\w+')
+# Matches up to the last sentence end or newline, where split_long_message breaks a reply.
+LAST_SENTENCE_END_RE = re.compile(r'.*(?:[.!?]\s|\n)', re.DOTALL)
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = discord.Client(intents=intents)
+if SHARD_COUNT == 'auto':
+    bot = discord.AutoShardedClient(intents=intents)
+elif SHARD_COUNT:
+    bot = discord.AutoShardedClient(intents=intents, shard_count=int(SHARD_COUNT), shard_ids=SHARD_IDS or None)
+else:
+    bot = discord.Client(intents=intents)
+attachment_cache = AttachmentCache(
+    ATTACHMENT_CACHE_BYTES, ATTACHMENT_CONCURRENCY, shared=shared, shared_ttl=CONTEXT_HOURS * 3600
+)
 
 def split_long_message(text, max_len=2000):
-    sentences = re.split(r'([.!?]\s|\n)', text)
+    """Split `text` into Discord-sized chunks, each ending at the last sentence end or newline that fits.
+
+    A sentence longer than `max_len` is cut at `max_len` characters.
+    """
+    if len(text) <= max_len:
+        return [text] if text else []
     result = []
-    current = ''
-    for i in range(0, len(sentences), 2):
-        sentence = sentences[i]
-        sep = sentences[i+1] if i+1 < len(sentences) else ''
-        piece = sentence + sep
-        if len(current) + len(piece) > max_len:
-            if current:
-                result.append(current)
-                current = ''
-            while len(piece) > max_len:
-                result.append(piece[:max_len])
-                piece = piece[max_len:]
-        current += piece
-    if current:
-        result.append(current)
+    start = 0
+    while len(text) - start > max_len:
+        # Start one character back to catch a ". " that straddles the previous cut.
+        lo, hi = max(start - 1, 0), start + max_len
+        m = None
+        if any(text.find(c, lo, hi) != -1 for c in ".!?\n"):
+            m = LAST_SENTENCE_END_RE.match(text, lo, hi)
+        end = m.end() if m and m.end() > start else hi
+        result.append(text[start:end])
+        start = end
+    result.append(text[start:])
     return result
 
 async def send_long_message(channel, text):
@@ -79,105 +280,227 @@ async def send_long_message(channel, text):
         await channel.send(chunk)
 
 async def download_attachment(attachment):
-    return await attachment.read()
+    """Return (bytes, mime_type) for an image attachment, served from the attachment cache."""
+    return await attachment_cache.fetch(attachment)
 
 def strip_bot_name(text, bot_name):
     bot_name = bot_name.lower()
     text = text.lstrip()
-    if text.lower().startswith(bot_name + ":"):
+    # isascii() is a flag check. ASCII text lowercases character by character, so only its start
+    # needs looking at; anything else takes the full lower() (final sigma, expanding characters).
+    if text.isascii():
+        matched = text[:len(bot_name)+1].lower() == bot_name + ":"
+    else:
+        matched = text.lower().startswith(bot_name + ":")
+    if matched:
         return text[len(bot_name)+1:].lstrip()
     return text
 
-async def collect_context(channel, current_message, bot_user):
-    after_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=CONTEXT_HOURS)
-    messages = []
-    async for msg in channel.history(limit=100, after=after_time, oldest_first=True):
-        if msg.id == current_message.id or not msg.clean_content:
-            continue
-        messages.append(msg)
+def message_tokens(msg):
+    return min(estimate_tokens(msg.clean_content), MAX_MESSAGE_TOKENS)
+
+async def summarize_history(previous, lines):
+    """Fold older chat lines into the running channel summary with the Lite model."""
+    prompt = ""
+    if previous:
+        prompt += f"Current summary:\n{previous}\n\n"
+    prompt += "New messages:\n" + "\n".join(lines)
+    response = await gemini.generate(
+        model=GEMINI_LITE_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            system_instruction=SUMMARY_SYSTEM_PROMPT,
+            thinking_config=types.ThinkingConfig(thinking_budget=0),
+        ),
+    )
+    log_token_usage(response)
+    return truncate_to_tokens(response.text.strip(), SUMMARY_MAX_TOKENS)
+
+def fold_evicted(msgs):
+    summaries.fold(msgs[0].channel.id, msgs)
+
+async def fetch_from_cdn(url):
+    return await bot.http.get_from_cdn(url)
+
+message_store = MessageStore(MESSAGE_STORE_PATH, fetch=fetch_from_cdn)
+history = HistoryCache(CONTEXT_HOURS, HISTORY_LIMIT, on_evict=fold_evicted, store=message_store)
+summaries = RollingSummary(summarize_history)
+thinking_policy = ThinkingPolicy(
+    THINKING_BUDGETS, THINKING_LIMITS, LATENCY_SLO_SECONDS, metrics=metrics, log_path=THINKING_LOG_PATH
+)
+admission = AdmissionControl(
+    USER_REQUESTS_PER_MINUTE, USER_REQUEST_BURST, GUILD_REQUESTS_PER_MINUTE, GUILD_REQUEST_BURST,
+    exempt={ADMIN_USER_ID}, metrics=metrics,
+)
+scheduler = FairScheduler(MAX_PIPELINES, CHANNEL_WEIGHTS, SHED_QUEUE_DEPTH, SHED_P95_SECONDS, metrics=metrics)
+image_cache = ResultCache("image", IMAGE_CACHE_BYTES, IMAGE_CACHE_TTL, sizeof=image_size, metrics=metrics)
+search_cache = ResultCache(
+    "search", SEARCH_CACHE_BYTES, SEARCH_CACHE_TTL, sizeof=lambda texts: sum(len(t) for t in texts), metrics=metrics
+)
+requests = RequestRegistry(metrics=metrics)
+threads = ThreadTracker(
+    HISTORY_LIMIT * 5, THREAD_ADJACENCY_SECONDS, THREAD_ACTIVE_SECONDS, THREAD_MIN_SIMILARITY, metrics=metrics
+)
+
+async def collect_context(snapshot, exclude_ids, bot_user):
+    messages = [msg for msg in snapshot if msg.id not in exclude_ids and msg.clean_content]
+    channel_id = snapshot[0].channel.id if snapshot else None
+    older, messages = split_to_budget(messages, message_tokens, CONTEXT_TOKEN_BUDGET)
+    if older:
+        summaries.fold(channel_id, older)
 
-    context_messages = [None] * len(messages)
-    images_used = 0
+    # Pick the newest images first, then download whatever is not cached yet in parallel.
+    wanted = []
+    for msg in reversed(messages):
+        for attachment in msg.attachments:
+            if len(wanted) >= MAX_CONTEXT_IMAGES:
+                break
+            if attachment.content_type and attachment.content_type.startswith("image/"):
+                wanted.append(attachment)
+        if len(wanted) >= MAX_CONTEXT_IMAGES:
+            break
+    with metrics.timer("stage_seconds", stage="attachments"):
+        images = dict(zip((a.id for a in wanted), await attachment_cache.fetch_many(wanted)))
 
-    for idx, msg in enumerate(reversed(messages)):
+    context_messages = []
+    for msg in messages:
         role = "model" if msg.author == bot_user else "user"
-        parts = []
-        if msg.clean_content:
-            parts.append({"text": msg.clean_content})
-        if images_used < MAX_CONTEXT_IMAGES:
-            for attachment in msg.attachments:
-                if attachment.content_type and attachment.content_type.startswith("image/"):
-                    if images_used >= MAX_CONTEXT_IMAGES:
-                        break
-                    image_bytes = await download_attachment(attachment)
-                    parts.append(types.Part.from_bytes(data=image_bytes, mime_type=attachment.content_type))
-                    images_used += 1
-        context_messages[len(messages) - 1 - idx] = {"role": role, "parts": parts}
-
-    return [msg for msg in context_messages if msg]  # In chronological order
-
-async def collect_context_pairs(channel, current_message):
-    after_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=CONTEXT_HOURS)
+        parts = [{"text": truncate_to_tokens(msg.clean_content, MAX_MESSAGE_TOKENS)}]
+        for attachment in msg.attachments:
+            image = images.get(attachment.id)
+            if image:
+                image_bytes, mime_type = image
+                parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+        context_messages.append({"role": role, "parts": parts})
+    # The summary changes whenever older history is folded in, so it goes after the messages,
+    # where it is part of the uncached tail instead of moving the start of the cached prefix.
+    summary = summaries.get(channel_id)
+    if summary:
+        context_messages.append({"role": "user", "parts": [{"text": f"Summary of earlier conversation:\n{summary}"}]})
+
+    return context_messages  # In chronological order, then the summary
+
+def recall_context(channel, snapshot, msgs):
+    """Context entry with stored messages from before the history window that match `msgs`, or None."""
+    if not snapshot or not msgs:
+        return None
+    # Names would match every old message by the same people, and the bot's name every mention.
+    names = {msg.author.display_name for msg in msgs} | {msg.author.name for msg in msgs} | {bot.user.display_name}
+    ignore = STOPWORDS | {w for name in names for w in re.findall(r"\w+", name.lower())}
+    try:
+        recalled = message_store.search(
+            channel, " ".join(msg.clean_content for msg in msgs), before_id=snapshot[0].id, limit=RECALL_RESULTS,
+            ignore=ignore, min_overlap=RECALL_MIN_OVERLAP,
+        )
+    except sqlite3.Error as e:
+        print(f"Message store search failed: {e}")
+        return None
+    if not recalled:
+        return None
+    lines = "\n".join(
+        f"{m.author.display_name}: {truncate_to_tokens(m.clean_content, MAX_MESSAGE_TOKENS)}" for m in recalled
+    )
+    return {"role": "user", "parts": [{"text": f"Possibly relevant messages from before this chat log:\n{lines}"}]}
+
+def make_pair(msg, text, bot_user):
+    """Decision-log entry for a message, with the metadata the local fast-path looks at."""
+    reply_to = msg.reference.resolved if msg.reference else None
+    return {
+        "id": msg.id,
+        "text": f"{msg.author.display_name}: {truncate_to_tokens(text, MAX_MESSAGE_TOKENS)}",
+        "author_id": msg.author.id,
+        "from_bot": msg.author == bot_user,
+        # `resolved` may be a DeletedReferencedMessage, which has no author.
+        "addresses_bot": bot_user.mentioned_in(msg) or getattr(reply_to, "author", None) == bot_user,
+    }
+
+async def collect_context_pairs(snapshot, exclude_ids, bot_user):
     pairs = []
-    async for msg in channel.history(limit=100, after=after_time, oldest_first=True):
-        if msg.id == current_message.id or not msg.clean_content:
+    for msg in snapshot:
+        if msg.id in exclude_ids or not msg.clean_content:
             continue
-        entry = {
-            "id": msg.id,
-            "text": f"{msg.author.display_name}: {msg.clean_content}"
-        }
-        pairs.append(entry)
+        pairs.append(make_pair(msg, msg.clean_content, bot_user))
+    _, pairs = split_to_budget(pairs, lambda p: estimate_tokens(p["text"]), PAIRS_TOKEN_BUDGET)
     return pairs
 
-async def decide_reply_ids(pairs):
-    """Return a list of message IDs to reply to, ensuring the newest message is included."""
+def local_reply_ids(pairs, required_ids):
+    """Answer the reply-selection question without a model call when it is obvious.
+
+    Looks at the messages since the bot last spoke. If nobody other than the people who just
+    pinged the bot has addressed it (by mention or by replying to it) in that window, the answer
+    is just the required IDs. Returns None when the window is ambiguous.
+    """
+    since_bot = []
+    for pair in reversed(pairs):
+        if pair.get("from_bot"):
+            break
+        since_bot.append(pair)
+    required = set(required_ids)
+    askers = {p.get("author_id") for p in since_bot if p["id"] in required}
+    for pair in since_bot:
+        if pair["id"] in required or pair.get("author_id") in askers:
+            continue
+        if pair.get("addresses_bot"):
+            return None
+    return list(required_ids)
+
+async def decide_reply_ids(pairs, required_ids=None):
+    """Return a list of message IDs to reply to, ensuring the required (default: newest) messages are included."""
     if not pairs:
         return []
+    if required_ids is None:
+        required_ids = [pairs[-1]["id"]]
+    selected_ids = local_reply_ids(pairs, required_ids)
+    metrics.inc("reply_decisions_total", path="fast" if selected_ids is not None else "model")
+    if selected_ids is not None:
+        return selected_ids
     log_lines = [f"[{p['id']}] {p['text']}" for p in pairs]
     decision_prompt = "\n".join(log_lines)
-    try:
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=GEMINI_FLASH_MODEL,
-            contents=decision_prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=ASSISTANT_SYSTEM_PROMPT,
-                thinking_config=types.ThinkingConfig(thinking_budget=DEFAULT_BUDGET),
-            ),
-        )
+
+    def parse_ids(response):
         log_token_usage(response)
         ids = extract_json(response.text)
-        if isinstance(ids, list):
-            selected_ids = [int(i) for i in ids]
-        else:
-            selected_ids = []
-    except Exception as e:
-        print(f"FLASH decision failed: {e}")
-        try:
-            response = await asyncio.to_thread(
-                client.models.generate_content,
-                model=GEMINI_LITE_MODEL,
-                contents=decision_prompt,
-                config=types.GenerateContentConfig(
-                    system_instruction=ASSISTANT_SYSTEM_PROMPT,
-                ),
-            )
-            log_token_usage(response)
-            ids = extract_json(response.text)
-            if isinstance(ids, list):
-                selected_ids = [int(i) for i in ids]
-            else:
-                selected_ids = []
-        except Exception as e2:
-            print(f"LITE decision failed: {e2}")
-    final_id = pairs[-1]["id"]
-    if final_id not in selected_ids:
-        selected_ids.append(final_id)
+        outcome = "ok"
+        if not isinstance(ids, list):
+            ids, _ = parse_partial(response.text or "")
+            outcome = "recovered"
+        # An empty list is a valid answer: nothing to reply to beyond the required IDs.
+        if not isinstance(ids, list):
+            count_parse("decision", "failed")
+            return None
+        count_parse("decision", outcome)
+        return [int(i) for i in ids]
+
+    budget = thinking_policy.choose(GEMINI_FLASH_MODEL, "decision", estimate_tokens(decision_prompt))
+    attempts = [
+        (GEMINI_FLASH_MODEL, "", types.GenerateContentConfig(
+            system_instruction=ASSISTANT_SYSTEM_PROMPT,
+            thinking_config=types.ThinkingConfig(thinking_budget=budget),
+            response_mime_type="application/json",
+            response_schema=REPLY_IDS_SCHEMA,
+        )),
+        (GEMINI_LITE_MODEL, "", types.GenerateContentConfig(
+            system_instruction=ASSISTANT_SYSTEM_PROMPT,
+            response_mime_type="application/json",
+            response_schema=REPLY_IDS_SCHEMA,
+        )),
+    ]
+    start = time.perf_counter()
+    selected_ids, _ = await fallback.run("decision", decision_prompt, attempts, parse_ids)
+    thinking_policy.observe("decision", time.perf_counter() - start)
+    if selected_ids is None:
+        selected_ids = []
+    for required_id in required_ids:
+        if required_id not in selected_ids:
+            selected_ids.append(required_id)
     return selected_ids
 
-async def generate_replies(context_messages, ids, pairs, used_tools, thinking, image_mode):
-    if not ids:
-        return []
+def build_reply_request(context_messages, ids, pairs, used_tools, thinking, image_mode, cache_key=None, shed=0):
+    """Return (gemini_input, attempts) for the Pro/Flash/Lite reply chain, minus its first `shed` models.
+
+    Each model's thinking budget comes from thinking_policy, by mode and by the size of the
+    messages to answer and of the context.
+    """
     id_list = ", ".join(str(i) for i in ids)
     selected_lines = [f"[{p['id']}] {p['text']}" for p in pairs if p['id'] in ids]
     messages_block = "\n".join(selected_lines)
@@ -187,69 +510,224 @@ async def generate_replies(context_messages, ids, pairs, used_tools, thinking, i
         "Respond in MuffinBot style to each of the above messages. "
         "Return your result as JSON in the format {'responses': [{'id': ID, 'reply': 'text'}]}"
     )
-    gemini_input = context_messages.copy()
-    gemini_input.append({
+    instruction_message = {
         "role": "user",
         "parts": [{"text": instruction}],
-    })
-    config = types.GenerateContentConfig(
-        system_instruction=BOT_SYSTEM_PROMPT,
-        tools=used_tools,
-        thinking_config=types.ThinkingConfig(thinking_budget=DEFAULT_BUDGET) if (thinking and not image_mode) else None,
-    )
-    models = [
-        (GEMINI_PRO_MODEL, ""),
-        (GEMINI_FLASH_MODEL, "[FLASH] "),
-        (GEMINI_LITE_MODEL, "[LITE] "),
-    ]
-    for model_name, prefix in models:
-        try:
-            alt_config = config
-            if model_name == GEMINI_LITE_MODEL and config.thinking_config:
-                alt_config = types.GenerateContentConfig(
-                    system_instruction=BOT_SYSTEM_PROMPT,
-                    tools=used_tools,
-                    thinking_config=types.ThinkingConfig(thinking_budget=0) if not image_mode else None,
-                )
-            response = await asyncio.to_thread(
-                client.models.generate_content,
-                model=model_name,
-                contents=gemini_input,
-                config=alt_config,
+    }
+    gemini_input = context_messages.copy()
+    gemini_input.append(instruction_message)
+    # Gemini cannot combine a response schema with tool use, so !search relies on extract_json.
+    schema = {} if used_tools else {"response_mime_type": "application/json", "response_schema": REPLIES_SCHEMA}
+    mode = "search" if used_tools else "think" if thinking else "normal"
+    prompt_tokens = estimate_tokens(messages_block)
+    context_tokens = estimate_content_tokens(context_messages)
+
+    def config_for(model):
+        budget = None if image_mode else thinking_policy.choose(model, mode, prompt_tokens, context_tokens)
+        return types.GenerateContentConfig(
+            system_instruction=BOT_SYSTEM_PROMPT,
+            tools=used_tools,
+            thinking_config=types.ThinkingConfig(thinking_budget=budget) if budget is not None else None,
+            **schema,
+        )
+
+    chain = [(GEMINI_PRO_MODEL, ""), (GEMINI_FLASH_MODEL, "[FLASH] "), (GEMINI_LITE_MODEL, "[LITE] ")][shed:]
+    attempts = [(model, prefix, config_for(model)) for model, prefix in chain]
+    if attempts[0][0] == GEMINI_PRO_MODEL and cache_key is not None and not used_tools:
+        # Cached content carries the system instruction, so the request config must not repeat it.
+        cache_name, tail = context_cache.lookup(cache_key, GEMINI_PRO_MODEL, BOT_SYSTEM_PROMPT, context_messages)
+        if cache_name:
+            cached_config = types.GenerateContentConfig(
+                cached_content=cache_name,
+                thinking_config=attempts[0][2].thinking_config,
+                **schema,
             )
-            log_token_usage(response)
-            data = extract_json(response.text)
-            if isinstance(data, dict):
-                replies = data.get("responses", [])
-                if prefix:
-                    for item in replies:
-                        if "reply" in item:
-                            item["reply"] = prefix + item["reply"]
-                return replies
-        except Exception as e:
-            print(f"{model_name} reply failed: {e}")
-    return []
+            attempts[0] = (GEMINI_PRO_MODEL, "", cached_config, tail + [instruction_message])
+    return gemini_input, attempts
+
+async def generate_replies(context_messages, ids, pairs, used_tools, thinking, image_mode, cache_key=None, shed=0):
+    if not ids:
+        return []
+    gemini_input, attempts = build_reply_request(
+        context_messages, ids, pairs, used_tools, thinking, image_mode, cache_key, shed
+    )
+
+    def parse_replies(response):
+        log_token_usage(response)
+        data = extract_json(response.text)
+        if isinstance(data, dict):
+            count_parse("reply", "ok")
+            return data.get("responses", [])
+        recovered = recover_replies(response.text or "")
+        if recovered:
+            count_parse("reply", "recovered")
+            return recovered
+        count_parse("reply", "failed")
+        return None
+
+    replies, prefix = await fallback.run("reply", gemini_input, attempts, parse_replies)
+    if replies is None:
+        return []
+    if prefix:
+        for item in replies:
+            if "reply" in item:
+                item["reply"] = prefix + item["reply"]
+    return replies
 
 async def send_replies(channel, replies):
-    for item in replies:
-        text = item.get("reply")
-        msg_id = item.get("id")
-        if not text or not msg_id:
-            continue
-        ref = None
+    # Mentions withdrawn by their author asking again are answered by the newer request.
+    replies = [r for r in replies if not dropped(r.get("id"))]
+    if not replies:
+        return
+    mark_posted()
+    await dispatcher.send(channel, replies)
+
+async def stream_replies(channel, context_messages, ids, pairs, used_tools, thinking, cache_key=None, shed=0):
+    """Stream the Pro reply call into Discord, posting each reply as soon as its ID and first text
+    arrive and editing it as the rest comes in.
+
+    The stream gets the same deadline and hedge as the first attempt of generate_replies: if
+    nothing has been posted after HEDGE_AFTER_SECONDS, the rest of the chain is raced against it,
+    and replies the stream did not start fall back to that chain without retrying the model that
+    just failed. If the request is cancelled mid-stream, the partial replies are deleted."""
+    if not ids:
+        return
+    gemini_input, attempts = build_reply_request(
+        context_messages, ids, pairs, used_tools, thinking, False, cache_key, shed
+    )
+    # Under load shedding the first attempt is Flash or Lite, whose replies carry their marker.
+    model, prefix, config = attempts[0][:3]
+    contents = attempts[0][3] if len(attempts[0]) > 3 else gemini_input
+    breaker = fallback.breaker(model)
+    streams = {}
+    posted = asyncio.Event()
+
+    async def run_stream():
+        text = ""
+        last_chunk = None
+        ok = False
         try:
-            ref = await channel.fetch_message(int(msg_id))
+            async with asyncio.timeout(FALLBACK_DEADLINES.get(model)):
+                async with contextlib.aclosing(gemini.stream(model, contents, config)) as chunks:
+                    async for chunk in chunks:
+                        last_chunk = chunk
+                        if not chunk.text:
+                            continue
+                        text += chunk.text
+                        for reply_id, reply in partial_replies(text):
+                            if reply_id not in streams:
+                                if dropped(reply_id):
+                                    continue
+                                mark_posted()
+                                streams[reply_id] = StreamedReply(
+                                    channel, dispatcher.reference(channel, reply_id), split_long_message,
+                                    STREAM_EDIT_INTERVAL, dispatcher.retries, metrics,
+                                )
+                                posted.set()
+                            await streams[reply_id].update(prefix + reply)
+            if last_chunk is not None:
+                log_token_usage(last_chunk)
+            # A document cut off by MAX_TOKENS or a safety stop still parses as a dict; only a
+            # complete one means the IDs the stream never reached were left out on purpose.
+            data, complete = parse_partial(text)
+            ok = complete and isinstance(data, dict)
+        except asyncio.CancelledError:
+            # The request was withdrawn, ran out of time or lost to its hedge: take back the
+            # half-written replies.
+            for stream in streams.values():
+                await stream.discard()
+            raise
+        except TimeoutError:
+            print(f"{model} reply stream timed out")
         except Exception as e:
-            print(f"Could not fetch message {msg_id}: {e}")
-        for chunk in split_long_message(text):
-            await channel.send(chunk, reference=ref)
+            print(f"{model} reply stream failed: {e}")
+        for reply_id, reply in partial_replies(text):
+            if reply_id not in streams:
+                continue
+            try:
+                await streams[reply_id].update(prefix + reply, final=True)
+            except Exception as e:
+                print(f"Could not finish streamed reply {reply_id}: {e}")
+        return ok
+
+    ok = False
+    hedge = None
+    if breaker.allow():
+        breaker.begin()
+        start = time.monotonic()
+        task = asyncio.create_task(run_stream())
+        try:
+            delay = HEDGE_AFTER_SECONDS.get(model) if len(attempts) > 1 else None
+            await asyncio.wait({task}, timeout=delay)
+            if not task.done() and not streams:
+                # Nothing posted by the hedge delay: race the rest of the chain against the stream.
+                metrics.inc("fallback_hedges_total", label="reply", model=attempts[1][0])
+                hedge = asyncio.create_task(
+                    generate_replies(context_messages, ids, pairs, used_tools, thinking, False, shed=shed + 1)
+                )
+                first_post = asyncio.create_task(posted.wait())
+                try:
+                    await asyncio.wait({task, hedge, first_post}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    first_post.cancel()
+                if not streams and not task.done() and hedge.done() and hedge.result():
+                    # The hedge answered first; the stream was too slow and counts as such.
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    breaker.record(False, time.monotonic() - start)
+                    metrics.inc("fallback_attempt_failures_total", label="reply", model=model)
+                    await send_replies(channel, hedge.result())
+                    return
+                if streams:
+                    hedge.cancel()
+                    hedge = None
+            ok = await task
+        except asyncio.CancelledError:
+            pending = [task] if hedge is None else [task, hedge]
+            for pending_task in pending:
+                pending_task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            breaker.release()
+            raise
+        breaker.record(ok, time.monotonic() - start)
+    if hedge is not None:
+        if ok or streams:
+            hedge.cancel()
+        else:
+            # The stream failed without posting anything; the hedge is already its fallback.
+            replies = await hedge
+            if replies:
+                await send_replies(channel, replies)
+            return
+    if ok or len(attempts) < 2:
+        return
+    remaining = [i for i in ids if i not in streams and not dropped(i)]
+    replies = await generate_replies(context_messages, remaining, pairs, used_tools, thinking, False, shed=shed + 1)
+    if replies:
+        await send_replies(channel, replies)
 
-def wave_file(filename, pcm, channels=1, rate=24000, sample_width=2):
-    with wave.open(filename, "wb") as wf:
-        wf.setnchannels(channels)
-        wf.setsampwidth(sample_width)
-        wf.setframerate(rate)
-        wf.writeframes(pcm)
+REPLY_IDS_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(type=types.Type.INTEGER),
+)
+REPLIES_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "responses": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "id": types.Schema(type=types.Type.INTEGER),
+                    "reply": types.Schema(type=types.Type.STRING),
+                },
+                required=["id", "reply"],
+                property_ordering=["id", "reply"],
+            ),
+        ),
+    },
+    required=["responses"],
+)
 
 google_search_tool = types.Tool(google_search=types.GoogleSearch())
 url_context_tool = types.Tool(url_context=types.UrlContext())
@@ -328,13 +806,513 @@ Output:
 [124,125]
 """
 
+SUMMARY_SYSTEM_PROMPT = """
+You maintain a running summary of a Discord channel for MuffinBot.
+You will be given the current summary (if any) and a batch of older messages
+formatted as "username: text". Return an updated summary that keeps who said
+what, open questions, ongoing topics and anything MuffinBot promised or was
+asked to remember. Drop small talk. Use short bullet points, at most 300 words.
+Respond only with the summary.
+"""
+
+
+PURGE_WINDOW_RE = re.compile(r'^(\d+)\s*([mhd])$')
+PURGE_UNITS = {"m": ("minutes", "minute"), "h": ("hours", "hour"), "d": ("days", "day")}
+
+def parse_purge_window(text):
+    """Parse the argument of !purge ("", "30m", "6h", "7d" or "all") into (timedelta or None, label)."""
+    text = text.strip().lower()
+    if not text:
+        return datetime.timedelta(hours=CONTEXT_HOURS), f"the last {CONTEXT_HOURS} hours"
+    if text == "all":
+        return None, "all time"
+    match = PURGE_WINDOW_RE.match(text)
+    if not match:
+        raise ValueError(text)
+    amount = int(match.group(1))
+    plural, singular = PURGE_UNITS[match.group(2)]
+    return datetime.timedelta(**{plural: amount}), f"the last {amount} {singular if amount == 1 else plural}"
+
+async def purge_sent_messages(channel, window, label):
+    """Bulk-delete the bot's messages in `channel` from the last `window` (None for all time)."""
+    after = datetime.datetime.now(datetime.timezone.utc) - window if window else None
+    ids = sent_index.ids(channel.id, after)
+    covered = sent_index.covered_from(channel.id)
+    if covered is not None and (after is None or after < covered):
+        # The index is younger than the window; find the older bot messages the slow way, once.
+        found = [
+            msg.id
+            async for msg in channel.history(limit=None, after=after, before=covered, oldest_first=True)
+            if msg.author == bot.user
+        ]
+        sent_index.mark_covered(channel.id, after, found)
+        ids = sorted(set(ids).union(found))
+    if not ids:
+        await channel.send(f"No MuffinBot messages to purge from {label}.")
+        return
+    status = await channel.send(f"Purging {len(ids)} MuffinBot message(s)...")
+    last_update = time.monotonic()
+
+    async def progress(done, total):
+        nonlocal last_update
+        if done < total and time.monotonic() - last_update >= PURGE_PROGRESS_INTERVAL:
+            last_update = time.monotonic()
+            await status.edit(content=f"Purging... {done}/{total}")
+
+    deleted = await delete_messages(channel, ids, progress)
+    sent_index.remove(channel.id, deleted)
+    metrics.inc("purged_messages_total", len(deleted))
+    result = f"Purged {len(deleted)} MuffinBot message(s) from {label}."
+    if len(deleted) < len(ids):
+        result += f" {len(ids) - len(deleted)} could not be deleted."
+    await status.edit(content=result)
+
+async def heartbeat():
+    """Publish this worker's status to the shared store, for the supervisor and !stats."""
+    while True:
+        try:
+            shared.set("workers", WORKER_ID, {
+                "pid": os.getpid(),
+                "shards": sorted(bot.shards) if isinstance(bot, discord.AutoShardedClient) else [],
+                "guilds": len(bot.guilds),
+                "pipelines": len(coalescer.tasks),
+                "queued": coalescer.depth(),
+                "waiting": scheduler.depth(),
+                "shed": scheduler.shed_level(),
+            })
+        except sqlite3.Error as e:
+            print(f"Heartbeat failed: {e}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+def worker_summary():
+    now = time.time()
+    lines = []
+    for worker_id, (status, updated) in sorted(shared.items("workers").items()):
+        lines.append(
+            f"worker {worker_id}: shards={status['shards']} guilds={status['guilds']} "
+            f"pipelines={status['pipelines']} queued={status['queued']} waiting={status.get('waiting', 0)} "
+            f"shed={status.get('shed', 0)} (seen {now - updated:.0f}s ago)"
+        )
+    return "\n".join(lines)
+
+def mention_mode(m):
+    return "search" if m["search"] else "think" if m["thinking"] else "normal"
+
+def queue_summary():
+    """Scheduler and admission state for the !queue command."""
+    p95s = ", ".join(f"{mode} {p95:.1f}s" for mode, p95 in sorted(scheduler.p95_by_mode().items()))
+    lines = [
+        f"running {scheduler.in_flight}/{scheduler.max_in_flight}, waiting {scheduler.depth()}, "
+        f"debouncing {coalescer.depth()}, requests {len(requests)}, shed level {scheduler.shed_level()}, "
+        f"p95 {p95s or 'n/a'}"
+    ]
+    waiting = scheduler.waiting_by_channel()
+    for channel_id in sorted(set(waiting) | set(scheduler.running)):
+        lines.append(
+            f"channel {channel_id}: running={scheduler.running.get(channel_id, 0)} waiting={waiting.get(channel_id, 0)}"
+        )
+    for kind, key, tokens in sorted(admission.throttled()):
+        lines.append(f"throttled {kind} {key} ({tokens:.2f} tokens)")
+    return "\n".join(lines)
+
+async def run_reply_pipeline(channel, mentions):
+    """Answer one or more coalesced mentions in a channel with a single decide/generate round."""
+    request = RequestContext(
+        channel.id,
+        {m["message"].id: m["message"].author.id for m in mentions},
+        max(REQUEST_DEADLINE_SECONDS[mention_mode(m)] for m in mentions),
+    )
+
+    started = None
+
+    async def run():
+        nonlocal started
+        async with scheduler.slot(channel.id, sum(PIPELINE_COSTS[mention_mode(m)] for m in mentions)):
+            started = time.perf_counter()
+            await reply_to_mentions(channel, mentions)
+
+    requeued = set()
+    try:
+        if not await requests.run(request, run()) and request.reason in REQUEUE_REASONS:
+            items = [m for m in mentions if m["message"].id not in request.dropped]
+            requeued = {m["message"].id for m in items}
+            if items:
+                coalescer.requeue(channel, items)
+    finally:
+        now = time.perf_counter()
+        for m in mentions:
+            if m["message"].id in requeued or m["message"].id in request.dropped:
+                continue
+            metrics.observe("pipeline_seconds", now - m["received"], mode=mention_mode(m))
+            if started is not None:
+                scheduler.record(mention_mode(m), now - started)
+            thinking_policy.observe(mention_mode(m), now - m["received"])
+
+async def run_request(message, mode, start_request, wait_turn=None):
+    """Run a one-off (image or speech) request, `start_request()`, under the scheduler and a deadline.
+
+    `wait_turn`, an async context manager such as a per-user limit, is entered before the
+    scheduler slot is taken, so waiting on it does not hold a pipeline slot.
+    """
+    request = RequestContext(
+        message.channel.id, {message.id: message.author.id}, REQUEST_DEADLINE_SECONDS[mode], kind=mode
+    )
+
+    started = None
+
+    async def run():
+        nonlocal started
+        async with wait_turn or contextlib.nullcontext():
+            async with scheduler.slot(message.channel.id, PIPELINE_COSTS[mode]):
+                started = time.perf_counter()
+                await start_request()
+
+    start = time.perf_counter()
+    try:
+        await requests.run(request, run())
+    finally:
+        if request.reason in (None, "deadline"):
+            now = time.perf_counter()
+            metrics.observe("pipeline_seconds", now - start, mode=mode)
+            if started is not None:
+                scheduler.record(mode, now - started)
+            thinking_policy.observe(mode, now - start)
+
+def thread_snapshot(snapshot, channel_id, thread_id):
+    """The messages of one thread plus the channel's last few, in order. Thread None means all of them."""
+    if thread_id is None:
+        return snapshot
+    members = threads.members(channel_id, thread_id)
+    tail = {msg.id for msg in snapshot[-THREAD_SHARED_TAIL:]}
+    return [msg for msg in snapshot if msg.id in members or msg.id in tail]
+
+def search_key(mention):
+    """search_cache key for a !search mention: the normalized question, its guild, and the message it replies to."""
+    query = " ".join(SEARCH_WORD_RE.findall(mention["text"].lower()))
+    if not query:
+        return None
+    msg = mention["message"]
+    reference = msg.reference.resolved if msg.reference else None
+    context = getattr(reference, "clean_content", None) or ""
+    scope = msg.guild.id if msg.guild else msg.channel.id
+    return hashlib.sha256(f"{scope}\0{query}\0{context}".encode()).hexdigest()
+
+async def cached_search_reply(channel, context_messages, reply_id, pairs, thinking, shed, key, bypass):
+    """Answer one !search mention from search_cache; identical questions share one grounded call."""
+
+    async def create():
+        replies = await generate_replies(context_messages, [reply_id], pairs, TOOLS, thinking, False, shed=shed)
+        return [r["reply"] for r in replies if r.get("reply")] or None
+
+    texts = await search_cache.get_or_create(
+        key, create, bypass=bypass,
+        # Answers from a fallback model are sent but not kept.
+        keep=lambda texts: not texts[0].startswith(("[FLASH] ", "[LITE] ")),
+    )
+    if texts:
+        with metrics.timer("stage_seconds", stage="send"):
+            await send_replies(channel, [{"id": reply_id, "reply": text} for text in texts])
+
+async def reply_in_thread(channel, snapshot, thread_id, ids, exclude_ids, pairs, used_tools, thinking, shed, search_keys):
+    """Generate and post the replies to `ids`, all in one thread, with that thread as context.
+
+    IDs in `search_keys` ({id: (key, bypass)}) are answered through search_cache, one by one.
+    """
+    with metrics.timer("stage_seconds", stage="context"):
+        context_messages = await collect_context(thread_snapshot(snapshot, channel.id, thread_id), exclude_ids, bot.user)
+        # Appended last so the cacheable prefix of the context stays stable.
+        recalled = recall_context(channel, snapshot, [msg for msg in snapshot if msg.id in ids])
+        if recalled:
+            context_messages.append(recalled)
+    cache_key = channel.id if thread_id is None else (channel.id, thread_id)
+    jobs = [
+        cached_search_reply(channel, context_messages, i, pairs, thinking, shed, *search_keys[i])
+        for i in ids if i in search_keys
+    ]
+    ids = [i for i in ids if i not in search_keys]
+
+    async def reply_directly():
+        if STREAM_REPLIES:
+            with metrics.timer("stage_seconds", stage="stream"):
+                await stream_replies(
+                    channel, context_messages, ids, pairs, used_tools, thinking, cache_key=cache_key, shed=shed
+                )
+            return
+        with metrics.timer("stage_seconds", stage="generation"):
+            replies = await generate_replies(
+                context_messages,
+                ids,
+                pairs,
+                used_tools,
+                thinking,
+                False,
+                cache_key=cache_key,
+                shed=shed,
+            )
+        if replies:
+            with metrics.timer("stage_seconds", stage="send"):
+                await send_replies(channel, replies)
+
+    if ids:
+        jobs.append(reply_directly())
+    await asyncio.gather(*jobs)
+
+async def reply_to_mentions(channel, mentions):
+    mention_ids = [m["message"].id for m in mentions]
+    with metrics.timer("stage_seconds", stage="history"):
+        snapshot = await history.snapshot(channel)
+    with metrics.timer("stage_seconds", stage="pairs"):
+        pairs = await collect_context_pairs(snapshot, set(mention_ids), bot.user)
+        for m in mentions:
+            pairs.append(make_pair(m["message"], m["text"], bot.user))
+    with metrics.timer("stage_seconds", stage="decision"):
+        reply_ids = await decide_reply_ids(pairs, mention_ids)
+    if not reply_ids:
+        return
+    search_mode = any(m["search"] for m in mentions)
+    thinking = any(m["thinking"] for m in mentions)
+    used_tools = TOOLS if search_mode else []
+    shed = scheduler.shed_level()
+    if shed:
+        thinking = False
+        metrics.inc("shed_pipelines_total", level=shed)
+    search_keys = {}
+    for m in mentions:
+        key = search_key(m) if m["search"] else None
+        if key is not None:
+            search_keys[m["message"].id] = (key, m["nocache"])
+    if THREAD_CONTEXT:
+        threads.sync(snapshot)
+        groups = threads.group(channel.id, reply_ids)
+    else:
+        groups = {None: reply_ids}
+    metrics.observe("reply_thread_groups", len(groups), buckets=THREAD_GROUP_BUCKETS)
+    results = await asyncio.gather(*(
+        reply_in_thread(
+            channel, snapshot, thread_id, ids, set(mention_ids), pairs, used_tools, thinking, shed, search_keys
+        )
+        for thread_id, ids in groups.items()
+    ), return_exceptions=True)
+    for thread_id, result in zip(groups, results):
+        if isinstance(result, Exception):
+            print(f"Replies in thread {thread_id} of channel {channel.id} failed: {result}")
+
+async def run_image_mode(message, prompt, bypass_cache=False):
+    """Generate or edit an image with the image model and post the result."""
+    image = None
+    if message.attachments:
+        attachment = message.attachments[0]
+        if attachment.content_type and attachment.content_type.startswith("image/"):
+            image = await download_attachment(attachment)
+    if not prompt:
+        prompt = "Edit this image in a fun way." if image else "Draw something cool."
+    try:
+        with metrics.timer("stage_seconds", stage="generation"):
+            parts = await image_generator.generate(prompt, image, bypass=bypass_cache)
+        for kind, value, mime_type in parts:
+            if kind == "text":
+                await send_long_message(message.channel, value)
+            else:
+                file = discord.File(BytesIO(value), filename=f"gemini-image.{EXTENSIONS.get(mime_type, 'png')}")
+                await message.channel.send(file=file)
+    except Exception as e:
+        await send_long_message(message.channel, f"Failed to generate image: {e}")
+
+async def speak_last_response(message):
+    """Re-speak the bot's last message in the channel."""
+    for msg in reversed(await history.snapshot(message.channel)):
+        if msg.id < message.id and msg.author == bot.user and msg.clean_content:
+            last_response = msg.clean_content
+            break
+    else:
+        await message.channel.send("No previous MuffinBot response found.")
+        return
+    audio = speech.cached(last_response)
+    if audio is None:
+        try:
+            with metrics.timer("stage_seconds", stage="tts_direction"):
+                direction_line = await speech.direction(last_response)
+        except Exception as e:
+            await message.channel.send("Sorry, TTS is unavailable right now.")
+            return
+    try:
+        if audio is None:
+            with metrics.timer("stage_seconds", stage="tts_synthesis"):
+                audio = await speech.synthesize(direction_line, last_response)
+        await message.channel.send(file=discord.File(BytesIO(audio), filename="output.wav"))
+        await send_long_message(message.channel, last_response)
+    except Exception as e:
+        await message.channel.send("Sorry, TTS failed. [No audio]")
+
+async def speak_reply(message, prompt, search_mode):
+    """Generate a reply to `prompt` and post it with a spoken version."""
+    with metrics.timer("stage_seconds", stage="history"):
+        snapshot = await history.snapshot(message.channel)
+    with metrics.timer("stage_seconds", stage="context"):
+        context_messages = await collect_context(snapshot, {message.id}, bot.user)
+    gemini_input = context_messages.copy()
+    user_parts = []
+    if prompt:
+        user_parts.append({"text": prompt})
+    if message.attachments:
+        attachment = message.attachments[0]
+        if attachment.content_type and attachment.content_type.startswith("image/"):
+            image_bytes, mime_type = await download_attachment(attachment)
+            user_parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+    gemini_input.append({
+        "role": "user",
+        "parts": user_parts
+    })
+    used_tools = TOOLS if search_mode else []
+    prompt_tokens = estimate_tokens(prompt)
+    context_tokens = estimate_content_tokens(context_messages)
+    chain = [(GEMINI_PRO_MODEL, ""), (GEMINI_FLASH_MODEL, "[FLASH] "), (GEMINI_LITE_MODEL, "[LITE] ")]
+    attempts = [
+        (model, prefix, types.GenerateContentConfig(
+            system_instruction=BOT_SYSTEM_PROMPT,
+            tools=used_tools,
+            thinking_config=types.ThinkingConfig(
+                thinking_budget=thinking_policy.choose(model, "speak", prompt_tokens, context_tokens)
+            ),
+        ))
+        for model, prefix in chain[scheduler.shed_level():]
+    ]
+
+    def parse_reply(response):
+        log_token_usage(response)
+        return strip_bot_name(response.text.strip(), bot.user.display_name)
+
+    with metrics.timer("stage_seconds", stage="generation"):
+        reply, prefix = await fallback.run("speak", gemini_input, attempts, parse_reply)
+    if reply is None:
+        await send_long_message(message.channel, "Sorry, TTS is unavailable right now.")
+        return
+    reply = prefix + reply
+    try:
+        with metrics.timer("stage_seconds", stage="tts_direction"):
+            direction_line = await speech.direction(reply)
+    except Exception as e:
+        await send_long_message(message.channel, reply)
+        await message.channel.send("Sorry, TTS failed (direction).")
+        return
+    try:
+        with metrics.timer("stage_seconds", stage="tts_synthesis"):
+            audio = await speech.synthesize(direction_line, reply)
+        await message.channel.send(file=discord.File(BytesIO(audio), filename="output.wav"))
+        await send_long_message(message.channel, reply)
+        # `!speak` with no prompt re-speaks the last message we posted, i.e. the last chunk.
+        speech.alias(split_long_message(reply)[-1], reply)
+    except Exception as e:
+        await send_long_message(message.channel, reply)
+        await message.channel.send("Sorry, TTS failed. [No audio]")
+
+speech = SpeechPipeline(
+    gemini,
+    GEMINI_TTS_MODEL,
+    GEMINI_FLASH_MODEL,
+    VOICE_NAME,
+    split_long_message,
+    TTS_CACHE_BYTES,
+    TTS_CHUNK_CHARS,
+    log=log_token_usage,
+    shared=shared,
+)
+image_generator = ImageGenerator(
+    gemini, GEMINI_IMAGE_MODEL, image_cache, IMAGE_PER_USER, IMAGE_TARGET_BYTES, IMAGE_OUTPUT_FORMAT,
+    log=log_token_usage,
+)
+dispatcher = ReplyDispatcher(split_long_message, history.get, REPLY_SEND_CONCURRENCY, metrics=metrics)
+coalescer = MentionCoalescer(run_reply_pipeline, MENTION_DEBOUNCE_SECONDS, MENTION_MAX_WAIT_SECONDS)
+
+metrics.describe("stage_seconds", "Time spent in each step of handling a mention.")
+metrics.describe("pipeline_seconds", "End-to-end time from mention to last reply, by mode.")
+metrics.describe("gemini_request_seconds", "Gemini call latency by model.")
+metrics.describe("discord_rate_limited_total", "Discord 429s retried by the bot after discord.py gave up.")
+metrics.describe("purged_messages_total", "Bot messages deleted by !purge.")
+metrics.describe("thread_links_total", "How new messages were placed into conversation threads, by signal.")
+metrics.describe("reply_thread_groups", "Threads (parallel reply requests) per answered batch of mentions.")
+metrics.describe("admission_rejected_total", "Requests turned away by the per-user or per-guild rate limit.")
+metrics.describe("admission_wait_seconds", "Time pipelines waited for a scheduler slot.")
+metrics.describe("shed_pipelines_total", "Reply pipelines answered with cheaper models because of load, by shed level.")
+metrics.describe("result_cache_requests_total", "Image and !search result cache lookups by outcome (hit, miss, joined, bypass).")
+metrics.describe("thinking_budget_tokens", "Thinking budgets chosen by the policy, by model and mode.")
+metrics.describe("requests_cancelled_total", "Requests stopped before finishing, by reason (deadline, deleted, edited, superseded).")
+metrics.describe("gemini_tokens_total", "Gemini tokens by model and kind (prompt, cached, output, thinking).")
+metrics.gauge("gemini_waiting", lambda: [({"model": m}, n) for m, n in gemini.waiting.items()])
+metrics.gauge("gemini_in_flight", lambda: [({"model": m}, n) for m, n in gemini.in_flight.items()])
+metrics.gauge("mention_queue_depth", coalescer.depth)
+metrics.gauge("pipelines_running", lambda: len(coalescer.tasks))
+metrics.gauge("requests_in_flight", lambda: len(requests))
+metrics.gauge("scheduler_in_flight", lambda: scheduler.in_flight)
+metrics.gauge("scheduler_waiting", scheduler.depth)
+metrics.gauge("shed_level", scheduler.shed_level)
+metrics.gauge("summary_updates_running", lambda: len(summaries.tasks))
+metrics.gauge("attachment_cache_bytes", lambda: attachment_cache.size)
+metrics.gauge("tts_cache_bytes", lambda: speech.audio_size)
+metrics.gauge("result_cache_bytes", lambda: [({"cache": c.name}, c.size) for c in (image_cache, search_cache)])
+metrics.gauge("result_cache_hit_ratio", lambda: [({"cache": c.name}, c.hit_ratio()) for c in (image_cache, search_cache)])
+metrics.gauge(
+    "circuit_open",
+    lambda: [({"model": m}, int(b.state != "closed")) for m, b in fallback.breakers.items()],
+)
 
 @bot.event
 async def on_ready():
+    global metrics_server, heartbeat_task
     print(f'Logged in as {bot.user}')
+    if heartbeat_task is None:
+        heartbeat_task = asyncio.create_task(heartbeat())
+        try:
+            message_store.prune(
+                datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=MESSAGE_RETENTION_DAYS)
+            )
+        except sqlite3.Error as e:
+            print(f"Message store prune failed: {e}")
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        print(f'Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+
+def withdraw(channel_id, message_id, reason):
+    """Stop answering a message: cancel its running request and drop it from the mention queue."""
+    cancelled = requests.cancel_message(channel_id, message_id, reason)
+    unqueued = coalescer.drop(channel_id, lambda m: m["message"].id == message_id)
+    return cancelled or unqueued
+
+@bot.event
+async def on_raw_message_edit(payload):
+    previous = history.get(payload.channel_id, payload.message_id) or payload.cached_message
+    history.update(payload.message)
+    message_store.update(payload.message)
+    threads.update(payload.message)
+    # Embeds being attached also arrive as edits; only a change of text counts.
+    if previous is not None and previous.content != payload.message.content:
+        if withdraw(payload.channel_id, payload.message_id, "edited") and bot.user.mentioned_in(payload.message):
+            await on_message(payload.message)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    withdraw(payload.channel_id, payload.message_id, "deleted")
+    history.remove(payload.channel_id, payload.message_id)
+    threads.remove(payload.channel_id, payload.message_id)
+    sent_index.remove(payload.channel_id, [payload.message_id])
+    message_store.delete([payload.message_id])
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    for message_id in payload.message_ids:
+        withdraw(payload.channel_id, message_id, "deleted")
+        history.remove(payload.channel_id, message_id)
+        threads.remove(payload.channel_id, message_id)
+    sent_index.remove(payload.channel_id, payload.message_ids)
+    message_store.delete(payload.message_ids)
 
 @bot.event
 async def on_message(message):
+    history.add(message)
+    message_store.add(message)
+    threads.add(message)
+    if message.author == bot.user:
+        sent_index.add(message.channel.id, message.id)
     if bot.user.mentioned_in(message) and message.author != bot.user:
         prompt = message.content
         prompt = prompt.replace(f'<@{bot.user.id}>', '').replace(f'<@!{bot.user.id}>', '').strip()
@@ -342,6 +1320,7 @@ async def on_message(message):
         image_mode = False
         search_mode = False
         speak_mode = False
+        bypass_cache = False
 
         # --- Only allow !purge for ADMIN_USER_ID ---
         if '!purge' in prompt:
@@ -349,16 +1328,29 @@ async def on_message(message):
                 await message.channel.send("You wish. Nice try, scrub.")
                 return
             prompt = prompt.replace('!purge', '').strip()
-            after_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=CONTEXT_HOURS)
-            count = 0
-            async for msg in message.channel.history(limit=None, after=after_time, oldest_first=True):
-                if msg.author == bot.user:
-                    try:
-                        await msg.delete()
-                        count += 1
-                    except Exception as e:
-                        print(f"Could not delete message: {e}")
-            await message.channel.send(f"Purged {count} MuffinBot message(s) from the last 24 hours.")
+            try:
+                window, label = parse_purge_window(prompt)
+            except ValueError:
+                await message.channel.send("Usage: !purge [30m | 6h | 7d | all] (default: last 24 hours)")
+                return
+            await purge_sent_messages(message.channel, window, label)
+            return
+
+        # --- Only allow !stats for ADMIN_USER_ID ---
+        if '!stats' in prompt:
+            if message.author.id != ADMIN_USER_ID:
+                await message.channel.send("Stats? Touch grass instead.")
+                return
+            stats = "\n".join(part for part in (metrics.summary(), worker_summary()) if part)
+            await send_long_message(message.channel, f"**Stats:**\n{stats}" if stats else "No stats yet!")
+            return
+
+        # --- Only allow !queue for ADMIN_USER_ID ---
+        if '!queue' in prompt:
+            if message.author.id != ADMIN_USER_ID:
+                await message.channel.send("Queue? Get in line like everyone else.")
+                return
+            await send_long_message(message.channel, f"**Queue:**\n{queue_summary()}")
             return
 
         # --- Only allow !context for ADMIN_USER_ID ---
@@ -367,9 +1359,8 @@ async def on_message(message):
                 await message.channel.send("Context? For you? LMAO, no.")
                 return
             prompt = prompt.replace('!context', '').strip()
-            after_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=CONTEXT_HOURS)
             context_lines = []
-            async for msg in message.channel.history(limit=100, after=after_time, oldest_first=True):
+            for msg in await history.snapshot(message.channel):
                 if msg.id == message.id or not msg.clean_content:
                     continue
                 context_lines.append(f"{msg.author.display_name}: {msg.clean_content}")
@@ -393,215 +1384,51 @@ async def on_message(message):
         if '!speak' in prompt:
             speak_mode = True
             prompt = prompt.replace('!speak', '').strip()
+        if '!nocache' in prompt:
+            bypass_cache = message.author.id == ADMIN_USER_ID
+            prompt = prompt.replace('!nocache', '').strip()
 
         trigger_text = prompt
 
+        limited = admission.admit(message.author.id, message.guild.id if message.guild else None)
+        if limited:
+            if admission.should_warn(message.author.id):
+                if limited == "user":
+                    await message.channel.send("SLOW DOWN 😭 give me a sec before the next one")
+                else:
+                    await message.channel.send("too many of u pinging me rn 😵 try again in a minute")
+            return
+
         # IMAGE MODE
         if image_mode:
-            gen_input = []
-            if message.attachments:
-                attachment = message.attachments[0]
-                if attachment.content_type and attachment.content_type.startswith("image/"):
-                    image_bytes = await download_attachment(attachment)
-                    gen_input.append(prompt if prompt else "Edit this image in a fun way.")
-                    gen_input.append(types.Part.from_bytes(data=image_bytes, mime_type=attachment.content_type))
-            else:
-                gen_input.append(prompt if prompt else "Draw something cool.")
-            try:
-                response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_IMAGE_MODEL,
-                    contents=gen_input,
-                    config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
-                )
-                for part in response.candidates[0].content.parts:
-                    if getattr(part, "text", None):
-                        await send_long_message(message.channel, part.text)
-                    elif getattr(part, "inline_data", None):
-                        image_bytes = part.inline_data.data
-                        file = discord.File(BytesIO(image_bytes), filename="gemini-image.png")
-                        await message.channel.send(file=file)
-                log_token_usage(response)
-            except Exception as e:
-                await send_long_message(message.channel, f"Failed to generate image: {e}")
+            await run_request(
+                message, "image", lambda: run_image_mode(message, prompt, bypass_cache),
+                wait_turn=image_generator.user_slot(message.author.id),
+            )
             return
 
         # --- TTS Mode ---
         if speak_mode and not prompt:
-            async for msg in message.channel.history(limit=100, before=message.created_at, oldest_first=False):
-                if msg.author == bot.user and msg.clean_content:
-                    last_response = msg.clean_content
-                    break
-            else:
-                await message.channel.send("No previous MuffinBot response found.")
-                return
-            direction_prompt = f"Given the following Discord message, write a single line direction (e.g. 'Say dramatically:' or 'Say in a deadpan voice:') for how it should be spoken out loud, based on its vibe/context. The line should be suitable to prepend before the text for TTS.\n\nMessage: {last_response}"
-            try:
-                direction_response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_FLASH_MODEL,
-                    contents=direction_prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction="Respond only with the single line direction for TTS, nothing else.",
-                    )
-                )
-                direction_line = direction_response.text.strip()
-                if not direction_line.endswith(':'):
-                    direction_line += ':'
-                log_token_usage(direction_response)
-            except Exception as e:
-                await message.channel.send("Sorry, TTS is unavailable right now.")
-                return
-            tts_prompt = f"{direction_line} {last_response}"
-            try:
-                tts_response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_TTS_MODEL,
-                    contents=tts_prompt,
-                    config=types.GenerateContentConfig(
-                        response_modalities=["AUDIO"],
-                        speech_config=types.SpeechConfig(
-                            voice_config=types.VoiceConfig(
-                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                    voice_name=VOICE_NAME
-                                )
-                            )
-                        ),
-                    )
-                )
-                log_token_usage(tts_response)
-                pcm_data = tts_response.candidates[0].content.parts[0].inline_data.data
-                fname = "output.wav"
-                wave_file(fname, pcm_data)
-                await message.channel.send(file=discord.File(fname))
-                await send_long_message(message.channel, last_response)
-            except Exception as e:
-                await message.channel.send("Sorry, TTS failed. [No audio]")
+            await run_request(message, "speak", lambda: speak_last_response(message))
             return
 
         if speak_mode and prompt:
-            context_messages = await collect_context(message.channel, message, bot.user)
-            gemini_input = context_messages.copy()
-            user_parts = []
-            if prompt:
-                user_parts.append({"text": prompt})
-            if message.attachments:
-                attachment = message.attachments[0]
-                if attachment.content_type and attachment.content_type.startswith("image/"):
-                    image_bytes = await download_attachment(attachment)
-                    user_parts.append(types.Part.from_bytes(data=image_bytes, mime_type=attachment.content_type))
-            gemini_input.append({
-                "role": "user",
-                "parts": user_parts
-            })
-            used_tools = TOOLS if search_mode else []
-            config = types.GenerateContentConfig(
-                system_instruction=BOT_SYSTEM_PROMPT,
-                tools=used_tools,
-                thinking_config=types.ThinkingConfig(thinking_budget=DEFAULT_BUDGET)
-            )
-            try:
-                response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_PRO_MODEL,
-                    contents=gemini_input,
-                    config=config,
-                )
-                reply = strip_bot_name(response.text.strip(), bot.user.display_name)
-                log_token_usage(response)
-            except Exception as e:
-                err_str = str(e)
-                # fallback to flash then lite
-                try:
-                    response = await asyncio.to_thread(
-                        client.models.generate_content,
-                        model=GEMINI_FLASH_MODEL,
-                        contents=gemini_input,
-                        config=config,
-                    )
-                    reply = "[FLASH] " + strip_bot_name(response.text.strip(), bot.user.display_name)
-                    log_token_usage(response)
-                except Exception as e2:
-                    try:
-                        lite_config = types.GenerateContentConfig(
-                            system_instruction=BOT_SYSTEM_PROMPT,
-                            tools=used_tools,
-                            thinking_config=types.ThinkingConfig(thinking_budget=0)
-                        )
-                        response = await asyncio.to_thread(
-                            client.models.generate_content,
-                            model=GEMINI_LITE_MODEL,
-                            contents=gemini_input,
-                            config=lite_config,
-                        )
-                        reply = "[LITE] " + strip_bot_name(response.text.strip(), bot.user.display_name)
-                        log_token_usage(response)
-                    except Exception:
-                        await send_long_message(message.channel, "Sorry, TTS is unavailable right now.")
-                        return
-            direction_prompt = f"Given the following Discord message, write a single line direction (e.g. 'Say dramatically:' or 'Say in a deadpan voice:') for how it should be spoken out loud, based on its vibe/context. The line should be suitable to prepend before the text for TTS.\n\nMessage: {reply}"
-            try:
-                direction_response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_FLASH_MODEL,
-                    contents=direction_prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction="Respond only with the single line direction for TTS, nothing else.",
-                    )
-                )
-                direction_line = direction_response.text.strip()
-                if not direction_line.endswith(':'):
-                    direction_line += ':'
-                log_token_usage(direction_response)
-            except Exception as e:
-                await send_long_message(message.channel, reply)
-                await message.channel.send("Sorry, TTS failed (direction).")
-                return
-            tts_prompt = f"{direction_line} {reply}"
-            try:
-                tts_response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=GEMINI_TTS_MODEL,
-                    contents=tts_prompt,
-                    config=types.GenerateContentConfig(
-                        response_modalities=["AUDIO"],
-                        speech_config=types.SpeechConfig(
-                            voice_config=types.VoiceConfig(
-                                prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                    voice_name=VOICE_NAME
-                                )
-                            )
-                        ),
-                    )
-                )
-                log_token_usage(tts_response)
-                pcm_data = tts_response.candidates[0].content.parts[0].inline_data.data
-                fname = "output.wav"
-                wave_file(fname, pcm_data)
-                await message.channel.send(file=discord.File(fname))
-                await send_long_message(message.channel, reply)
-            except Exception as e:
-                await send_long_message(message.channel, reply)
-                await message.channel.send("Sorry, TTS failed. [No audio]")
+            await run_request(message, "speak", lambda: speak_reply(message, prompt, search_mode))
             return
 
         # NORMAL MODE with message ID targeting
-        context_messages = await collect_context(message.channel, message, bot.user)
-        pairs = await collect_context_pairs(message.channel, message)
-        pairs.append({"id": message.id, "text": f"{message.author.display_name}: {trigger_text}"})
-        reply_ids = await decide_reply_ids(pairs)
-        if not reply_ids:
-            return
-        used_tools = TOOLS if search_mode else []
-        replies = await generate_replies(
-            context_messages,
-            reply_ids,
-            pairs,
-            used_tools,
-            thinking,
-            image_mode,
-        )
-        if replies:
-            await send_replies(message.channel, replies)
+        requests.supersede(message.channel.id, message.author.id)
+        coalescer.submit(message.channel, {
+            "message": message,
+            "text": trigger_text,
+            "thinking": thinking,
+            "search": search_mode,
+            "nocache": bypass_cache,
+            "received": time.perf_counter(),
+        })
 
-bot.run(TOKEN)
+if __name__ == "__main__":
+    try:
+        bot.run(TOKEN)
+    finally:
+        message_store.flush()
@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import time
+
+# The request the running task works for. Tasks created inside it (gather, fallback attempts,
+# parallel sends) inherit it, so deep code such as ModelPool can read its deadline.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class RequestContext:
+    """Deadline and cancellation token for one request (a reply pipeline, an image, a spoken reply).
+
+    `triggers` maps the IDs of the messages that started it to their authors. `cancel` stops
+    the request's task with a reason and the trigger IDs that should not be answered any more;
+    `posted` is set once something has been sent, after which it is no longer superseded.
+    """
+
+    def __init__(self, channel_id, triggers, timeout, kind="reply"):
+        self.channel_id = channel_id
+        self.triggers = dict(triggers)
+        self.kind = kind
+        self.deadline = time.monotonic() + timeout
+        self.task = None
+        self.reason = None
+        self.dropped = set()
+        self.posted = False
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def cancel(self, reason, message_ids=()):
+        if self.task is None or self.task.done():
+            return False
+        if self.reason is None:
+            self.reason = reason
+        self.dropped.update(message_ids)
+        self.task.cancel()
+        return True
+
+
+def dropped(message_id):
+    """True if the current request should no longer answer `message_id`."""
+    request = current_request.get()
+    if request is None or not request.dropped:
+        return False
+    try:
+        return int(message_id) in request.dropped
+    except (TypeError, ValueError):
+        return False
+
+
+def mark_posted():
+    """Note that the current request has sent something to Discord."""
+    request = current_request.get()
+    if request is not None:
+        request.posted = True
+
+
+class RequestRegistry:
+    """Requests in flight per channel, run as their own tasks so they can be cancelled.
+
+    A request is cancelled when one of its trigger messages is deleted or edited
+    (`cancel_message`), when all of its authors are one person who asks again in the same
+    channel before anything was posted (`supersede`), or when its deadline passes.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.active = {}
+
+    def __len__(self):
+        return sum(len(requests) for requests in self.active.values())
+
+    async def run(self, request, coro):
+        """Run `coro` for `request` until it finishes, is cancelled, or hits the deadline.
+
+        Returns True if it finished. Other exceptions are raised as usual.
+        """
+
+        async def guarded():
+            current_request.set(request)
+            async with asyncio.timeout(request.remaining()):
+                return await coro
+
+        request.task = asyncio.create_task(guarded())
+        requests = self.active.setdefault(request.channel_id, set())
+        requests.add(request)
+        try:
+            await asyncio.wait({request.task})
+        except asyncio.CancelledError:
+            request.task.cancel()
+            raise
+        finally:
+            requests.discard(request)
+            if not requests:
+                self.active.pop(request.channel_id, None)
+            # Never started if it was cancelled while still queued.
+            coro.close()
+        if request.task.cancelled():
+            self._count(request.reason or "cancelled")
+            return False
+        error = request.task.exception()
+        if isinstance(error, TimeoutError) and request.remaining() <= 0:
+            request.reason = "deadline"
+            self._count("deadline")
+            return False
+        if error is not None:
+            raise error
+        return True
+
+    def _count(self, reason):
+        if self.metrics is not None:
+            self.metrics.inc("requests_cancelled_total", reason=reason)
+
+    def cancel_message(self, channel_id, message_id, reason):
+        """Cancel the requests triggered by a message. Returns True if there were any."""
+        cancelled = False
+        for request in list(self.active.get(channel_id, ())):
+            if message_id in request.triggers:
+                cancelled = request.cancel(reason, [message_id]) or cancelled
+        return cancelled
+
+    def supersede(self, channel_id, author_id):
+        """Withdraw `author_id`'s mentions from reply requests in the channel that have posted nothing yet.
+
+        A request made only of their mentions is cancelled. One that also answers other people
+        keeps going and just leaves their mentions out (see `dropped`), so a user pinging again
+        and again cannot hold back everyone else's replies.
+        """
+        for request in list(self.active.get(channel_id, ())):
+            if request.kind != "reply" or request.posted:
+                continue
+            mine = [i for i, author in request.triggers.items() if author == author_id]
+            if not mine:
+                continue
+            if len(mine) == len(request.triggers):
+                request.cancel("superseded", mine)
+            else:
+                request.dropped.update(mine)
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+
+class MentionCoalescer:
+    """Folds mentions in a channel into one pipeline run.
+
+    A run starts once no new mention has arrived for `debounce` seconds, or `max_wait`
+    seconds after the first one, whichever comes first. Mentions that arrive while a run
+    is in progress are queued and handled together by the next run.
+    """
+
+    def __init__(self, handler, debounce, max_wait):
+        self.handler = handler
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.pending = {}
+        self.tasks = {}
+
+    def submit(self, channel, item):
+        batch = self.pending.get(channel.id)
+        if batch is None:
+            batch = self.pending[channel.id] = {"items": [], "first": time.monotonic(), "last": 0}
+        batch["items"].append(item)
+        batch["last"] = time.monotonic()
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._run(channel))
+
+    def requeue(self, channel, items):
+        """Put the items of a cancelled run back at the front of the channel's next batch."""
+        batch = self.pending.get(channel.id)
+        if batch is None:
+            now = time.monotonic()
+            batch = self.pending[channel.id] = {"items": [], "first": now, "last": now}
+        batch["items"][:0] = items
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._run(channel))
+
+    def drop(self, channel_id, match):
+        """Remove queued items for which `match(item)` is true. Returns True if any were removed."""
+        batch = self.pending.get(channel_id)
+        if batch is None:
+            return False
+        kept = [item for item in batch["items"] if not match(item)]
+        dropped = len(kept) < len(batch["items"])
+        batch["items"] = kept
+        if not kept:
+            del self.pending[channel_id]
+        return dropped
+
+    def depth(self):
+        return sum(len(batch["items"]) for batch in self.pending.values())
+
+    async def _wait(self, batch):
+        while True:
+            now = time.monotonic()
+            deadline = min(batch["last"] + self.debounce, batch["first"] + self.max_wait)
+            if now >= deadline:
+                return
+            await asyncio.sleep(deadline - now)
+
+    async def _run(self, channel):
+        try:
+            while channel.id in self.pending:
+                await self._wait(self.pending[channel.id])
+                batch = self.pending.pop(channel.id, None)
+                if not batch or not batch["items"]:
+                    continue
+                try:
+                    await self.handler(channel, batch["items"])
+                except Exception as e:
+                    print(f"Reply pipeline failed in channel {channel.id}: {e}")
+        finally:
+            self.tasks.pop(channel.id, None)
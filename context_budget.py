@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate: ~4 chars per token, with extra weight for non-ASCII (emoji, CJK)."""
+    chars = len(text)
+    if text.isascii():
+        return chars // 4 + 1
+    extra = len(text.encode("utf-8")) - chars
+    return chars // 4 + extra // 2 + 1
+
+
+def estimate_content_tokens(contents):
+    tokens = 0
+    for content in contents:
+        for part in content["parts"]:
+            if isinstance(part, dict):
+                tokens += estimate_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+def truncate_to_tokens(text, max_tokens):
+    # estimate_tokens(text) is at most 2 * len(text) + 1, so short text never needs measuring.
+    if 2 * len(text) < max_tokens or estimate_tokens(text) <= max_tokens:
+        return text
+    cut = max_tokens * 4
+    while cut > 0 and estimate_tokens(text[:cut]) > max_tokens:
+        cut = cut * 3 // 4
+    return text[:cut].rstrip() + " …[truncated]"
+
+
+def split_to_budget(items, cost, budget):
+    """Split chronological items into (older, recent) so the newest items fit in `budget`."""
+    total = 0
+    keep = len(items)
+    while keep > 0:
+        item_cost = cost(items[keep - 1])
+        if total + item_cost > budget:
+            break
+        total += item_cost
+        keep -= 1
+    return items[:keep], items[keep:]
+
+
+class RollingSummary:
+    """Per-channel running summary of history that no longer fits in the prompt verbatim.
+
+    Messages are queued with `fold` (when they are pushed out of the token budget or evicted from
+    the history window) and merged into the summary in the background by `summarize`, a coroutine
+    taking (previous_summary, lines) and returning the new summary text. An update starts once
+    `batch_lines` lines are pending, or on a later `fold` once the oldest has waited `max_delay`
+    seconds, so a busy channel does not cost a summarize call per request.
+    """
+
+    def __init__(self, summarize, batch_lines=200, max_pending=1000, max_delay=600):
+        self.summarize = summarize
+        self.batch_lines = batch_lines
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.summaries = {}
+        self.covered = {}
+        self.pending = {}
+        self.pending_since = {}
+        self.tasks = {}
+
+    def get(self, channel_id):
+        return self.summaries.get(channel_id)
+
+    def fold(self, channel_id, messages):
+        covered = self.covered.get(channel_id, 0)
+        pending = None
+        for msg in messages:
+            if msg.id <= covered or not msg.clean_content:
+                continue
+            if pending is None:
+                pending = self.pending.setdefault(channel_id, {})
+            pending[msg.id] = f"{msg.author.display_name}: {msg.clean_content}"
+        if pending and len(pending) > self.max_pending:
+            for msg_id in sorted(pending)[:len(pending) - self.max_pending]:
+                del pending[msg_id]
+        pending = self.pending.get(channel_id)
+        if not pending or channel_id in self.tasks:
+            return
+        now = time.monotonic()
+        since = self.pending_since.setdefault(channel_id, now)
+        if len(pending) >= self.batch_lines or now - since >= self.max_delay:
+            self.tasks[channel_id] = asyncio.create_task(self._update(channel_id))
+
+    async def _update(self, channel_id):
+        try:
+            while self.pending.get(channel_id):
+                pending = self.pending[channel_id]
+                ids = sorted(pending)[:self.batch_lines]
+                lines = [pending[i] for i in ids]
+                try:
+                    summary = await self.summarize(self.summaries.get(channel_id), lines)
+                except Exception as e:
+                    print(f"Could not update summary for channel {channel_id}: {e}")
+                    # Wait another max_delay before retrying rather than on the next fold.
+                    self.pending_since[channel_id] = time.monotonic()
+                    return
+                if summary:
+                    self.summaries[channel_id] = summary
+                self.covered[channel_id] = max(self.covered.get(channel_id, 0), ids[-1])
+                covered = self.covered[channel_id]
+                for msg_id in [i for i in pending if i <= covered]:
+                    del pending[msg_id]
+            self.pending_since.pop(channel_id, None)
+        finally:
+            self.tasks.pop(channel_id, None)
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import itertools
+import time
+
+from google.genai import types
+
+from context_budget import estimate_content_tokens
+
+
+def content_fingerprint(content):
+    """Stable hash of one context entry (role, text and image bytes)."""
+    h = hashlib.sha1(content["role"].encode())
+    for part in content["parts"]:
+        if isinstance(part, dict):
+            h.update(part.get("text", "").encode())
+        else:
+            inline = getattr(part, "inline_data", None)
+            if inline is not None and inline.data:
+                h.update(hashlib.sha1(inline.data).digest())
+    return h.hexdigest()
+
+
+class GeminiCacheBackend:
+    """Stores prefixes with the google-genai cached-content API."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, model, system_instruction, contents, ttl):
+        cached = await self.client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                contents=contents,
+                ttl=f"{ttl}s",
+            ),
+        )
+        return cached.name
+
+    async def delete(self, name):
+        await self.client.aio.caches.delete(name=name)
+
+
+class LocalCacheBackend:
+    """In-process stand-in for GeminiCacheBackend, for tests and benchmarks."""
+
+    def __init__(self):
+        self.caches = {}
+        self.counter = itertools.count(1)
+
+    async def create(self, model, system_instruction, contents, ttl):
+        name = f"cachedContents/local-{next(self.counter)}"
+        self.caches[name] = {
+            "model": model,
+            "system_instruction": system_instruction,
+            "contents": list(contents),
+            "ttl": ttl,
+        }
+        return name
+
+    async def delete(self, name):
+        self.caches.pop(name, None)
+
+
+class ContextCache:
+    """Per-channel cached prompt prefixes (system instruction plus older history).
+
+    `lookup` never waits on the backend: on a miss it returns the full contents and builds the
+    prefix in the background so later calls in the channel only send the new tail. A cached
+    prefix stays usable while the current window still starts inside it, so older messages
+    sliding out of the window do not force a rebuild. It is rebuilt once the uncached tail
+    grows past `refresh_tail` messages or the entry expires.
+    """
+
+    def __init__(self, backend, ttl=3600, min_tokens=4096, tail_messages=8, refresh_tail=40, retry_after=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.tail_messages = tail_messages
+        self.refresh_tail = refresh_tail
+        self.retry_after = retry_after
+        self.entries = {}
+        self.building = {}
+        self.failed = {}
+
+    def lookup(self, key, model, system_instruction, contents):
+        """Return (cache_name, tail) for a live matching prefix, or (None, contents)."""
+        entry_key = (key, model)
+        fingerprints = [content_fingerprint(c) for c in contents]
+        entry = self.entries.get(entry_key)
+        if entry is not None and entry["expires"] <= time.monotonic():
+            self._drop(entry_key)
+            entry = None
+        tail = None
+        if entry is not None and entry["system_instruction"] == system_instruction and fingerprints:
+            prefix = entry["prefix"]
+            try:
+                start = prefix.index(fingerprints[0])
+            except ValueError:
+                start = None
+            if start is not None and fingerprints[:len(prefix) - start] == prefix[start:]:
+                tail = contents[len(prefix) - start:]
+        if tail is None or len(tail) > self.refresh_tail:
+            self._schedule(entry_key, model, system_instruction, contents, fingerprints)
+        if tail is None:
+            return None, contents
+        return entry["name"], tail
+
+    def invalidate(self, key):
+        for entry_key in [k for k in self.entries if k[0] == key]:
+            self._drop(entry_key)
+
+    def _drop(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            asyncio.create_task(self._delete(entry["name"]))
+
+    async def _delete(self, name):
+        try:
+            await self.backend.delete(name)
+        except Exception as e:
+            print(f"Could not delete context cache {name}: {e}")
+
+    def _schedule(self, entry_key, model, system_instruction, contents, fingerprints):
+        if entry_key in self.building or self.failed.get(entry_key, 0) > time.monotonic():
+            return
+        prefix_len = len(contents) - self.tail_messages
+        if prefix_len <= 0 or estimate_content_tokens(contents[:prefix_len]) < self.min_tokens:
+            return
+        task = asyncio.create_task(
+            self._build(entry_key, model, system_instruction, contents[:prefix_len], fingerprints[:prefix_len])
+        )
+        self.building[entry_key] = task
+        task.add_done_callback(lambda _: self.building.pop(entry_key, None))
+
+    async def _build(self, entry_key, model, system_instruction, prefix_contents, prefix):
+        try:
+            name = await self.backend.create(model, system_instruction, prefix_contents, self.ttl)
+        except Exception as e:
+            print(f"Could not create context cache for {entry_key}: {e}")
+            self.failed[entry_key] = time.monotonic() + self.retry_after
+            return
+        self._drop(entry_key)
+        self.entries[entry_key] = {
+            "name": name,
+            "prefix": prefix,
+            "system_instruction": system_instruction,
+            # Expire locally a little before the server does so we never send a dead name.
+            "expires": time.monotonic() + self.ttl - 60,
+        }
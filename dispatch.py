@@ -0,0 +1,79 @@
+import asyncio
+
+import discord
+
+
+async def retry_rate_limited(call, retries=5, metrics=None):
+    """Await `call()`, retrying when Discord answers 429.
+
+    discord.py already waits out the rate limits it knows about; this covers the 429s it gives
+    up on (shared or global limits), using the server's retry_after or exponential backoff.
+    """
+    delay = 1.0
+    for attempt in range(retries):
+        try:
+            return await call()
+        except discord.HTTPException as e:
+            if e.status != 429 or attempt == retries - 1:
+                raise
+            if metrics is not None:
+                metrics.inc("discord_rate_limited_total")
+            await asyncio.sleep(getattr(e, "retry_after", None) or delay)
+            delay *= 2
+
+
+class ReplyDispatcher:
+    """Posts model replies as Discord replies.
+
+    References are built from the target message's ID, or from the cached message when `lookup`
+    has it, so no fetch_message round trip is needed. Replies to different messages go out
+    concurrently (up to `concurrency` at a time) while the chunks of each reply stay in order,
+    and replies aimed at the same message are joined before splitting instead of being posted
+    as a run of tiny messages.
+    """
+
+    def __init__(self, split, lookup=None, concurrency=4, retries=5, metrics=None):
+        self.split = split
+        self.lookup = lookup
+        self.concurrency = concurrency
+        self.retries = retries
+        self.metrics = metrics
+
+    def reference(self, channel, message_id):
+        msg = self.lookup(channel.id, message_id) if self.lookup is not None else None
+        if msg is not None:
+            return msg.to_reference(fail_if_not_exists=False)
+        guild = getattr(channel, "guild", None)
+        return discord.MessageReference(
+            message_id=message_id,
+            channel_id=channel.id,
+            guild_id=getattr(guild, "id", None),
+            fail_if_not_exists=False,
+        )
+
+    async def send(self, channel, replies):
+        grouped = {}
+        for item in replies:
+            text = item.get("reply")
+            try:
+                msg_id = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if text and msg_id:
+                grouped.setdefault(msg_id, []).append(text)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(msg_id, texts):
+            ref = self.reference(channel, msg_id)
+            async with semaphore:
+                for chunk in self.split("\n\n".join(texts)):
+                    await retry_rate_limited(
+                        lambda: channel.send(chunk, reference=ref), self.retries, self.metrics
+                    )
+
+        results = await asyncio.gather(
+            *(send_one(msg_id, texts) for msg_id, texts in grouped.items()), return_exceptions=True
+        )
+        for msg_id, result in zip(grouped, results):
+            if isinstance(result, Exception):
+                print(f"Could not send reply to {msg_id}: {result}")
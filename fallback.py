@@ -0,0 +1,165 @@
+import asyncio
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """Tracks a model's recent error rate and latency and opens when it is failing.
+
+    While open, the model is skipped until `cooldown` seconds have passed; then a single
+    trial call is let through and its outcome decides whether the breaker closes again.
+    """
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, slow_seconds=None, cooldown=30):
+        self.calls = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        return not self.trial and time.monotonic() - self.opened_at >= self.cooldown
+
+    def begin(self):
+        if self.opened_at is not None:
+            self.trial = True
+
+    def record(self, ok, latency):
+        if self.slow_seconds is not None and latency > self.slow_seconds:
+            ok = False
+        self.calls.append((ok, latency))
+        if self.trial:
+            self.trial = False
+            self.opened_at = None if ok else time.monotonic()
+            if ok:
+                self.calls.clear()
+            return
+        if len(self.calls) >= self.min_calls:
+            failures = sum(1 for call_ok, _ in self.calls if not call_ok)
+            if failures / len(self.calls) >= self.error_rate:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Forget a trial call that was cancelled before it finished."""
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial else "open"
+
+
+class FallbackEngine:
+    """Runs a model fallback chain with per-model circuit breakers, deadlines and optional hedging.
+
+    `attempts` is an ordered list of (model, prefix, config), optionally with a fourth item that
+    replaces `contents` for that attempt. Models whose breaker is open are
+    skipped. If an attempt has not answered after `hedge_after[model]` seconds the next one is
+    started alongside it, and whichever produces a usable result first wins.
+
+    `breaker_factory(model)` makes each model's CircuitBreaker, e.g. with its own `slow_seconds`.
+    """
+
+    def __init__(self, pool, deadlines=None, hedge_after=None, breaker_factory=None, metrics=None):
+        self.pool = pool
+        self.metrics = metrics
+        self.deadlines = deadlines or {}
+        self.hedge_after = hedge_after or {}
+        self.breaker_factory = breaker_factory or (lambda model: CircuitBreaker())
+        self.breakers = {}
+
+    def breaker(self, model):
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = self.breaker_factory(model)
+        return breaker
+
+    async def _attempt(self, label, model, contents, config, parse, beaten):
+        start = time.monotonic()
+        try:
+            response = await self.pool.generate(
+                model=model,
+                contents=contents,
+                config=config,
+                timeout=self.deadlines.get(model),
+            )
+            result = parse(response)
+            if result is None:
+                print(f"{model} {label} returned an unusable response")
+        except asyncio.CancelledError:
+            elapsed = time.monotonic() - start
+            hedge = self.hedge_after.get(model)
+            if asyncio.current_task() in beaten and hedge is not None and elapsed >= hedge:
+                # Lost to its own hedge: it was too slow, and has to count as such, or a model
+                # that always loses the race would never open its breaker.
+                if self.metrics is not None:
+                    self.metrics.inc("fallback_attempt_failures_total", label=label, model=model)
+                self.breaker(model).record(False, elapsed)
+            else:
+                # Cancelled from outside (the request was withdrawn) or before it was due: no verdict.
+                self.breaker(model).release()
+            raise
+        except Exception as e:
+            print(f"{model} {label} failed: {e}")
+            result = None
+        if result is None and self.metrics is not None:
+            self.metrics.inc("fallback_attempt_failures_total", label=label, model=model)
+        self.breaker(model).record(result is not None, time.monotonic() - start)
+        return result
+
+    async def run(self, label, contents, attempts, parse):
+        """Return (result, prefix) from the first attempt that parses, or (None, None)."""
+        candidates = [a for a in attempts if self.breaker(a[0]).allow()]
+        if not candidates:
+            candidates = list(attempts)
+        running = {}
+        # Attempts still running when another one answered.
+        beaten = set()
+        next_index = 0
+        last_start = 0
+
+        def start_next():
+            nonlocal next_index, last_start
+            model, prefix, config = candidates[next_index][:3]
+            attempt_contents = candidates[next_index][3] if len(candidates[next_index]) > 3 else contents
+            next_index += 1
+            last_start = time.monotonic()
+            self.breaker(model).begin()
+            task = asyncio.create_task(self._attempt(label, model, attempt_contents, config, parse, beaten))
+            running[task] = (model, prefix)
+
+        start_next()
+        try:
+            while running:
+                timeout = None
+                if next_index < len(candidates):
+                    hedge = self.hedge_after.get(candidates[next_index - 1][0])
+                    if hedge is not None:
+                        timeout = max(0, last_start + hedge - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if self.metrics is not None:
+                        self.metrics.inc("fallback_hedges_total", label=label, model=candidates[next_index][0])
+                    start_next()
+                    continue
+                for task in done:
+                    model, prefix = running.pop(task)
+                    result = task.result()
+                    if result is not None:
+                        if self.metrics is not None:
+                            self.metrics.inc("fallback_answers_total", label=label, model=model)
+                        beaten.update(running)
+                        return result, prefix
+                if next_index < len(candidates):
+                    start_next()
+            if self.metrics is not None:
+                self.metrics.inc("fallback_exhausted_total", label=label)
+            return None, None
+        finally:
+            for task in running:
+                task.cancel()
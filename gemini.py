@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+from cancellation import current_request
+
+
+class ModelPool:
+    """Shared async request layer for Gemini calls.
+
+    All calls go through one genai client, so its HTTP session and connections are reused.
+    Each model gets its own concurrency semaphore and per-call timeout, and, if `rate_limiter`
+    is given, waits for a request token from it before each call. Inside a request with a
+    deadline (cancellation.current_request), timeouts never run past it.
+    """
+
+    def __init__(self, client, limits, timeouts, default_limit=8, default_timeout=120, metrics=None, rate_limiter=None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.limits = limits
+        self.timeouts = timeouts
+        self.default_limit = default_limit
+        self.default_timeout = default_timeout
+        self.semaphores = {}
+        self.waiting = {}
+        self.in_flight = {}
+
+    def _semaphore(self, model):
+        semaphore = self.semaphores.get(model)
+        if semaphore is None:
+            semaphore = self.semaphores[model] = asyncio.Semaphore(self.limits.get(model, self.default_limit))
+        return semaphore
+
+    async def _acquire(self, model):
+        semaphore = self._semaphore(model)
+        self.waiting[model] = self.waiting.get(model, 0) + 1
+        try:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(model)
+            await semaphore.acquire()
+        finally:
+            self.waiting[model] -= 1
+        self.in_flight[model] = self.in_flight.get(model, 0) + 1
+
+    def _release(self, model):
+        self.in_flight[model] -= 1
+        self.semaphores[model].release()
+
+    def _timeout(self, model, timeout):
+        if timeout is None:
+            timeout = self.timeouts.get(model, self.default_timeout)
+        request = current_request.get()
+        if request is not None:
+            timeout = max(0, min(timeout, request.remaining()))
+        return timeout
+
+    def _record(self, model, start, response=None, error=None):
+        if self.metrics is None:
+            return
+        self.metrics.observe("gemini_request_seconds", time.perf_counter() - start, model=model)
+        if error is not None:
+            outcome = "timeout" if isinstance(error, asyncio.TimeoutError) else "error"
+            self.metrics.inc("gemini_requests_total", model=model, outcome=outcome)
+            return
+        self.metrics.inc("gemini_requests_total", model=model, outcome="ok")
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            for kind, count in (
+                ("prompt", usage.prompt_token_count),
+                ("cached", usage.cached_content_token_count),
+                ("output", usage.candidates_token_count),
+                ("thinking", usage.thoughts_token_count),
+            ):
+                if count:
+                    self.metrics.inc("gemini_tokens_total", count, model=model, kind=kind)
+
+    async def generate(self, model, contents, config=None, timeout=None):
+        timeout = self._timeout(model, timeout)
+        await self._acquire(model)
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                self.client.aio.models.generate_content(model=model, contents=contents, config=config),
+                timeout,
+            )
+        except Exception as e:
+            self._record(model, start, error=e)
+            raise
+        finally:
+            self._release(model)
+        self._record(model, start, response)
+        return response
+
+    async def stream(self, model, contents, config=None, timeout=None):
+        """Yield chunks from generate_content_stream. `timeout` bounds the whole stream."""
+        timeout = self._timeout(model, timeout)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        await self._acquire(model)
+        start = time.perf_counter()
+        chunks = None
+        last_chunk = None
+        try:
+            chunks = await asyncio.wait_for(
+                self.client.aio.models.generate_content_stream(model=model, contents=contents, config=config),
+                timeout,
+            )
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                last_chunk = chunk
+                yield chunk
+        except Exception as e:
+            self._record(model, start, error=e)
+            raise
+        else:
+            self._record(model, start, last_chunk)
+        finally:
+            self._release(model)
+            if chunks is not None and hasattr(chunks, "aclose"):
+                await chunks.aclose()
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import sqlite3
+from collections import deque
+
+
+class ChannelHistory:
+    """Ring buffer of one channel's recent messages, oldest first."""
+
+    def __init__(self, hours, limit, on_evict=None):
+        self.hours = hours
+        self.limit = limit
+        self.on_evict = on_evict
+        self.messages = deque(maxlen=limit)
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def _evicted(self, msgs):
+        if msgs and self.on_evict is not None:
+            self.on_evict(msgs)
+
+    def _rebuild(self, merged):
+        ordered = sorted(merged.values(), key=lambda m: m.id)
+        self._evicted(ordered[:-self.limit])
+        self.messages = deque(ordered[-self.limit:], maxlen=self.limit)
+
+    def add(self, msg):
+        if not self.messages or msg.id > self.messages[-1].id:
+            if len(self.messages) == self.limit:
+                self._evicted([self.messages[0]])
+            self.messages.append(msg)
+            return
+        # Out-of-order or duplicate delivery: rebuild in id order.
+        merged = {m.id: m for m in self.messages}
+        merged[msg.id] = msg
+        self._rebuild(merged)
+
+    def merge(self, msgs):
+        merged = {m.id: m for m in msgs}
+        # Live events that arrived during the backfill are newer than the fetched copies.
+        merged.update({m.id: m for m in self.messages})
+        self._rebuild(merged)
+
+    def update(self, msg):
+        for idx, existing in enumerate(self.messages):
+            if existing.id == msg.id:
+                self.messages[idx] = msg
+                return
+
+    def get(self, message_id):
+        for existing in reversed(self.messages):
+            if existing.id == message_id:
+                return existing
+        return None
+
+    def remove(self, message_id):
+        for existing in self.messages:
+            if existing.id == message_id:
+                self.messages.remove(existing)
+                return
+
+    def snapshot(self):
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=self.hours)
+        expired = []
+        while self.messages and self.messages[0].created_at < cutoff:
+            expired.append(self.messages.popleft())
+        self._evicted(expired)
+        return list(self.messages)
+
+
+class HistoryCache:
+    """Per-channel message windows, backfilled once and then kept current from gateway events.
+
+    `on_evict`, if given, is called with the messages that fall out of a window. With a `store`
+    (see message_store.MessageStore), a window is first filled from it and only the messages
+    newer than its latest entry are fetched, and fetched messages are written back to it.
+    """
+
+    def __init__(self, hours, limit=100, on_evict=None, store=None):
+        self.hours = hours
+        self.limit = limit
+        self.on_evict = on_evict
+        self.store = store
+        self.channels = {}
+
+    async def snapshot(self, channel):
+        history = self.channels.get(channel.id)
+        if history is None:
+            history = self.channels[channel.id] = ChannelHistory(self.hours, self.limit, self.on_evict)
+        if not history.loaded:
+            async with history.lock:
+                if not history.loaded:
+                    after_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=self.hours)
+                    if self.store is not None:
+                        try:
+                            stored = self.store.recent(channel, after_time, self.limit)
+                        except sqlite3.Error as e:
+                            # Fetch the whole window from Discord instead.
+                            print(f"Message store read failed: {e}")
+                            stored = []
+                        history.merge(stored)
+                        if stored:
+                            after_time = stored[-1]
+                    fetched = [msg async for msg in channel.history(limit=self.limit, after=after_time, oldest_first=False)]
+                    history.merge(fetched)
+                    if self.store is not None:
+                        self.store.add_many(fetched)
+                    history.loaded = True
+        return history.snapshot()
+
+    def add(self, msg):
+        history = self.channels.get(msg.channel.id)
+        if history is not None:
+            history.add(msg)
+
+    def update(self, msg):
+        history = self.channels.get(msg.channel.id)
+        if history is not None:
+            history.update(msg)
+
+    def get(self, channel_id, message_id):
+        """Return the cached message, or None if it is not in the channel's window."""
+        history = self.channels.get(channel_id)
+        return history.get(message_id) if history is not None else None
+
+    def remove(self, channel_id, message_id):
+        history = self.channels.get(channel_id)
+        if history is not None:
+            history.remove(message_id)
@@ -0,0 +1,132 @@
+import asyncio
+import contextlib
+import hashlib
+from io import BytesIO
+
+from google.genai import types
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXTENSIONS = {"image/webp": "webp", "image/jpeg": "jpg", "image/png": "png", "image/gif": "gif"}
+
+
+def compact_image(data, mime_type, target_bytes, output_format="WEBP", qualities=(90, 80, 70, 60, 50), min_side=256):
+    """Re-encode a generated image to fit under `target_bytes`. Returns (data, mime_type).
+
+    Tries `output_format` (WEBP or JPEG; images with transparency always use WEBP) at falling
+    quality, then at half the size, until the result fits. Keeps the original if it is
+    already small enough, Pillow is missing, or nothing comes out smaller.
+    """
+    if Image is None or len(data) <= target_bytes:
+        return data, mime_type
+    best = (data, mime_type)
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.load()
+            alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            fmt = "WEBP" if alpha else output_format.upper()
+            img = img.convert("RGBA" if alpha else "RGB")
+            while True:
+                for quality in qualities:
+                    out = BytesIO()
+                    if fmt == "JPEG":
+                        img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+                    else:
+                        img.save(out, format="WEBP", quality=quality, method=4)
+                    if out.tell() < len(best[0]):
+                        best = (out.getvalue(), f"image/{fmt.lower()}")
+                    if out.tell() <= target_bytes:
+                        return best
+                if min(img.size) // 2 < min_side:
+                    return best
+                img = img.resize((img.width // 2, img.height // 2), Image.LANCZOS)
+    except Exception as e:
+        print(f"Could not re-encode image: {e}")
+    return best
+
+
+def image_size(parts):
+    """ResultCache `sizeof` for ImageGenerator results."""
+    return sum(len(value) for _, value, _ in parts)
+
+
+class ImageGenerator:
+    """!image requests with the image model.
+
+    Identical requests (same prompt, same input image bytes) share one model call while it is
+    in flight and are then served from `cache` (a result_cache.ResultCache) until it expires.
+    Returned images are re-encoded under `target_bytes` before caching, so cache hits are cheap
+    to upload too. Each user runs at most `per_user` generations at a time (see `user_slot`); more
+    wait their turn.
+
+    Results are lists of ("text", str, None) and ("image", bytes, mime_type) parts, in order.
+    """
+
+    def __init__(self, pool, model, cache, per_user=1, target_bytes=1024 * 1024, output_format="WEBP", log=None):
+        self.pool = pool
+        self.model = model
+        self.cache = cache
+        self.per_user = per_user
+        self.target_bytes = target_bytes
+        self.output_format = output_format
+        self.log = log
+        self.users = {}
+
+    def key(self, prompt, image):
+        h = hashlib.sha256(prompt.encode())
+        h.update(b"\0")
+        if image is not None:
+            h.update(hashlib.sha256(image[0]).digest())
+        return h.hexdigest()
+
+    async def _generate(self, prompt, image):
+        contents = [prompt]
+        if image is not None:
+            contents.append(types.Part.from_bytes(data=image[0], mime_type=image[1]))
+        response = await self.pool.generate(
+            model=self.model,
+            contents=contents,
+            config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
+        )
+        if self.log:
+            self.log(response)
+        parts = []
+        for part in response.candidates[0].content.parts:
+            if getattr(part, "text", None):
+                parts.append(("text", part.text, None))
+            elif getattr(part, "inline_data", None):
+                data, mime_type = await asyncio.to_thread(
+                    compact_image, part.inline_data.data, part.inline_data.mime_type or "image/png",
+                    self.target_bytes, self.output_format,
+                )
+                parts.append(("image", data, mime_type))
+        return parts
+
+    @contextlib.asynccontextmanager
+    async def user_slot(self, user_id):
+        """Wait for one of `user_id`'s `per_user` generation turns.
+
+        Take it before any shared capacity (such as a scheduler slot), so a user's queued
+        requests wait here instead of holding that capacity idle.
+        """
+        slot = self.users.get(user_id)
+        if slot is None:
+            slot = self.users[user_id] = [asyncio.Semaphore(self.per_user), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.users[user_id]
+
+    async def generate(self, prompt, image=None, bypass=False):
+        """Generate for `prompt` and an optional (bytes, mime_type) input image. Call it inside `user_slot`."""
+        return await self.cache.get_or_create(
+            self.key(prompt, image), lambda: self._generate(prompt, image), bypass=bypass,
+            keep=lambda parts: any(kind == "image" for kind, _, _ in parts),
+        )
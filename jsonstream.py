@@ -0,0 +1,170 @@
+import json
+import re
+from json.decoder import scanstring
+
+_WS = " \t\n\r"
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_LITERALS = {"true": True, "false": False, "null": None}
+_CUT_ESCAPE = re.compile(r"((?:^|[^\\])(?:\\\\)*)\\(?:u[0-9a-fA-F]{0,3})?$")
+_HIGH_SURROGATE = re.compile(r"((?:^|[^\\])(?:\\\\)*)\\u[dD][89abAB][0-9a-fA-F]{2}$")
+_MISSING = object()
+# Longer than either pattern's match after its leading non-backslash, plus a final newline.
+_TAIL = 16
+
+
+def _skip(s, i):
+    while i < len(s) and s[i] in _WS:
+        i += 1
+    return i
+
+
+def _partial_string(s, i):
+    """Decode the unterminated string body starting at s[i]."""
+    # Drop an escape sequence (or the high half of a surrogate pair) that was cut off. Both can
+    # only sit in the last few characters, so the patterns run over a tail that starts at a
+    # character that is not a backslash; scanning a long reply from the start is much slower.
+    cut = len(s) - _TAIL
+    while cut > i and s[cut] == "\\":
+        cut -= 1
+    if cut <= i:
+        cut = i
+    body = s[i:cut] + _HIGH_SURROGATE.sub(r"\1", _CUT_ESCAPE.sub(r"\1", s[cut:]))
+    try:
+        return json.loads('"' + body + '"', strict=False)
+    except json.JSONDecodeError:
+        return body
+
+
+def _value(s, i):
+    i = _skip(s, i)
+    if i >= len(s):
+        return _MISSING, i, False
+    c = s[i]
+    if c == "{":
+        return _object(s, i + 1)
+    if c == "[":
+        return _array(s, i + 1)
+    if c == '"':
+        try:
+            value, end = scanstring(s, i + 1, False)
+            return value, end, True
+        except json.JSONDecodeError:
+            return _partial_string(s, i + 1), len(s), False
+    m = _NUMBER.match(s, i)
+    if m:
+        # A number touching the end of the input may still be growing.
+        if m.end() >= len(s):
+            return _MISSING, len(s), False
+        text = m.group(0)
+        return (float(text) if any(ch in text for ch in ".eE") else int(text)), m.end(), True
+    for word, value in _LITERALS.items():
+        if s.startswith(word, i):
+            return value, i + len(word), True
+    return _MISSING, i, False
+
+
+def _array(s, i):
+    items = []
+    while True:
+        i = _skip(s, i)
+        if i >= len(s):
+            return items, i, False
+        if s[i] == "]":
+            return items, i + 1, True
+        if s[i] == ",":
+            i += 1
+            continue
+        value, i, complete = _value(s, i)
+        if value is not _MISSING:
+            items.append(value)
+        if not complete:
+            return items, i, False
+
+
+def _object(s, i):
+    obj = {}
+    while True:
+        i = _skip(s, i)
+        if i >= len(s):
+            return obj, i, False
+        if s[i] == "}":
+            return obj, i + 1, True
+        if s[i] == ",":
+            i += 1
+            continue
+        if s[i] != '"':
+            return obj, i, False
+        try:
+            key, i = scanstring(s, i + 1, False)
+        except json.JSONDecodeError:
+            return obj, len(s), False
+        i = _skip(s, i)
+        if i >= len(s) or s[i] != ":":
+            return obj, i, False
+        value, i, complete = _value(s, i + 1)
+        if value is not _MISSING:
+            obj[key] = value
+        if not complete:
+            return obj, i, False
+
+
+def parse_partial(text):
+    """Parse a JSON object or array that may be truncated or followed by junk.
+
+    Returns (value, complete). Unterminated strings, arrays and objects are closed off with what
+    has arrived so far; numbers and literals are only included once fully received. Returns
+    (None, False) if no object or array has started yet.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return None, False
+    value, _, complete = _value(text, min(starts))
+    if value is _MISSING:
+        return None, False
+    return value, complete
+
+
+def find_json(text, max_starts=20):
+    """Return the first complete JSON object or array embedded in `text`, or None."""
+    start = 0
+    for _ in range(max_starts):
+        starts = [i for i in (text.find("{", start), text.find("[", start)) if i != -1]
+        if not starts:
+            return None
+        start = min(starts)
+        value, _, complete = _value(text, start)
+        if complete and value is not _MISSING:
+            return value
+        start += 1
+    return None
+
+
+def recover_replies(text):
+    """Salvage the fully received {"id", "reply"} items from a broken or truncated responses document."""
+    data, complete = parse_partial(text)
+    if not isinstance(data, dict) or not isinstance(data.get("responses"), list):
+        return []
+    # The last item of an unfinished document may have been cut mid-reply.
+    items = data["responses"] if complete else data["responses"][:-1]
+    return [
+        item for item in items
+        if isinstance(item, dict) and "id" in item and isinstance(item.get("reply"), str)
+    ]
+
+
+def partial_replies(text):
+    """Return [(id, reply_text)] for every reply in a (possibly partial) {"responses": [...]} document
+    whose id has fully arrived and whose reply text has started."""
+    data, _ = parse_partial(text)
+    if not isinstance(data, dict) or not isinstance(data.get("responses"), list):
+        return []
+    replies = []
+    for item in data["responses"]:
+        if not isinstance(item, dict) or not isinstance(item.get("reply"), str) or not item["reply"]:
+            continue
+        try:
+            reply_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        replies.append((reply_id, item["reply"]))
+    return replies
@@ -0,0 +1,278 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import discord
+from discord.utils import snowflake_time, time_snowflake
+
+_WORD = re.compile(r"\w{3,}")
+
+
+class StoredUser:
+    """Just enough of a discord.User for context building: compares equal by ID."""
+
+    __slots__ = ("id", "name", "display_name", "bot")
+
+    def __init__(self, user_id, name, display_name, bot):
+        self.id = user_id
+        self.name = name
+        self.display_name = display_name
+        self.bot = bot
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class StoredAttachment:
+    __slots__ = ("id", "filename", "content_type", "url", "fetch")
+
+    def __init__(self, attachment_id, filename, content_type, url, fetch):
+        self.id = attachment_id
+        self.filename = filename
+        self.content_type = content_type
+        self.url = url
+        self.fetch = fetch
+
+    async def read(self):
+        if self.fetch is None:
+            raise LookupError(f"No way to download stored attachment {self.id}")
+        return await self.fetch(self.url)
+
+
+class StoredMessage:
+    """A message loaded from the store, shaped like the parts of discord.Message the bot reads."""
+
+    __slots__ = (
+        "id", "channel", "author", "content", "clean_content", "created_at",
+        "attachments", "mentions", "mention_everyone", "reference",
+    )
+
+    def __init__(self, row, channel, fetch):
+        (message_id, _, author_id, author_name, display_name, author_bot, content, clean_content,
+         reply_to, mentions, mention_everyone, attachments) = row
+        self.id = message_id
+        self.channel = channel
+        self.author = StoredUser(author_id, author_name, display_name, bool(author_bot))
+        self.content = content
+        self.clean_content = clean_content
+        self.created_at = snowflake_time(message_id)
+        self.mentions = [StoredUser(*m) for m in json.loads(mentions)]
+        self.mention_everyone = bool(mention_everyone)
+        self.attachments = [StoredAttachment(*a, fetch) for a in json.loads(attachments)]
+        self.reference = SimpleNamespace(message_id=reply_to, resolved=None) if reply_to else None
+
+    def to_reference(self, fail_if_not_exists=True):
+        return discord.MessageReference(
+            message_id=self.id, channel_id=self.channel.id, fail_if_not_exists=fail_if_not_exists
+        )
+
+
+_COLUMNS = (
+    "message_id", "channel_id", "author_id", "author_name", "display_name", "author_bot", "content",
+    "clean_content", "reply_to", "mentions", "mention_everyone", "attachments",
+)
+_SELECT = ", ".join(_COLUMNS)
+_INSERT = "INSERT OR IGNORE INTO messages ({}) VALUES ({})".format(
+    ", ".join(_COLUMNS + ("guild_id",)), ", ".join("?" * (len(_COLUMNS) + 1))
+)
+_UPDATE = "UPDATE messages SET content = ?, clean_content = ? WHERE message_id = ? AND NOT deleted"
+_DELETE = (
+    "UPDATE messages SET content = '', clean_content = '', attachments = '[]', deleted = 1 WHERE message_id = ?"
+)
+
+
+def _row(msg):
+    reference = getattr(msg, "reference", None)
+    return (
+        msg.id,
+        msg.channel.id,
+        msg.author.id,
+        msg.author.name,
+        msg.author.display_name,
+        int(bool(getattr(msg.author, "bot", False))),
+        msg.content,
+        msg.clean_content,
+        getattr(reference, "message_id", None),
+        json.dumps([[u.id, u.name, u.display_name, bool(getattr(u, "bot", False))] for u in msg.mentions]),
+        int(bool(getattr(msg, "mention_everyone", False))),
+        json.dumps([
+            [a.id, getattr(a, "filename", None), a.content_type, getattr(a, "url", None)] for a in msg.attachments
+        ]),
+        getattr(getattr(msg.channel, "guild", None), "id", None),
+    )
+
+
+class MessageStore:
+    """Append-only local copy of every message the bot sees, in SQLite.
+
+    Rows are keyed by message ID; since IDs are snowflakes, (channel_id, message_id) doubles as
+    the channel/time index. Messages are inserted as they arrive and never rewritten except for
+    edits (new text) and deletes (text cleared, row kept as a tombstone). An FTS5 index over the
+    text serves keyword recall beyond the live history window. `fetch(url)`, if given, is used to
+    download attachments of stored messages.
+
+    Writes (`add`, `update`, `delete`) are only queued on the calling thread and committed in
+    batches from a worker thread every `flush_interval` seconds, so gateway events never wait on
+    the disk; reads flush the queue first. Store errors during a background flush are logged and
+    that batch is dropped.
+    """
+
+    def __init__(self, path, fetch=None, flush_interval=1.0):
+        self.fetch = fetch
+        self.flush_interval = flush_interval
+        self.writes = []
+        self.flush_task = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                guild_id INTEGER,
+                author_id INTEGER NOT NULL,
+                author_name TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                author_bot INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                clean_content TEXT NOT NULL,
+                reply_to INTEGER,
+                mentions TEXT NOT NULL,
+                mention_everyone INTEGER NOT NULL,
+                attachments TEXT NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, message_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                clean_content, content='messages', content_rowid='message_id'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, clean_content) VALUES (new.message_id, new.clean_content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF clean_content ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, clean_content)
+                    VALUES ('delete', old.message_id, old.clean_content);
+                INSERT INTO messages_fts (rowid, clean_content) VALUES (new.message_id, new.clean_content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, clean_content)
+                    VALUES ('delete', old.message_id, old.clean_content);
+            END;
+            """
+        )
+        self.db.commit()
+
+    def add(self, msg):
+        self._queue(_INSERT, [_row(msg)])
+
+    def add_many(self, msgs):
+        self._queue(_INSERT, [_row(m) for m in msgs])
+
+    def update(self, msg):
+        self._queue(_UPDATE, [(msg.content, msg.clean_content, msg.id)])
+
+    def delete(self, message_ids):
+        self._queue(_DELETE, [(message_id,) for message_id in message_ids])
+
+    def _queue(self, sql, rows):
+        if not rows:
+            return
+        if self.writes and self.writes[-1][0] == sql:
+            self.writes[-1][1].extend(rows)
+        else:
+            self.writes.append((sql, rows))
+        if self.flush_task is None:
+            try:
+                self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError:
+                self.flush()
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self.flush_task = None
+        try:
+            await asyncio.to_thread(self.flush)
+        except sqlite3.Error as e:
+            print(f"Message store write failed: {e}")
+
+    def flush(self):
+        """Commit the queued writes, in order, in one transaction."""
+        with self.lock:
+            writes, self.writes = self.writes, []
+            if not writes:
+                return
+            try:
+                for sql, rows in writes:
+                    self.db.executemany(sql, rows)
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def prune(self, before):
+        """Drop everything older than the datetime `before`."""
+        self.flush()
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE message_id < ?", (time_snowflake(before),))
+            self.db.commit()
+
+    def _load(self, channel, rows):
+        msgs = [StoredMessage(row, channel, self.fetch) for row in rows]
+        by_id = {m.id: m for m in msgs}
+        for msg in msgs:
+            if msg.reference is not None:
+                msg.reference.resolved = by_id.get(msg.reference.message_id)
+        return msgs
+
+    def recent(self, channel, after, limit):
+        """The newest `limit` live messages in `channel` since the datetime `after`, oldest first."""
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {_SELECT} FROM messages WHERE channel_id = ? AND message_id > ? AND NOT deleted "
+                "ORDER BY message_id DESC LIMIT ?",
+                (channel.id, time_snowflake(after), limit),
+            ).fetchall()
+        return self._load(channel, rows[::-1])
+
+    def search(self, channel, text, before_id=None, limit=5, ignore=frozenset(), min_overlap=2):
+        """Best keyword matches for `text` among the channel's messages older than `before_id`, oldest first.
+
+        Words in `ignore` (lowercase) are left out of the query. A match must share at least
+        `min_overlap` distinct query words with `text` (all of them for shorter queries), so one
+        common word in a long message is not enough to be recalled.
+        """
+        words = list(dict.fromkeys(w for w in (w.lower() for w in _WORD.findall(text)) if w not in ignore))[:12]
+        if not words:
+            return []
+        query = " OR ".join(f'"{w}"' for w in words)
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join('m.' + c for c in _COLUMNS)} "
+                "FROM messages_fts JOIN messages m ON m.message_id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? AND m.channel_id = ? AND m.message_id < ? AND NOT m.deleted "
+                "ORDER BY bm25(messages_fts) LIMIT ?",
+                (query, channel.id, before_id or (1 << 63) - 1, limit * 4),
+            ).fetchall()
+        wanted = set(words)
+        need = min(min_overlap, len(wanted))
+        # clean_content is the eighth column.
+        rows = [
+            row for row in rows if len(wanted.intersection(w.lower() for w in _WORD.findall(row[7]))) >= need
+        ][:limit]
+        return sorted(self._load(channel, rows), key=lambda m: m.id)
+
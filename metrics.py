@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import time
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside the bucket that contains it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[idx - 1] if idx > 0 else 0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class _Timer:
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """In-process counters, gauges and histograms rendered in the Prometheus text format.
+
+    Updates are plain dict operations so they are cheap enough for the hot path. Gauges are
+    callables sampled only when metrics are rendered.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _label_key(labels)
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, fn):
+        """Register a gauge. `fn` returns a number, or a list of (labels_dict, number) pairs."""
+        self.gauges[name] = fn
+
+    def value(self, name, **labels):
+        return self.counters.get(name, {}).get(_label_key(labels), 0)
+
+    def _gauge_series(self, name):
+        try:
+            sample = self.gauges[name]()
+        except Exception as e:
+            print(f"Gauge {name} failed: {e}")
+            return {}
+        if isinstance(sample, list):
+            return {_label_key(labels): value for labels, value in sample}
+        return {(): sample}
+
+    def render(self):
+        lines = []
+        for name in sorted(self.counters):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(self.counters[name].items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name in sorted(self.gauges):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(self._gauge_series(name).items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name in sorted(self.histograms):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in sorted(self.histograms[name].items()):
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {hist.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {hist.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short human-readable digest for chat."""
+        lines = []
+        for name in sorted(self.histograms):
+            for key, hist in sorted(self.histograms[name].items()):
+                p50, p95 = hist.quantile(0.5), hist.quantile(0.95)
+                lines.append(f"{name}{_format_labels(key)}: n={hist.count} p50={p50:.2f}s p95={p95:.2f}s")
+        for name in sorted(self.counters):
+            for key, value in sorted(self.counters[name].items()):
+                lines.append(f"{name}{_format_labels(key)}: {value}")
+        for name in sorted(self.gauges):
+            for key, value in sorted(self._gauge_series(name).items()):
+                lines.append(f"{name}{_format_labels(key)}: {value}")
+        return "\n".join(lines)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request.split(b" ")[1:2] == [b"/metrics"]:
+                body = self.render().encode()
+                status = b"200 OK"
+            else:
+                body = b"not found\n"
+                status = b"404 Not Found"
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except Exception as e:
+            print(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """Serve GET /metrics over plain HTTP."""
+        return await asyncio.start_server(self._handle, host, port)
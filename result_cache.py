@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """TTL + LRU cache of coroutine results, bounded by total size, with single-flight misses.
+
+    `get_or_create(key, create)` returns a live cached value, or awaits `create()` once no
+    matter how many callers ask for the same key at the same time. `sizeof(value)` measures
+    entries against `max_bytes`. Outcomes are counted in `result_cache_requests_total` under
+    the cache's `name`.
+    """
+
+    def __init__(self, name, max_bytes, ttl, sizeof=len, metrics=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, outcome):
+        if outcome in ("hit", "joined"):
+            self.hits += 1
+        elif outcome == "miss":
+            self.misses += 1
+        if self.metrics is not None:
+            self.metrics.inc("result_cache_requests_total", cache=self.name, outcome=outcome)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, size, expires = entry
+        if expires <= time.monotonic():
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._drop(key)
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    async def _create(self, key, create, keep):
+        value = await create()
+        if value is not None and (keep is None or keep(value)):
+            self.put(key, value)
+        return value
+
+    async def get_or_create(self, key, create, bypass=False, keep=None):
+        """Cached value for `key`, or the result of `create()`.
+
+        With `bypass`, the cache is not read but a fresh result still replaces the entry.
+        Results that are None, or that `keep(value)` rejects, are returned but not cached.
+        """
+        if bypass:
+            self._count("bypass")
+            return await self._create(key, create, keep)
+        value = self.get(key)
+        if value is not None:
+            self._count("hit")
+            return value
+        task = self.pending.get(key)
+        if task is None:
+            self._count("miss")
+            task = asyncio.ensure_future(self._create(key, create, keep))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        else:
+            self._count("joined")
+        return await asyncio.shield(task)
@@ -0,0 +1,126 @@
+import datetime
+import sqlite3
+
+import discord
+from discord.utils import snowflake_time, time_snowflake
+
+from dispatch import retry_rate_limited
+
+BULK_DELETE_MAX = 100
+# Discord only bulk-deletes messages younger than 14 days; keep a margin for clock skew.
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
+
+class SentMessageIndex:
+    """IDs of the messages the bot has posted, per channel, persisted in SQLite.
+
+    Message IDs are snowflakes, so a time window maps to an ID range and needs no extra column.
+    The index only knows about messages sent since it started recording; `covered_from` says
+    how far back it is complete for a channel, so callers can scan the rest once and mark it.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sent_messages (
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                PRIMARY KEY (channel_id, message_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS sent_coverage (
+                channel_id INTEGER PRIMARY KEY,
+                covered_from INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
+        )
+        now = time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('sent_index_started', ?)", (now,))
+        self.db.commit()
+        self.started = self.db.execute("SELECT value FROM meta WHERE key = 'sent_index_started'").fetchone()[0]
+
+    def add(self, channel_id, message_id):
+        self.db.execute("INSERT OR IGNORE INTO sent_messages VALUES (?, ?)", (channel_id, message_id))
+        self.db.commit()
+
+    def remove(self, channel_id, message_ids):
+        self.db.executemany(
+            "DELETE FROM sent_messages WHERE channel_id = ? AND message_id = ?",
+            [(channel_id, message_id) for message_id in message_ids],
+        )
+        self.db.commit()
+
+    def ids(self, channel_id, after=None):
+        """IDs sent in a channel since `after` (a datetime, or None for all time), oldest first."""
+        low = time_snowflake(after) if after else 0
+        rows = self.db.execute(
+            "SELECT message_id FROM sent_messages WHERE channel_id = ? AND message_id >= ? ORDER BY message_id",
+            (channel_id, low),
+        )
+        return [row[0] for row in rows]
+
+    def covered_from(self, channel_id):
+        """Datetime from which the index holds every bot message in the channel, or None if it always has."""
+        row = self.db.execute("SELECT covered_from FROM sent_coverage WHERE channel_id = ?", (channel_id,)).fetchone()
+        since = row[0] if row else self.started
+        return snowflake_time(since) if since else None
+
+    def mark_covered(self, channel_id, since, message_ids):
+        """Record the result of scanning the channel back to `since` (None for the beginning)."""
+        self.db.executemany(
+            "INSERT OR IGNORE INTO sent_messages VALUES (?, ?)",
+            [(channel_id, message_id) for message_id in message_ids],
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO sent_coverage VALUES (?, ?)",
+            (channel_id, time_snowflake(since) if since else 0),
+        )
+        self.db.commit()
+
+
+async def _delete_batch(channel, batch, retries):
+    """Delete one batch. Returns "ok", "forbidden" or "failed"."""
+    try:
+        await retry_rate_limited(
+            lambda: channel.delete_messages([discord.Object(id=message_id) for message_id in batch]), retries
+        )
+    except discord.NotFound:
+        pass
+    except discord.Forbidden:
+        return "forbidden"
+    except discord.HTTPException as e:
+        print(f"Could not delete {len(batch)} message(s): {e}")
+        return "failed"
+    return "ok"
+
+
+async def delete_messages(channel, message_ids, on_progress=None, retries=5):
+    """Delete `message_ids` from `channel` and return the IDs that are gone.
+
+    Messages younger than 14 days go in bulk-delete calls of up to 100, older ones one at a time.
+    Without Manage Messages the bot can only delete its own messages one by one, so a forbidden
+    bulk call switches the rest to single deletes. `on_progress(done, total)` is awaited after
+    every call.
+    """
+    cutoff = time_snowflake(datetime.datetime.now(datetime.timezone.utc) - BULK_DELETE_MAX_AGE)
+    recent = [i for i in message_ids if i >= cutoff]
+    batches = [recent[i:i + BULK_DELETE_MAX] for i in range(0, len(recent), BULK_DELETE_MAX)]
+    batches += [[i] for i in message_ids if i < cutoff]
+    deleted = []
+    while batches:
+        batch = batches.pop(0)
+        outcome = await _delete_batch(channel, batch, retries)
+        if outcome == "forbidden" and len(batch) > 1:
+            batches = [[i] for b in [batch] + batches for i in b]
+            continue
+        if outcome == "ok":
+            deleted.extend(batch)
+        if on_progress is not None:
+            await on_progress(len(deleted), len(message_ids))
+    return deleted
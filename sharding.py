@@ -0,0 +1,142 @@
+"""Run the bot as several worker processes, each owning a group of shards.
+
+    python sharding.py --workers 2 --shard-count 4
+    python sharding.py --workers 2 --shard-count 4 -- python bench/fake_gateway.py --synthetic 200
+
+Each worker gets SHARD_COUNT, SHARD_IDS, WORKER_ID, WORKER_RESTARTS and its own METRICS_PORT in
+its environment, and shares STATE_DB_PATH (sent-message index, caches, rate tokens, heartbeats)
+with the others. Workers that exit with an error, or whose heartbeat goes stale, are restarted
+with exponential backoff. The supervisor exits once every worker has exited cleanly.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import sys
+import time
+
+from shared_state import SharedStore
+
+
+def shard_groups(shard_count, workers):
+    """Spread shards round-robin over workers, e.g. 4 shards on 2 workers -> [[0, 2], [1, 3]]."""
+    return [list(range(i, shard_count, workers)) for i in range(workers)]
+
+
+class Worker:
+    def __init__(self, index, shards):
+        self.index = index
+        self.worker_id = str(index)
+        self.shards = shards
+        self.process = None
+        self.restarts = 0
+        self.started = 0
+
+
+class Supervisor:
+    """Starts one process per shard group and keeps them running."""
+
+    def __init__(self, command, groups, shard_count, store=None, metrics_port=0, min_backoff=1, max_backoff=60,
+                 stable_after=60, heartbeat_timeout=120):
+        self.command = command
+        self.shard_count = shard_count
+        self.workers = [Worker(i, shards) for i, shards in enumerate(groups)]
+        self.store = store
+        self.metrics_port = metrics_port
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stopping = False
+
+    def _env(self, worker):
+        env = dict(os.environ)
+        env.update({
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": ",".join(str(s) for s in worker.shards),
+            "WORKER_ID": worker.worker_id,
+            "WORKER_RESTARTS": str(worker.restarts),
+            "METRICS_PORT": str(self.metrics_port + worker.index if self.metrics_port else 0),
+        })
+        return env
+
+    def _stale(self, worker):
+        """True if the worker has sent a heartbeat since it started but none recently."""
+        if self.store is None:
+            return False
+        try:
+            record = self.store.items("workers").get(worker.worker_id)
+        except sqlite3.Error as e:
+            print(f"Could not read heartbeats: {e}")
+            return False
+        if record is None:
+            return False
+        _, updated = record
+        return updated >= worker.started and time.time() - updated > self.heartbeat_timeout
+
+    async def _watch(self, worker):
+        backoff = self.min_backoff
+        while not self.stopping:
+            worker.started = time.time()
+            worker.process = await asyncio.create_subprocess_exec(*self.command, env=self._env(worker))
+            print(f"Worker {worker.worker_id} (shards {worker.shards}) started, pid {worker.process.pid}")
+            while True:
+                try:
+                    code = await asyncio.wait_for(worker.process.wait(), 5)
+                    break
+                except asyncio.TimeoutError:
+                    if self._stale(worker):
+                        print(f"Worker {worker.worker_id} stopped sending heartbeats; killing it")
+                        worker.process.kill()
+            if self.stopping or code == 0:
+                print(f"Worker {worker.worker_id} exited with code {code}")
+                return
+            if time.time() - worker.started >= self.stable_after:
+                backoff = self.min_backoff
+            worker.restarts += 1
+            print(f"Worker {worker.worker_id} exited with code {code}; restarting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                pass
+        await asyncio.gather(*(self._watch(worker) for worker in self.workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--shard-count", type=int, required=True)
+    parser.add_argument("--heartbeat-timeout", type=float, default=120)
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="worker command (default: this python running bot.py)")
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    command = command or [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    ]
+    state_path = os.environ.setdefault("STATE_DB_PATH", "muffinbot.sqlite3")
+    supervisor = Supervisor(
+        command,
+        shard_groups(args.shard_count, min(args.workers, args.shard_count)),
+        args.shard_count,
+        store=SharedStore(state_path),
+        metrics_port=int(os.getenv("METRICS_PORT", "9108")),
+        heartbeat_timeout=args.heartbeat_timeout,
+    )
+    asyncio.run(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+
+class SharedStore:
+    """State shared by every worker process, kept in one SQLite file.
+
+    - Blobs: a byte-bounded, least-recently-used cache with optional TTL (attachments, TTS audio).
+    - Token buckets: request budgets that all workers draw from, refilled atomically.
+    - Records: small JSON values by namespace and key (worker heartbeats, admin state).
+
+    The file is opened in WAL mode, so readers in one process never block writers in another.
+    Calls are synchronous; async code should use load_blob/save_blob, which run in a worker thread.
+    """
+
+    def __init__(self, path, max_blob_bytes=512 * 1024 * 1024):
+        self.max_blob_bytes = max_blob_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                meta TEXT,
+                size INTEGER NOT NULL,
+                expires REAL,
+                used REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS records (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            """
+        )
+
+    def get_blob(self, namespace, key):
+        """Return (value, meta) or None."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, meta, expires FROM blobs WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            value, meta, expires = row
+            if expires is not None and expires < now:
+                self.db.execute("DELETE FROM blobs WHERE namespace = ? AND key = ?", (namespace, key))
+                return None
+            self.db.execute("UPDATE blobs SET used = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        return value, meta
+
+    def put_blob(self, namespace, key, value, meta=None, ttl=None):
+        if len(value) > self.max_blob_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (namespace, key, value, meta, len(value), now + ttl if ttl else None, now),
+                )
+                self.db.execute("DELETE FROM blobs WHERE expires IS NOT NULL AND expires < ?", (now,))
+                total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+                if total > self.max_blob_bytes:
+                    excess = total - self.max_blob_bytes
+                    rows = self.db.execute("SELECT namespace, key, size FROM blobs ORDER BY used")
+                    doomed = []
+                    for row in rows:
+                        if excess <= 0:
+                            break
+                        doomed.append(row[:2])
+                        excess -= row[2]
+                    self.db.executemany("DELETE FROM blobs WHERE namespace = ? AND key = ?", doomed)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    async def load_blob(self, namespace, key):
+        """get_blob in a worker thread; store errors are logged and treated as a miss."""
+        try:
+            return await asyncio.to_thread(self.get_blob, namespace, key)
+        except sqlite3.Error as e:
+            print(f"Shared store read failed: {e}")
+            return None
+
+    async def save_blob(self, namespace, key, value, meta=None, ttl=None):
+        """put_blob in a worker thread; store errors are logged and ignored."""
+        try:
+            await asyncio.to_thread(self.put_blob, namespace, key, value, meta, ttl)
+        except sqlite3.Error as e:
+            print(f"Shared store write failed: {e}")
+
+    def take(self, name, rate, burst):
+        """Take one token from bucket `name` (refilled at `rate` per second, holding at most `burst`).
+
+        Returns 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self.db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (name, tokens, now))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return wait
+
+    def set(self, namespace, key, value):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), time.time()),
+            )
+
+    def get(self, namespace, key, default=None):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def items(self, namespace):
+        """Return {key: (value, updated)} for a namespace."""
+        with self.lock:
+            rows = self.db.execute("SELECT key, value, updated FROM records WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: (json.loads(value), updated) for key, value, updated in rows}
+
+
+class SharedRateLimiter:
+    """Per-model requests-per-minute limits drawn from a SharedStore, so they hold across workers."""
+
+    def __init__(self, store, requests_per_minute):
+        self.store = store
+        self.requests_per_minute = requests_per_minute
+
+    async def acquire(self, model):
+        rpm = self.requests_per_minute.get(model)
+        if not rpm:
+            return
+        # A burst of a few seconds' worth keeps short spikes fast without letting workers overshoot.
+        burst = max(1, rpm / 20)
+        while True:
+            try:
+                wait = await asyncio.to_thread(self.store.take, f"gemini:{model}", rpm / 60, burst)
+            except sqlite3.Error as e:
+                print(f"Shared rate limiter unavailable, not limiting {model}: {e}")
+                return
+            if not wait:
+                return
+            await asyncio.sleep(wait)
@@ -0,0 +1,59 @@
+import time
+
+from dispatch import retry_rate_limited
+
+
+class StreamedReply:
+    """One reply being streamed into a Discord channel.
+
+    The first chunk is posted as soon as there is text, the newest message is edited as more
+    arrives (at most once every `edit_interval` seconds), and text past the message length limit
+    goes to follow-up messages as laid out by `split`. Sends, edits and deletes are retried on
+    429 like every other send path (dispatch.retry_rate_limited), so a rate limit mid-stream does
+    not end the reply.
+    """
+
+    def __init__(self, channel, reference, split, edit_interval, retries=5, metrics=None):
+        self.channel = channel
+        self.reference = reference
+        self.split = split
+        self.edit_interval = edit_interval
+        self.messages = []
+        self.shown = []
+        self.last_edit = 0
+        self.retries = retries
+        self.metrics = metrics
+
+    async def _call(self, call):
+        return await retry_rate_limited(call, self.retries, self.metrics)
+
+    async def update(self, text, final=False):
+        chunks = self.split(text) if text else []
+        now = time.monotonic()
+        for idx, chunk in enumerate(chunks):
+            if idx >= len(self.messages):
+                self.messages.append(await self._call(lambda: self.channel.send(chunk, reference=self.reference)))
+                self.shown.append(chunk)
+                continue
+            if self.shown[idx] == chunk:
+                continue
+            # Only the last message is still growing; earlier ones are settled and edited right away.
+            if final or idx < len(chunks) - 1 or now - self.last_edit >= self.edit_interval:
+                await self._call(lambda: self.messages[idx].edit(content=chunk))
+                self.shown[idx] = chunk
+                self.last_edit = now
+        if final:
+            for msg in self.messages[len(chunks):]:
+                await self._call(msg.delete)
+            del self.messages[len(chunks):]
+            del self.shown[len(chunks):]
+
+    async def discard(self):
+        """Delete everything posted so far."""
+        for msg in self.messages:
+            try:
+                await self._call(msg.delete)
+            except Exception as e:
+                print(f"Could not delete partial reply {msg.id}: {e}")
+        self.messages.clear()
+        self.shown.clear()
@@ -0,0 +1,79 @@
+import json
+import time
+from collections import deque
+
+BUDGET_BUCKETS = (0, 128, 512, 1024, 2048, 4096, 8192, 16384, 24576, 32768)
+
+
+class ThinkingPolicy:
+    """Picks a thinking_budget for each model call.
+
+    The starting point is `budgets[mode]` (None leaves thinking to the model's default). It is
+    scaled by how much there is to think about: `prompt_tokens` (the messages being answered)
+    plus `context_tokens` weighted by `context_weight`, relative to `full_at` tokens, but never
+    below `min_factor`. If the recent p95 latency for the mode (from `observe`) is over
+    `slos[mode]` seconds, the budget shrinks in proportion. The result is clamped to the
+    model's `limits` (min, max); Pro cannot turn thinking off, so its minimum is above zero.
+
+    Every choice is counted in the `thinking_budget_tokens` histogram, kept in `recent`, and,
+    with a `log_path`, appended there as a JSON line alongside the observed latencies, so the
+    numbers can be tuned from real traffic.
+    """
+
+    def __init__(self, budgets, limits, slos, full_at=400, context_weight=0.05, min_factor=0.125, window=300,
+                 metrics=None, log_path=None):
+        self.budgets = budgets
+        self.limits = limits
+        self.slos = slos
+        self.full_at = full_at
+        self.context_weight = context_weight
+        self.min_factor = min_factor
+        self.window = window
+        self.metrics = metrics
+        self.log_path = log_path
+        self.latencies = {}
+        self.recent = deque(maxlen=200)
+
+    def _log(self, record):
+        if self.log_path is None:
+            return
+        try:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not write thinking log: {e}")
+
+    def observe(self, mode, seconds):
+        self.latencies.setdefault(mode, deque(maxlen=500)).append((time.monotonic(), seconds))
+        self._log({"t": time.time(), "event": "latency", "mode": mode, "seconds": round(seconds, 3)})
+
+    def p95(self, mode):
+        cutoff = time.monotonic() - self.window
+        recent = sorted(s for t, s in self.latencies.get(mode, ()) if t >= cutoff)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(0.95 * len(recent)))]
+
+    def choose(self, model, mode, prompt_tokens, context_tokens=0):
+        """Return the thinking_budget for one call, or None for the model's default."""
+        base = self.budgets.get(mode)
+        if base is None:
+            return None
+        size_factor = min(1.0, max(self.min_factor, (prompt_tokens + context_tokens * self.context_weight) / self.full_at))
+        latency_factor = 1.0
+        p95 = self.p95(mode)
+        slo = self.slos.get(mode)
+        if p95 is not None and slo and p95 > slo:
+            latency_factor = max(self.min_factor, slo / p95)
+        low, high = self.limits.get(model, (0, base))
+        budget = min(high, max(low, int(base * size_factor * latency_factor)))
+        record = {
+            "t": time.time(), "event": "choice", "model": model, "mode": mode, "prompt_tokens": prompt_tokens,
+            "context_tokens": context_tokens, "size_factor": round(size_factor, 3),
+            "latency_factor": round(latency_factor, 3), "p95": p95, "budget": budget,
+        }
+        self.recent.append(record)
+        self._log(record)
+        if self.metrics is not None:
+            self.metrics.observe("thinking_budget_tokens", budget, buckets=BUDGET_BUCKETS, model=model, mode=mode)
+        return budget
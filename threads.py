@@ -0,0 +1,219 @@
+import heapq
+import math
+import re
+from collections import Counter
+
+_WORD = re.compile(r"\w{3,}")
+# Too common in chat to say anything about which conversation a message belongs to.
+STOPWORDS = frozenset(
+    "the and for you that this with what was are but not have just like its it's can all get "
+    "how why who when where your from they them then there about would could should will lol "
+    "lmao yeah yes okay im dont cant thats also really one out too now got any some".split()
+)
+
+
+def tokenize(text):
+    return Counter(w for w in (w.lower() for w in _WORD.findall(text or "")) if w not in STOPWORDS)
+
+
+class _Thread:
+    __slots__ = ("members", "terms", "length", "last")
+
+    def __init__(self):
+        self.members = set()
+        self.terms = Counter()
+        self.length = 0
+        self.last = 0
+
+
+class ChannelThreads:
+    """Thread assignments for one channel's recent messages."""
+
+    def __init__(self):
+        self.messages = {}
+        self.order = []
+        self.threads = {}
+        self.last_by_author = {}
+        self.df = Counter()
+
+    def _add_terms(self, thread, tokens, sign):
+        for word, n in tokens.items():
+            before = thread.terms[word]
+            after = before + sign * n
+            if after > 0:
+                thread.terms[word] = after
+            else:
+                del thread.terms[word]
+            if not before and after > 0:
+                self.df[word] += 1
+            elif before and after <= 0:
+                self.df[word] -= 1
+                if not self.df[word]:
+                    del self.df[word]
+        thread.length += sign * sum(tokens.values())
+
+    def attach(self, message_id, author_id, timestamp, tokens, thread_id):
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            thread = self.threads[thread_id] = _Thread()
+        thread.members.add(message_id)
+        thread.last = max(thread.last, timestamp)
+        self._add_terms(thread, tokens, 1)
+        self.messages[message_id] = (thread_id, author_id, timestamp, tokens)
+        heapq.heappush(self.order, message_id)
+        previous = self.last_by_author.get(author_id)
+        if previous is None or previous not in self.messages or self.messages[previous][2] <= timestamp:
+            self.last_by_author[author_id] = message_id
+
+    def retokenize(self, message_id, tokens):
+        entry = self.messages.get(message_id)
+        if entry is None:
+            return
+        thread_id, author_id, timestamp, old = entry
+        thread = self.threads[thread_id]
+        self._add_terms(thread, old, -1)
+        self._add_terms(thread, tokens, 1)
+        self.messages[message_id] = (thread_id, author_id, timestamp, tokens)
+
+    def detach(self, message_id):
+        entry = self.messages.pop(message_id, None)
+        if entry is None:
+            return
+        thread_id, _, _, tokens = entry
+        thread = self.threads[thread_id]
+        thread.members.discard(message_id)
+        self._add_terms(thread, tokens, -1)
+        if not thread.members:
+            del self.threads[thread_id]
+
+    def evict_oldest(self):
+        while self.order:
+            message_id = heapq.heappop(self.order)
+            if message_id in self.messages:
+                self.detach(message_id)
+                return
+
+    def latest_by(self, author_id):
+        message_id = self.last_by_author.get(author_id)
+        return self.messages.get(message_id) if message_id is not None else None
+
+    def similar(self, tokens, since, k1=1.2, b=0.75, min_terms=2):
+        """Best (score, thread_id) by BM25 over threads active since `since`, treating each thread as a document.
+
+        Threads sharing fewer than `min_terms` words with `tokens` are skipped: in a busy channel a
+        single rare word scores high on its own but says little.
+        """
+        candidates = [(tid, t) for tid, t in self.threads.items() if t.last >= since]
+        if not tokens or not candidates:
+            return 0.0, None
+        total = len(self.threads)
+        avg_length = sum(t.length for t in self.threads.values()) / total or 1
+        best = (0.0, None)
+        for thread_id, thread in candidates:
+            score = 0.0
+            shared = 0
+            norm = k1 * (1 - b + b * thread.length / avg_length)
+            for word in tokens:
+                tf = thread.terms.get(word)
+                if not tf:
+                    continue
+                df = self.df[word]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + norm)
+                shared += 1
+            if shared >= min_terms and score > best[0]:
+                best = (score, thread_id)
+        return best
+
+
+class ThreadTracker:
+    """Groups each channel's messages into conversation threads, incrementally, as they arrive.
+
+    A new message joins, in order of preference: the thread of the message it replies to; the
+    thread of the latest message by a (non-bot) user it mentions; its author's previous thread if
+    that message is less than `adjacency_seconds` old (not for bots, whose messages always answer
+    someone); or the recently active thread it is most similar to by BM25 over message text, if
+    they share two or more words and the score reaches `min_similarity`. Otherwise it starts a
+    thread of its own, named by its ID. Each channel keeps its `limit` newest messages.
+    """
+
+    def __init__(self, limit=500, adjacency_seconds=120, active_seconds=3600, min_similarity=1.0, metrics=None):
+        self.limit = limit
+        self.adjacency_seconds = adjacency_seconds
+        self.active_seconds = active_seconds
+        self.min_similarity = min_similarity
+        self.metrics = metrics
+        self.channels = {}
+
+    def _channel(self, channel_id):
+        state = self.channels.get(channel_id)
+        if state is None:
+            state = self.channels[channel_id] = ChannelThreads()
+        return state
+
+    def _assign(self, state, msg, tokens, timestamp):
+        reference = getattr(msg, "reference", None)
+        parent = state.messages.get(getattr(reference, "message_id", None))
+        if parent is not None:
+            return parent[0], "reply"
+        for user in msg.mentions:
+            if getattr(user, "bot", False) or user.id == msg.author.id:
+                continue
+            # Messages backfilled by sync() can be older than what is already tracked; they
+            # must not join a thread through a message posted after them.
+            latest = state.latest_by(user.id)
+            if latest is not None and latest[2] <= timestamp:
+                return latest[0], "mention"
+        if not getattr(msg.author, "bot", False):
+            latest = state.latest_by(msg.author.id)
+            if latest is not None and 0 <= timestamp - latest[2] <= self.adjacency_seconds:
+                return latest[0], "author"
+        score, thread_id = state.similar(tokens, timestamp - self.active_seconds)
+        if thread_id is not None and score >= self.min_similarity:
+            return thread_id, "lexical"
+        return msg.id, "new"
+
+    def add(self, msg):
+        state = self._channel(msg.channel.id)
+        if msg.id in state.messages:
+            return
+        tokens = tokenize(msg.clean_content)
+        timestamp = msg.created_at.timestamp()
+        thread_id, signal = self._assign(state, msg, tokens, timestamp)
+        state.attach(msg.id, msg.author.id, timestamp, tokens, thread_id)
+        while len(state.messages) > self.limit:
+            state.evict_oldest()
+        if self.metrics is not None:
+            self.metrics.inc("thread_links_total", signal=signal)
+
+    def sync(self, msgs):
+        """Add any of `msgs` not seen yet, e.g. a history window backfilled after a restart."""
+        for msg in msgs:
+            self.add(msg)
+
+    def update(self, msg):
+        state = self.channels.get(msg.channel.id)
+        if state is not None:
+            state.retokenize(msg.id, tokenize(msg.clean_content))
+
+    def remove(self, channel_id, message_id):
+        state = self.channels.get(channel_id)
+        if state is not None:
+            state.detach(message_id)
+
+    def thread_of(self, channel_id, message_id):
+        state = self.channels.get(channel_id)
+        entry = state.messages.get(message_id) if state is not None else None
+        return entry[0] if entry is not None else None
+
+    def members(self, channel_id, thread_id):
+        state = self.channels.get(channel_id)
+        thread = state.threads.get(thread_id) if state is not None else None
+        return set(thread.members) if thread is not None else set()
+
+    def group(self, channel_id, message_ids):
+        """Split `message_ids` by thread: {thread_id: [ids]}, with untracked IDs under None."""
+        groups = {}
+        for message_id in message_ids:
+            groups.setdefault(self.thread_of(channel_id, message_id), []).append(message_id)
+        return groups
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import wave
+from collections import OrderedDict
+from io import BytesIO
+
+from google.genai import types
+
+DIRECTION_PROMPT = (
+    "Given the following Discord message, write a single line direction (e.g. 'Say dramatically:' "
+    "or 'Say in a deadpan voice:') for how it should be spoken out loud, based on its vibe/context. "
+    "The line should be suitable to prepend before the text for TTS.\n\nMessage: {text}"
+)
+
+
+def wav_bytes(pcm, channels=1, rate=24000, sample_width=2):
+    """Wrap raw PCM in a WAV container without touching the disk."""
+    out = BytesIO()
+    with wave.open(out, "wb") as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(rate)
+        wf.writeframes(pcm)
+    return out.getvalue()
+
+
+def _key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class SpeechPipeline:
+    """Direction + TTS synthesis with content-hash caching.
+
+    Audio is cached by (direction, text, voice) in a byte-bounded LRU, and the direction line is
+    cached by text, so speaking the same message again costs no model calls. Long text is split
+    at sentence boundaries by `split` and the pieces are synthesized concurrently and joined.
+    With a `shared` store, audio is also looked up in and written to it, so other workers can reuse it.
+    """
+
+    def __init__(self, pool, tts_model, direction_model, voice, split, max_bytes, chunk_chars, log=None, shared=None):
+        self.pool = pool
+        self.tts_model = tts_model
+        self.direction_model = direction_model
+        self.voice = voice
+        self.split = split
+        self.max_bytes = max_bytes
+        self.chunk_chars = chunk_chars
+        self.log = log
+        self.shared = shared
+        self.audio = OrderedDict()
+        self.audio_size = 0
+        self.directions = OrderedDict()
+        self.aliases = OrderedDict()
+
+    def _remember(self, cache, key, value, limit=1000):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    def _store_audio(self, key, data):
+        if key in self.audio:
+            self.audio_size -= len(self.audio.pop(key))
+        if len(data) > self.max_bytes:
+            return
+        self.audio[key] = data
+        self.audio_size += len(data)
+        while self.audio_size > self.max_bytes:
+            _, evicted = self.audio.popitem(last=False)
+            self.audio_size -= len(evicted)
+
+    def _get_audio(self, key):
+        data = self.audio.get(key)
+        if data is not None:
+            self.audio.move_to_end(key)
+        return data
+
+    async def direction(self, text):
+        text_key = _key(text)
+        cached = self.directions.get(text_key)
+        if cached is not None:
+            return cached
+        response = await self.pool.generate(
+            model=self.direction_model,
+            contents=DIRECTION_PROMPT.format(text=text),
+            config=types.GenerateContentConfig(
+                system_instruction="Respond only with the single line direction for TTS, nothing else.",
+            ),
+        )
+        if self.log:
+            self.log(response)
+        line = response.text.strip()
+        if not line.endswith(':'):
+            line += ':'
+        self._remember(self.directions, text_key, line)
+        return line
+
+    async def _synthesize_piece(self, direction, text):
+        response = await self.pool.generate(
+            model=self.tts_model,
+            contents=f"{direction} {text}",
+            config=types.GenerateContentConfig(
+                response_modalities=["AUDIO"],
+                speech_config=types.SpeechConfig(
+                    voice_config=types.VoiceConfig(
+                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                            voice_name=self.voice
+                        )
+                    )
+                ),
+            ),
+        )
+        if self.log:
+            self.log(response)
+        return response.candidates[0].content.parts[0].inline_data.data
+
+    async def synthesize(self, direction, text):
+        """Return WAV bytes for `text` spoken with `direction`."""
+        key = _key(direction, text, self.voice)
+        data = self._get_audio(key)
+        if data is None and self.shared is not None:
+            hit = await self.shared.load_blob("tts", key)
+            if hit is not None:
+                data = hit[0]
+                self._store_audio(key, data)
+        if data is None:
+            pieces = self.split(text, self.chunk_chars)
+            pcm = await asyncio.gather(*(self._synthesize_piece(direction, piece) for piece in pieces))
+            data = wav_bytes(b"".join(pcm))
+            self._store_audio(key, data)
+            if self.shared is not None:
+                await self.shared.save_blob("tts", key, data, "audio/wav")
+        self._remember(self.aliases, _key(text), key)
+        return data
+
+    def alias(self, text, spoken_text):
+        """Make `text` (e.g. the last chunk Discord shows) resolve to the audio cached for `spoken_text`."""
+        key = self.aliases.get(_key(spoken_text))
+        if key is not None:
+            self._remember(self.aliases, _key(text), key)
+
+    def cached(self, text):
+        """Return cached WAV bytes for text that was already spoken, or None."""
+        key = self.aliases.get(_key(text))
+        return self._get_audio(key) if key is not None else None